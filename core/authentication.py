@@ -0,0 +1,82 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+
+class UserCache:
+  # a bounded LRU of users by (user id, token jti), each entry kept for ttl seconds, per process. The users
+  # are stored with their permissions resolved (ModelBackend's _perm_cache...), so has_perm() and the
+  # permission classes need no query either. core.signals.handlers forgets a user when they, their groups
+  # or permissions change in this process; other processes see the change after ttl seconds at most
+  def __init__(self, maxsize=10000, ttl=60):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict() # key -> (expires, user)
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] <= time.monotonic():
+        self._entries.pop(key, None)
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+    return copy.copy(entry[1]) # a request may change its user, not the cached one
+
+  def set(self, key, user):
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl, user)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def forget(self, user_ids):
+    user_ids = {str(user_id) for user_id in user_ids}
+    with self._lock:
+      for key in [key for key in self._entries if key[0] in user_ids]:
+        del self._entries[key]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+def make_user_cache():
+  # CORE_USER_CACHE = {'MAXSIZE': 10000, 'TTL': 60}
+  options = getattr(settings, 'CORE_USER_CACHE', {})
+  return UserCache(maxsize=options.get('MAXSIZE', 10000), ttl=options.get('TTL', 60))
+
+
+user_cache = make_user_cache()
+
+
+def resolve_permissions(user):
+  # fills the permission caches ModelBackend keeps on the user (_perm_cache, _user_perm_cache, _group_perm_cache)
+  ModelBackend().get_all_permissions(user)
+  return user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+  # JWTAuthentication that loads the user of a token (and their permissions) once per user_cache.ttl
+  def get_user(self, validated_token):
+    key = (str(validated_token.get(api_settings.USER_ID_CLAIM)), validated_token.get(api_settings.JTI_CLAIM))
+    user = user_cache.get(key)
+    if user is None:
+      user = resolve_permissions(super().get_user(validated_token)) # raises for an unknown or inactive user
+      user_cache.set(key, user)
+      user = copy.copy(user)
+    return user
@@ -1,6 +1,38 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
+from core.authentication import user_cache
 from store.signals import order_created
 
+User = get_user_model()
+
 @receiver(order_created)
 def on_order_created(sender, **kwargs):
-  print(kwargs['order'])
\ No newline at end of file
+  print(kwargs['order'])
+
+@receiver([post_save, post_delete], sender=User)
+def forget_cached_user(sender, instance, **kwargs):
+  user_cache.forget([instance.pk])
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def forget_cached_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+  if not reverse:
+    user_cache.forget([instance.pk])
+  elif pk_set: # group.user_set.add(...) / permission.user_set.remove(...)
+    user_cache.forget(pk_set)
+  else: # a clear doesn't say which users
+    user_cache.clear()
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def forget_group_members(sender, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    user_cache.clear() # the permissions of every member of the group changed
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def forget_cached_users(sender, **kwargs):
+  user_cache.clear()
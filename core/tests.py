@@ -1,3 +1,41 @@
+from django.contrib.auth.models import Group, Permission
 from django.test import TestCase
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from core.authentication import user_cache
+from core.models import User
+from store.models import Customer
+
+
+class CachedJWTAuthenticationTest(TestCase):
+  # after the first request of a token the user and their permissions come from user_cache: the
+  # history endpoint then runs only its own queries (the customer's aggregates and orders, they have none)
+  def setUp(self):
+    user_cache.clear()
+    self.staff = User.objects.create_user('support', 'support@example.com', 'password', is_staff=True)
+    self.group = Group.objects.create(name='Support')
+    self.group.permissions.add(Permission.objects.get(codename='view_history'))
+    self.staff.groups.add(self.group)
+    customer = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+    self.url = '/store/customers/%s/history/' % Customer.objects.get(user=customer).pk
+
+    tokens = APIClient().post('/auth/jwt/create/', {'username': 'support', 'password': 'password'}).data
+    self.client = APIClient()
+    self.client.credentials(HTTP_AUTHORIZATION='JWT ' + tokens['access'])
+
+  def test_no_auth_queries_in_steady_state(self):
+    self.assertEqual(self.client.get(self.url).status_code, 200) # the user and their permissions are cached
+    with self.assertNumQueries(2):
+      self.assertEqual(self.client.get(self.url).status_code, 200)
+
+  def test_permission_changes_are_seen(self):
+    self.assertEqual(self.client.get(self.url).status_code, 200)
+    self.group.permissions.clear()
+    self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    self.staff.user_permissions.add(Permission.objects.get(codename='view_history'))
+    self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    self.staff.is_active = False
+    self.staff.save()
+    self.assertEqual(self.client.get(self.url).status_code, 401)
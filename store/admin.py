@@ -1,5 +1,4 @@
 from django.contrib import admin, messages
-from django.db.models.aggregates import Count
 from django.contrib.contenttypes.admin import GenericTabularInline
 from django.urls import reverse
 from django.utils.html import format_html, urlencode
@@ -58,6 +57,7 @@ class ProductAdmin(admin.ModelAdmin):
 class CollectionAdmin(admin.ModelAdmin):
   list_display = ['title', 'products_count']
   search_fields = ['title']
+  exclude = ['products_count'] # kept up to date by the products, see adjust_products_count
   
   @admin.display(ordering='products_count')
   def products_count(self, collection):
@@ -69,11 +69,6 @@ class CollectionAdmin(admin.ModelAdmin):
       }))
     return format_html('<a href="{}">{}</a>', url, collection.products_count)
 
-  def get_queryset(self, request):
-    return super().get_queryset(request).annotate(
-      products_count=Count('products')
-    )
-
 @admin.register(models.Customer)
 class CustomerAdmin(admin.ModelAdmin):
   list_display = ['first_name', 'last_name', 'membership'] # 'user__first_name' isn't supported at time of recording the video
@@ -1,9 +1,33 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+def serves_requests():
+    # the background jobs run in the processes that serve requests: a WSGI/ASGI server or the child process of
+    # runserver, not the autoreloader watching it, and not migrate, test or any other management command
+    program = os.path.basename(sys.argv[0]) if sys.argv else ''
+    if program in ('manage.py', 'django-admin', 'django-admin.py', '__main__.py', 'pytest', 'py.test'):
+        if sys.argv[1:2] != ['runserver']:
+            return False
+        return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+    return True
+
+
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
+    reaper_schedule = None
+    outbox_worker = None
 
     def ready(self) -> None:
-        import store.signals.handlers # this is to make sure the signals are loaded when the app is ready
\ No newline at end of file
+        import store.signals.handlers # this is to make sure the signals are loaded when the app is ready
+        if serves_requests():
+            self.start_background_jobs()
+
+    def start_background_jobs(self):
+        from store.outbox import start_outbox_worker
+        from store.reaper import start_reaper_schedule
+        self.reaper_schedule = start_reaper_schedule() # None unless STORE_CART_REAPER_INTERVAL is set
+        self.outbox_worker = start_outbox_worker() # None unless STORE_OUTBOX_WORKER is set
@@ -0,0 +1,109 @@
+import hashlib
+import threading
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class ResponseCache:
+  # responses are stored under a key that includes a "generation" token for every namespace they
+  # depend on (e.g. 'products' for lists, 'products:1' for a detail); invalidating a namespace just
+  # replaces its token so the old entries are never read again and age out by TTL/LRU
+  key_prefix = 'store:response:'
+  generation_prefix = 'store:generation:'
+
+  def __init__(self, alias):
+    self.alias = alias
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  @property
+  def cache(self):
+    return caches[self.alias]
+
+  def get_generations(self, namespaces):
+    keys = [self.generation_prefix + namespace for namespace in namespaces]
+    generations = self.cache.get_many(keys)
+    for key in keys:
+      if key not in generations:
+        # a brand new token (not 0) so entries written before an eviction of the token can't match
+        self.cache.add(key, uuid4().hex, None)
+        generations[key] = self.cache.get(key)
+    return [generations[key] for key in keys]
+
+  def make_key(self, request, namespaces):
+    query = sorted((name, value) for name, values in request.query_params.lists() for value in values)
+    parts = [request.path, repr(query)] + self.get_generations(namespaces)
+    return self.key_prefix + hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest()
+
+  def get(self, key):
+    data = self.cache.get(key)
+    with self._lock:
+      if data is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+    return data
+
+  def set(self, key, data):
+    self.cache.set(key, data)
+
+  def invalidate(self, *namespaces):
+    # wait for the transaction so a concurrent request can't cache what is about to be rolled back or replaced
+    def bump():
+      self.cache.set_many({self.generation_prefix + namespace: uuid4().hex for namespace in namespaces}, None)
+    transaction.on_commit(bump)
+
+  def stats(self):
+    with self._lock:
+      hits, misses = self.hits, self.misses
+    total = hits + misses
+    return {
+      'hits': hits,
+      'misses': misses,
+      'hit_ratio': round(hits / total, 4) if total else None,
+    }
+
+
+response_cache = ResponseCache(getattr(settings, 'STORE_RESPONSE_CACHE', 'default'))
+
+
+class CachedResponseMixin:
+  # caches the serialized data of list and retrieve; subclasses name the namespace that
+  # the signal handlers in store.signals.handlers invalidate when the underlying rows change.
+  # Lists depend on '<namespace>', a detail on '<namespace>:<pk>' (plus the list namespace
+  # when detail_depends_on_list is set, for details that aggregate over other rows)
+  cache_namespace = None
+  detail_depends_on_list = False
+
+  def get_cache_namespaces(self):
+    if self.action == 'retrieve':
+      lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+      namespaces = ['%s:%s' % (self.cache_namespace, self.kwargs[lookup_url_kwarg])]
+      if self.detail_depends_on_list:
+        namespaces.append(self.cache_namespace)
+      return namespaces
+    return [self.cache_namespace]
+
+  def list(self, request, *args, **kwargs):
+    return self.cached_response(super().list, request, *args, **kwargs)
+
+  def retrieve(self, request, *args, **kwargs):
+    return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+  def cached_response(self, handler, request, *args, **kwargs):
+    key = response_cache.make_key(request, self.get_cache_namespaces())
+    data = response_cache.get(key)
+    if data is not None:
+      return Response(data, headers={'X-Cache': 'HIT'})
+
+    response = handler(request, *args, **kwargs)
+    if response.status_code == status.HTTP_200_OK:
+      response_cache.set(key, response.data)
+    response['X-Cache'] = 'MISS'
+    return response
@@ -0,0 +1,394 @@
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import lru_cache
+from uuid import UUID, uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import NotFound
+
+from store import pricing
+from store.db import set_prefetched, upsert_increment
+from store.models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+
+class CartNotFound(NotFound):
+  default_detail = 'No cart with the given ID was found.'
+
+
+class CartStore:
+  # where carts and their items live. Items come back as CartItem instances with their product and the
+  # sale_price and line_total annotations of pricing.with_line_totals, carts with their items and
+  # items_total, so CartSerializer and CartItemSerializer render them whatever the store.
+  # persistent: the carts are rows of the database, the views can read them with querysets
+  persistent = False
+  batch_size = 500 # items per upsert statement
+
+  def create_cart(self):
+    raise NotImplementedError
+
+  def get_cart(self, cart_id):
+    # the cart with its items, or None
+    raise NotImplementedError
+
+  def get_items(self, cart_id):
+    # the items of the cart, or None when there is no such cart
+    raise NotImplementedError
+
+  def get_item(self, cart_id, item_id):
+    raise NotImplementedError
+
+  def add_items(self, cart_id, items):
+    # items: [{'product_id': ..., 'quantity': ...}], added to the quantities already in the cart.
+    # Returns the items after the addition, raises CartNotFound
+    raise NotImplementedError
+
+  def update_item(self, cart_item, quantity):
+    raise NotImplementedError
+
+  def delete_item(self, cart_item):
+    raise NotImplementedError
+
+  def delete_cart(self, cart_id):
+    raise NotImplementedError
+
+  def summary(self, cart_id):
+    # {'id', 'items_count', 'quantity', 'total_price'} or None
+    cart = self.get_cart(cart_id)
+    if cart is None:
+      return None
+    items = cart.items.all()
+    return {
+      'id': cart.id,
+      'items_count': len(items),
+      'quantity': sum(item.quantity for item in items),
+      'total_price': cart.items_total,
+    }
+
+
+class DatabaseCartStore(CartStore):
+  # carts and items are rows of the store_cart and store_cartitem tables
+  persistent = True
+
+  def items_queryset(self):
+    return pricing.with_line_totals(CartItem.objects.select_related('product'))
+
+  def create_cart(self):
+    return Cart.objects.create()
+
+  def get_cart(self, cart_id):
+    try:
+      return Cart.objects \
+        .annotate(items_total=pricing.cart_total()) \
+        .prefetch_related(Prefetch('items', queryset=self.items_queryset())) \
+        .filter(pk=cart_id).first()
+    except ValidationError: # not a uuid
+      return None
+
+  def get_items(self, cart_id):
+    # one query for a cart with items, the existence of the cart is only checked when there are none
+    try:
+      items = list(self.items_queryset().filter(cart_id=cart_id))
+    except ValidationError: # not a uuid
+      return None
+    if items or Cart.objects.filter(pk=cart_id).exists():
+      return items
+    return None
+
+  def get_item(self, cart_id, item_id):
+    try:
+      return self.items_queryset().filter(cart_id=cart_id, pk=item_id).first()
+    except (ValidationError, ValueError):
+      return None
+
+  def add_items(self, cart_id, items):
+    items = [{'cart_id': cart_id, **item} for item in items]
+    cart_items = []
+    with transaction.atomic():
+      # touching the cart first also locks it, and tells whether it exists
+      if not Cart.objects.filter(pk=cart_id).update(last_update=timezone.now()):
+        raise CartNotFound()
+      # adds to the quantity of an item already in the cart, or creates it, in one statement; two
+      # concurrent adds of the same product add up instead of failing on unique_together
+      for start in range(0, len(items), self.batch_size):
+        cart_items += upsert_increment(CartItem, items[start:start + self.batch_size], ['cart', 'product'], 'quantity', returning=True)
+    return cart_items
+
+  def update_item(self, cart_item, quantity):
+    cart_item.quantity = quantity
+    cart_item.save() # touches the cart
+    return cart_item
+
+  def delete_item(self, cart_item):
+    cart_item.delete()
+
+  def delete_cart(self, cart_id):
+    # nothing listens to the deletion of carts and items, two DELETEs instead of the collector
+    # selecting the cart first
+    with transaction.atomic(savepoint=False):
+      CartItem.objects.filter(cart_id=cart_id)._raw_delete(CartItem.objects.db)
+      Cart.objects.filter(pk=cart_id)._raw_delete(Cart.objects.db)
+
+  def summary(self, cart_id):
+    # one aggregate query, the items aren't loaded
+    try:
+      return pricing.cart_summary(Cart.objects.filter(pk=cart_id)) \
+        .values('id', 'items_count', 'quantity', 'total_price') \
+        .first()
+    except ValidationError: # not a uuid
+      return None
+
+
+class CacheCartStore(CartStore):
+  # carts in a key-value store: a Django cache (STORE_CART_CACHE, e.g. Redis; the default local memory
+  # cache stands in for it in one process and in tests). A cart is one entry, {'created_at',
+  # 'last_update', 'items': {product_id: quantity}}, expiring STORE_CART_EXPIRY_DAYS after its last
+  # change, and changed under a short lock entry so concurrent adds to a cart don't overwrite each other.
+  # Reads and writes of carts never touch the database, only the products of the items are read from it.
+  # An item's id is its product id, a product is at most once in a cart.
+  #
+  # With STORE_CART_WRITE_BEHIND (seconds) the changed carts are also written to the cart tables by a
+  # background thread every that many seconds, and a cart missing from the cache is read back from them.
+  key_prefix = 'store:cart:'
+  lock_prefix = 'store:cart-lock:'
+  lock_timeout = 5 # seconds a crashed writer can hold a cart
+  tombstone_timeout = 24 * 60 * 60 # a deleted cart not read back from the tables before it is flushed
+
+  def __init__(self, alias=None, write_behind=None, expiry_days=None):
+    self.alias = alias or getattr(settings, 'STORE_CART_CACHE', 'default')
+    self.write_behind = write_behind if write_behind is not None else getattr(settings, 'STORE_CART_WRITE_BEHIND', None)
+    self.timeout = (expiry_days or getattr(settings, 'STORE_CART_EXPIRY_DAYS', 30)) * 24 * 60 * 60
+    self._dirty = set()
+    self._dirty_lock = threading.Lock()
+    self._timer = None
+    if self.write_behind:
+      atexit.register(self.flush)
+      self.schedule_flush()
+
+  @property
+  def cache(self):
+    return caches[self.alias]
+
+  def make_key(self, cart_id):
+    return self.key_prefix + cart_id
+
+  @staticmethod
+  def normalize(cart_id):
+    try:
+      return str(UUID(str(cart_id)))
+    except ValueError:
+      return None
+
+  @contextmanager
+  def locked(self, cart_id):
+    # cache.add is atomic in every cache backend, the entry expires if the holder dies
+    key = self.lock_prefix + cart_id
+    token = uuid4().hex
+    while not self.cache.add(key, token, self.lock_timeout):
+      time.sleep(0.002)
+    try:
+      yield
+    finally:
+      if self.cache.get(key) == token:
+        self.cache.delete(key)
+
+  def read(self, cart_id):
+    entry = self.cache.get(self.make_key(cart_id))
+    if entry is None and self.write_behind:
+      entry = self.load(cart_id)
+    if entry is None or entry.get('deleted'):
+      return None
+    return entry
+
+  def write(self, cart_id, entry):
+    self.cache.set(self.make_key(cart_id), entry, self.timeout)
+    self.mark_dirty(cart_id)
+
+  def load(self, cart_id):
+    # read-through from the cart tables the write-behind keeps, e.g. after the cache was flushed
+    cart = Cart.objects.filter(pk=cart_id).values('created_at', 'last_update').first()
+    if cart is None:
+      return None
+    cart['items'] = dict(CartItem.objects.filter(cart_id=cart_id).order_by('pk').values_list('product_id', 'quantity'))
+    self.cache.add(self.make_key(cart_id), cart, self.timeout)
+    return self.cache.get(self.make_key(cart_id))
+
+  def build_items(self, cart_id, quantities):
+    # CartItems with their product and prices, like pricing.with_line_totals computes them
+    products = pricing.with_discounts(Product.objects.filter(pk__in=quantities)).in_bulk()
+    items = []
+    for product_id, quantity in quantities.items():
+      product = products.get(product_id)
+      if product is None: # deleted since, like the cascade would
+        continue
+      item = CartItem(id=product_id, cart_id=UUID(cart_id), product=product, quantity=quantity)
+      item.sale_price = pricing.product_sale_price(product)
+      item.line_total = quantity * item.sale_price
+      items.append(item)
+    return items
+
+  def create_cart(self):
+    now = timezone.now()
+    cart = Cart(id=uuid4(), created_at=now, last_update=now)
+    self.write(str(cart.id), {'created_at': now, 'last_update': now, 'items': {}})
+    cart.items_total = Decimal('0.00')
+    return set_prefetched(cart, 'items', [])
+
+  def get_cart(self, cart_id):
+    cart_id = self.normalize(cart_id)
+    entry = cart_id and self.read(cart_id)
+    if not entry:
+      return None
+    cart = Cart(id=UUID(cart_id), created_at=entry['created_at'], last_update=entry['last_update'])
+    items = self.build_items(cart_id, entry['items'])
+    cart.items_total = sum((item.line_total for item in items), Decimal('0.00'))
+    return set_prefetched(cart, 'items', items)
+
+  def get_items(self, cart_id):
+    cart_id = self.normalize(cart_id)
+    entry = cart_id and self.read(cart_id)
+    if not entry:
+      return None
+    return self.build_items(cart_id, entry['items'])
+
+  def get_item(self, cart_id, item_id):
+    cart_id = self.normalize(cart_id)
+    entry = cart_id and self.read(cart_id)
+    try:
+      item_id = int(item_id)
+    except (TypeError, ValueError):
+      return None
+    if not entry or item_id not in entry['items']:
+      return None
+    items = self.build_items(cart_id, {item_id: entry['items'][item_id]})
+    return items[0] if items else None
+
+  def add_items(self, cart_id, items):
+    cart_id = self.normalize(cart_id)
+    if cart_id is None:
+      raise CartNotFound()
+    with self.locked(cart_id):
+      entry = self.read(cart_id)
+      if entry is None:
+        raise CartNotFound()
+      added = {}
+      for item in items:
+        product_id = item['product_id']
+        entry['items'][product_id] = entry['items'].get(product_id, 0) + item['quantity']
+        added[product_id] = entry['items'][product_id]
+      entry['last_update'] = timezone.now()
+      self.write(cart_id, entry)
+    return [CartItem(id=product_id, cart_id=UUID(cart_id), product_id=product_id, quantity=quantity) for product_id, quantity in added.items()]
+
+  def update_item(self, cart_item, quantity):
+    cart_id = str(cart_item.cart_id)
+    with self.locked(cart_id):
+      entry = self.read(cart_id)
+      if entry is None:
+        raise CartNotFound()
+      entry['items'][cart_item.product_id] = quantity
+      entry['last_update'] = timezone.now()
+      self.write(cart_id, entry)
+    cart_item.quantity = quantity
+    return cart_item
+
+  def delete_item(self, cart_item):
+    cart_id = str(cart_item.cart_id)
+    with self.locked(cart_id):
+      entry = self.read(cart_id)
+      if entry is None or entry['items'].pop(cart_item.product_id, None) is None:
+        return
+      entry['last_update'] = timezone.now()
+      self.write(cart_id, entry)
+
+  def delete_cart(self, cart_id):
+    cart_id = self.normalize(cart_id)
+    if cart_id is None:
+      return
+    def delete():
+      if self.write_behind: # not read back from the tables before the flush deletes it there
+        self.cache.set(self.make_key(cart_id), {'deleted': True}, self.tombstone_timeout)
+        self.mark_dirty(cart_id)
+      else:
+        self.cache.delete(self.make_key(cart_id))
+    transaction.on_commit(delete) # at checkout, the cart stays if the order is rolled back
+
+  # write-behind
+
+  def mark_dirty(self, cart_id):
+    if self.write_behind:
+      with self._dirty_lock:
+        self._dirty.add(cart_id)
+
+  def schedule_flush(self):
+    self._timer = threading.Timer(self.write_behind, self.tick)
+    self._timer.daemon = True
+    self._timer.start()
+
+  def tick(self):
+    try:
+      self.flush()
+    except Exception: # the carts stay dirty, the next tick tries again
+      logger.exception('cart write-behind flush failed')
+    finally:
+      connection.close()
+      self.schedule_flush()
+
+  def flush(self):
+    # writes the carts changed since the last flush to the cart tables, a short transaction per batch
+    with self._dirty_lock:
+      cart_ids, self._dirty = list(self._dirty), set()
+    try:
+      for start in range(0, len(cart_ids), self.batch_size):
+        self.persist(cart_ids[start:start + self.batch_size])
+    except Exception:
+      with self._dirty_lock:
+        self._dirty.update(cart_ids)
+      raise
+    return len(cart_ids)
+
+  def persist(self, cart_ids):
+    entries = self.cache.get_many([self.make_key(cart_id) for cart_id in cart_ids])
+    live = {}
+    for cart_id in cart_ids:
+      entry = entries.get(self.make_key(cart_id))
+      if entry is not None and not entry.get('deleted'):
+        live[UUID(cart_id)] = entry
+    gone = [UUID(cart_id) for cart_id in cart_ids if UUID(cart_id) not in live] # deleted or expired
+
+    product_ids = {product_id for entry in live.values() for product_id in entry['items']}
+    products = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+    with transaction.atomic():
+      Cart.objects.filter(pk__in=gone).delete()
+      existing = set(Cart.objects.filter(pk__in=live).values_list('pk', flat=True))
+      Cart.objects.bulk_create([Cart(id=cart_id) for cart_id in live if cart_id not in existing])
+      # bulk_update writes the timestamps as they are, auto_now doesn't apply
+      Cart.objects.bulk_update(
+        [Cart(id=cart_id, created_at=entry['created_at'], last_update=entry['last_update']) for cart_id, entry in live.items()],
+        ['created_at', 'last_update'])
+      CartItem.objects.filter(cart_id__in=live).delete()
+      CartItem.objects.bulk_create([
+        CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+        for cart_id, entry in live.items()
+        for product_id, quantity in entry['items'].items() if product_id in products
+      ])
+
+
+@lru_cache(maxsize=None)
+def _load_store(path):
+  return import_string(path)()
+
+
+def get_cart_store():
+  return _load_store(getattr(settings, 'STORE_CART_STORE', 'store.carts.DatabaseCartStore'))
@@ -0,0 +1,185 @@
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import F
+from rest_framework import serializers
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.settings import api_settings
+from rest_framework.response import Response
+
+
+class NotCompilable(Exception):
+  pass
+
+
+def row_method(*lookups):
+  # marks row_<field> on a serializer as the values() row version of its SerializerMethodField,
+  # it is called with the values of the lookups (relative to the serializer, like field sources)
+  def decorator(func):
+    func.lookups = lookups
+    return func
+  return decorator
+
+
+def is_identity(field):
+  # fields whose to_representation returns the database value unchanged, no call needed
+  if isinstance(field, serializers.ChoiceField):
+    return all(isinstance(key, str) for key in field.choices)
+  if isinstance(field, PrimaryKeyRelatedField):
+    return field.pk_field is None
+  if isinstance(field, serializers.BigIntegerField):
+    return not getattr(field, 'coerce_to_string', api_settings.COERCE_BIGINT_TO_STRING)
+  return type(field) in (serializers.IntegerField, serializers.CharField, serializers.SlugField)
+
+
+class CompiledSerializer:
+  # a read only serializer flattened into one generated function that turns a values() row into the
+  # same dict ModelSerializer.to_representation builds from a model instance, without the per field
+  # get_attribute/to_representation dispatch. Nested serializers read prefixed lookups
+  # ('product__title'), nested many=True serializers cost one extra values() query each.
+  #
+  # Meta.row_annotations = {name: factory of a queryset annotation the row methods read}
+  def __init__(self, serializer):
+    self.serializer = serializer
+    self.model = serializer.Meta.model
+    self.lookups = []
+    self.children = [] # (field name, lookup from the child model to this one, CompiledSerializer)
+    self.namespace = {}
+    self.lines = []
+    self.variables = {}
+    body = self.compile_fields(serializer, '')
+    self.source = 'def to_representation(row):\n%s\n  return %s\n' % ('\n'.join(self.lines), body)
+    exec(compile(self.source, '<compiled %s>' % serializer.__class__.__name__, 'exec'), self.namespace)
+    self.to_representation = self.namespace['to_representation']
+
+  def add_lookup(self, lookup):
+    if lookup not in self.lookups:
+      self.lookups.append(lookup)
+    return 'row[%r]' % lookup
+
+  def add_global(self, value):
+    name = '_g%d' % len(self.namespace)
+    self.namespace[name] = value
+    return name
+
+  def add_variable(self, expression):
+    if expression not in self.variables:
+      self.variables[expression] = '_v%d' % len(self.lines)
+      self.lines.append('  %s = %s' % (self.variables[expression], expression))
+    return self.variables[expression]
+
+  def compile_fields(self, serializer, prefix):
+    items = []
+    for field in serializer._readable_fields:
+      name = field.field_name
+      if isinstance(field, serializers.SerializerMethodField):
+        method = getattr(serializer, 'row_' + name, None)
+        if method is None:
+          raise NotCompilable('%s.%s has no row_%s' % (serializer.__class__.__name__, name, name))
+        args = ', '.join(self.add_lookup(prefix + lookup) for lookup in method.lookups)
+        items.append('%r: %s(%s)' % (name, self.add_global(method), args))
+        continue
+
+      if field.source == '*' or '.' in field.source:
+        raise NotCompilable('%s.%s has source %r' % (serializer.__class__.__name__, name, field.source))
+
+      if isinstance(field, serializers.ListSerializer):
+        if prefix:
+          raise NotCompilable('nested many=True serializers are only supported at the top level')
+        self.children.append((name, self.get_owner_lookup(field.source), CompiledSerializer(field.child)))
+        items.append('%r: row[%r]' % (name, name))
+        continue
+
+      if isinstance(field, serializers.BaseSerializer):
+        # a null foreign key gives None for every column of the related row
+        nested_prefix = prefix + field.source + '__'
+        nested_pk = self.add_variable(self.add_lookup(nested_prefix + field.Meta.model._meta.pk.attname))
+        nested = self.compile_fields(field, nested_prefix)
+        items.append('%r: None if %s is None else %s' % (name, nested_pk, nested))
+        continue
+
+      value = self.add_variable(self.add_lookup(prefix + field.source))
+      if is_identity(field):
+        items.append('%r: %s' % (name, value))
+      else:
+        items.append('%r: None if %s is None else %s(%s)' % (name, value, self.add_global(field.to_representation), value))
+    return '{%s}' % ', '.join(items)
+
+  def get_owner_lookup(self, source):
+    relation = self.model._meta.get_field(source)
+    if relation.many_to_many and not relation.auto_created: # e.g. product.promotions
+      return relation.related_query_name()
+    if relation.one_to_many: # a reverse foreign key, e.g. order.items
+      return relation.field.name
+    raise NotCompilable('%s.%s is not a supported relation' % (self.model.__name__, source))
+
+  def values(self, queryset, *extra):
+    for name, factory in getattr(self.serializer.Meta, 'row_annotations', {}).items():
+      if name not in queryset.query.annotations:
+        queryset = queryset.annotate(**{name: factory()})
+    return queryset.prefetch_related(None).values(*self.lookups, *extra)
+
+  def load(self, rows):
+    # fills the nested many=True fields of the rows, one query per field for the whole page
+    rows = list(rows)
+    if not self.children or not rows:
+      return rows
+    pk_name = self.model._meta.pk.attname
+    owner_ids = [row[pk_name] for row in rows]
+    for name, owner_lookup, child in self.children:
+      grouped = {owner_id: [] for owner_id in owner_ids}
+      # the same order the prefetch of the model serializer gives
+      ordering = child.model._meta.ordering or ['pk']
+      queryset = child.model._default_manager.annotate(_owner=F(owner_lookup)).filter(_owner__in=owner_ids).order_by('_owner', *ordering)
+      for child_row in child.render_rows(child.load(child.values(queryset, '_owner'))):
+        grouped[child_row[0]].append(child_row[1])
+      for row in rows:
+        row[name] = grouped[row[pk_name]]
+    return rows
+
+  def render_rows(self, rows):
+    to_representation = self.to_representation
+    return [(row['_owner'], to_representation(row)) for row in rows]
+
+  def render(self, rows):
+    to_representation = self.to_representation
+    return [to_representation(row) for row in rows]
+
+  def serialize(self, rows):
+    return self.render(self.load(rows))
+
+
+@lru_cache(maxsize=256)
+def get_compiled_serializer(serializer_class, fields=None, expand=()):
+  # compiled once per serializer class and ?fields=/?expand= combination, None when the serializer
+  # uses something the compiler doesn't support (it is then rendered the normal way)
+  context = {'fields': None if fields is None else list(fields), 'expand': list(expand)}
+  try:
+    return CompiledSerializer(serializer_class(context=context))
+  except NotCompilable:
+    return None
+
+
+class CompiledListMixin:
+  # opt-in fast path for list: the page is fetched with values() and rendered by the compiled
+  # serializer instead of building model instances and serializers. The output is the same.
+  def get_compiled_serializer(self):
+    if not getattr(settings, 'STORE_COMPILED_SERIALIZERS', False):
+      return None
+    fields, expand = self.get_requested_fields() if hasattr(self, 'get_requested_fields') else (None, [])
+    return get_compiled_serializer(
+      self.get_serializer_class(),
+      None if fields is None else tuple(fields),
+      tuple(expand),
+    )
+
+  def list(self, request, *args, **kwargs):
+    compiled = self.get_compiled_serializer()
+    if compiled is None:
+      return super().list(request, *args, **kwargs)
+
+    queryset = compiled.values(self.filter_queryset(self.get_queryset()))
+    page = self.paginate_queryset(queryset)
+    if page is not None:
+      return self.get_paginated_response(compiled.serialize(page))
+    return Response(compiled.serialize(queryset))
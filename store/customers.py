@@ -0,0 +1,37 @@
+from django.conf import settings
+
+from store.caching import response_cache
+from store.models import Customer
+
+
+def make_key(user_id):
+  return 'store:customer-id:%s' % user_id
+
+
+def get_customer_id(user_id):
+  # the customer of a user is created with the user and never changes, the mapping is cached for
+  # STORE_CUSTOMER_ID_TTL seconds (store.signals.handlers forgets it when a customer is created or
+  # deleted, so a reused user id never reads a stale one). Raises Customer.DoesNotExist
+  cache = response_cache.cache
+  customer_id = cache.get(make_key(user_id))
+  if customer_id is None:
+    customer_id = Customer.objects.values_list('pk', flat=True).get(user_id=user_id)
+    cache.set(make_key(user_id), customer_id, getattr(settings, 'STORE_CUSTOMER_ID_TTL', 60 * 60))
+  return customer_id
+
+
+def forget_customer(user_id):
+  response_cache.cache.delete(make_key(user_id))
+
+
+def get_request_customer_id(request):
+  # the customer of the authenticated user, resolved once per request: from the customer_id claim of
+  # the access token (core.serializers.TokenObtainPairSerializer) or else get_customer_id
+  if not hasattr(request, '_customer_id'):
+    customer_id = None
+    if request.auth is not None and hasattr(request.auth, 'get'):
+      customer_id = request.auth.get('customer_id')
+    if customer_id is None:
+      customer_id = get_customer_id(request.user.id)
+    request._customer_id = customer_id
+  return request._customer_id
@@ -0,0 +1,114 @@
+from functools import reduce
+from operator import or_
+
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F, Q
+
+
+def upsert_increment(model, rows, conflict_fields, increment_field, returning=False):
+  # inserts the rows, or adds increment_field (a name, or a list of them) to the row that already has the
+  # same conflict_fields (a unique constraint), in one statement: ON CONFLICT DO UPDATE on PostgreSQL and
+  # SQLite and ON DUPLICATE KEY UPDATE on MySQL, so concurrent upserts of the same key add up instead of
+  # racing. rows are dicts keyed by attname, e.g. {'cart_id': ..., 'product_id': ..., 'quantity': 2}
+  opts = model._meta
+  keys = [opts.get_field(name) for name in conflict_fields]
+  increments = [opts.get_field(name) for name in ([increment_field] if isinstance(increment_field, str) else increment_field)]
+
+  merged = {} # the same key twice in one statement is an error on PostgreSQL, add them up first
+  for row in rows:
+    key = tuple(row[field.attname] for field in keys)
+    values = tuple(row[field.attname] for field in increments)
+    merged[key] = tuple(map(sum, zip(merged[key], values))) if key in merged else values
+  if not merged:
+    return [] if returning else None
+
+  using = router.db_for_write(model)
+  connection = connections[using]
+  with transaction.atomic(using=using):
+    if connection.vendor in ('mysql', 'postgresql', 'sqlite'):
+      returned = execute_upsert(connection, model, keys, increments, merged, returning)
+    else:
+      upsert_rows(model, using, keys, increments, merged)
+      returned = None
+    if not returning:
+      return None
+    if returned is None: # no RETURNING, read the rows back
+      lookups = [Q(**dict(zip([field.attname for field in keys], key))) for key in merged]
+      return list(model._default_manager.using(using).filter(reduce(or_, lookups)))
+    return returned
+
+
+def execute_upsert(connection, model, keys, increments, merged, returning):
+  qn = connection.ops.quote_name
+  opts = model._meta
+  fields = keys + increments
+  table = qn(opts.db_table)
+  columns = [qn(field.column) for field in increments]
+
+  params = []
+  for key, values in merged.items():
+    params += [field.get_db_prep_save(value, connection) for field, value in zip(fields, key + values)]
+  sql = 'INSERT INTO %s (%s) VALUES %s' % (
+    table,
+    ', '.join(qn(field.column) for field in fields),
+    ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(merged)),
+  )
+  if connection.vendor == 'mysql':
+    sql += ' ON DUPLICATE KEY UPDATE %s' % ', '.join('%s = %s + VALUES(%s)' % (column, column, column) for column in columns)
+  else:
+    sql += ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+      ', '.join(qn(field.column) for field in keys),
+      ', '.join('%s = %s.%s + EXCLUDED.%s' % (column, table, column, column) for column in columns))
+
+  use_returning = returning and connection.vendor != 'mysql' and connection.features.can_return_columns_from_insert
+  returned_fields = [opts.pk] + fields
+  if use_returning:
+    sql += ' RETURNING %s' % ', '.join(qn(field.column) for field in returned_fields)
+
+  with connection.cursor() as cursor:
+    cursor.execute(sql, params)
+    if not use_returning:
+      return None
+    rows = cursor.fetchall()
+
+  converters = [
+    (field, connection.ops.get_db_converters(field.get_col(opts.db_table)) + field.get_db_converters(connection))
+    for field in returned_fields
+  ]
+  instances = []
+  for row in rows:
+    values = []
+    for (field, field_converters), value in zip(converters, row):
+      for converter in field_converters:
+        value = converter(value, field.get_col(opts.db_table), connection)
+      values.append(value)
+    instances.append(model.from_db(connection.alias, [field.attname for field in returned_fields], values))
+  return instances
+
+
+def upsert_rows(model, using, keys, increments, merged):
+  # other databases: update, or insert when there is nothing to update; an insert that loses the
+  # race against a concurrent one hits the unique constraint and becomes an update
+  manager = model._default_manager.using(using)
+  for key, values in merged.items():
+    lookup = dict(zip([field.attname for field in keys], key))
+    added = {field.attname: F(field.attname) + value for field, value in zip(increments, values)}
+    if manager.filter(**lookup).update(**added):
+      continue
+    try:
+      with transaction.atomic(using=using):
+        manager.create(**lookup, **{field.attname: value for field, value in zip(increments, values)})
+    except IntegrityError:
+      manager.filter(**lookup).update(**added)
+
+
+def set_prefetched(instance, name, objects):
+  # what prefetch_related(name) leaves on an instance, so instance.<name>.all() returns the objects
+  # already in memory without a query
+  queryset = getattr(instance, name).all()
+  queryset._result_cache = list(objects)
+  queryset._prefetch_done = True
+  if not hasattr(instance, '_prefetched_objects_cache'):
+    instance._prefetched_objects_cache = {}
+  instance._prefetched_objects_cache[name] = queryset
+  return instance
@@ -0,0 +1,100 @@
+import csv
+import json
+from decimal import Decimal
+
+from rest_framework.negotiation import BaseContentNegotiation
+
+from store.filters import OrderExportFilter, OrderItemExportFilter, ProductFilter
+from store.models import Order, OrderItem, Product
+
+
+class Export:
+  # one exported table: a queryset, the columns of a row and the FilterSet for the query parameters
+  def __init__(self, queryset, columns, filterset_class):
+    self.queryset = queryset
+    self.columns = columns
+    self.filterset_class = filterset_class
+
+  def filter(self, params):
+    # returns (queryset, None) or (None, errors)
+    filterset = self.filterset_class(params, queryset=self.queryset.all())
+    if not filterset.is_valid():
+      return None, filterset.errors
+    return filterset.qs, None
+
+  def rows(self, queryset, chunk_size):
+    # keyset chunks (pk > last pk) instead of one long running query: MySQL drivers buffer the whole
+    # result of a query in memory, a chunk of chunk_size rows at a time keeps the memory flat everywhere
+    queryset = queryset.values_list('pk', *self.columns).order_by('pk')
+    last_pk = None
+    while True:
+      chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+      chunk = list(chunk[:chunk_size])
+      if not chunk:
+        return
+      last_pk = chunk[-1][0]
+      yield [row[1:] for row in chunk]
+      if len(chunk) < chunk_size:
+        return
+
+
+EXPORTS = {
+  'products': Export(
+    Product.objects.all(),
+    ['id', 'title', 'slug', 'description', 'unit_price', 'inventory', 'collection_id', 'last_update'],
+    ProductFilter,
+  ),
+  'orders': Export(
+    Order.objects.all(),
+    ['id', 'customer_id', 'placed_at', 'payment_status', 'last_update'],
+    OrderExportFilter,
+  ),
+  'order-items': Export(
+    OrderItem.objects.all(),
+    ['id', 'order_id', 'order__placed_at', 'order__payment_status', 'product_id', 'product__title', 'quantity', 'unit_price'],
+    OrderItemExportFilter,
+  ),
+}
+
+
+class ExportContentNegotiation(BaseContentNegotiation):
+  # the format is in the url, an Accept: text/csv header must not end in 406; errors are rendered as json
+  def select_parser(self, request, parsers):
+    return parsers[0]
+
+  def select_renderer(self, request, renderers, format_suffix=None):
+    return renderers[0], renderers[0].media_type
+
+
+class Echo:
+  # csv.writer writes to a file, this one hands the line back instead so it can be yielded
+  def write(self, value):
+    return value
+
+
+def to_text(value):
+  # full precision in both formats: decimals as strings (not floats) and datetimes with microseconds
+  if isinstance(value, Decimal):
+    return str(value)
+  if hasattr(value, 'isoformat'):
+    return value.isoformat()
+  return value
+
+
+def ndjson_lines(columns, chunks):
+  encoder = json.JSONEncoder(separators=(',', ':'))
+  for chunk in chunks:
+    yield ''.join(encoder.encode({column: to_text(value) for column, value in zip(columns, row)}) + '\n' for row in chunk)
+
+
+def csv_lines(columns, chunks):
+  writer = csv.writer(Echo())
+  yield writer.writerow(columns)
+  for chunk in chunks:
+    yield ''.join(writer.writerow([to_text(value) for value in row]) for row in chunk)
+
+
+FORMATS = {
+  'ndjson': ('application/x-ndjson', ndjson_lines),
+  'csv': ('text/csv', csv_lines),
+}
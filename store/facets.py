@@ -0,0 +1,90 @@
+import hashlib
+
+from django.db.models import Count, Q
+
+from store.caching import response_cache
+from store.models import Collection
+
+# (label, min, max) on unit_price, min inclusive and max exclusive
+PRICE_BUCKETS = [
+  ('0-10', None, 10),
+  ('10-25', 10, 25),
+  ('25-50', 25, 50),
+  ('50-100', 50, 100),
+  ('100+', 100, None),
+]
+LOW_STOCK = 10 # like the 'Low' inventory filter of the admin
+
+STOCK_BUCKETS = {
+  'in_stock': Q(inventory__gt=0),
+  'low_stock': Q(inventory__gt=0, inventory__lt=LOW_STOCK),
+  'out_of_stock': Q(inventory__lte=0),
+}
+
+
+def price_condition(low, high):
+  condition = Q()
+  if low is not None:
+    condition &= Q(unit_price__gte=low)
+  if high is not None:
+    condition &= Q(unit_price__lt=high)
+  return condition
+
+
+def collection_namespace(collection_id):
+  return 'facets:collection:%s' % collection_id
+
+
+def invalidate_collections(*collection_ids):
+  # the facets of these collections are recomputed on the next request, the others are reused
+  response_cache.invalidate(*[collection_namespace(collection_id) for collection_id in collection_ids if collection_id is not None])
+
+
+def count_rows(queryset):
+  # every facet in one GROUP BY collection pass, the buckets are conditional counts of the same rows
+  aggregates = {'count': Count('pk')}
+  for index, (label, low, high) in enumerate(PRICE_BUCKETS):
+    aggregates['price_%d' % index] = Count('pk', filter=price_condition(low, high))
+  for name, condition in STOCK_BUCKETS.items():
+    aggregates[name] = Count('pk', filter=condition)
+  rows = queryset.order_by().values('collection_id').annotate(**aggregates)
+  return {row.pop('collection_id'): row for row in rows}
+
+
+def make_key(params):
+  # the same filters in any order (or with an empty value) share one entry
+  normalized = sorted((name, value.strip()) for name, value in params if value.strip())
+  return 'store:facets:' + hashlib.md5(repr(normalized).encode()).hexdigest()
+
+
+def get_facets(queryset, params):
+  # the counts are cached per collection: a change to a product only recomputes the counts of its
+  # collection (store.signals.handlers bumps its generation), every other collection is reused
+  cache = response_cache.cache
+  key = make_key(params)
+  entry = cache.get(key) or {'rows': {}, 'generations': {}}
+
+  collections = dict(Collection.objects.order_by().values_list('pk', 'title'))
+  # generations are read before counting, a change made while counting is picked up next time
+  generations = dict(zip(collections, response_cache.get_generations([collection_namespace(pk) for pk in collections])))
+  stale = [pk for pk in collections if entry['generations'].get(pk) != generations[pk]]
+
+  rows = {pk: row for pk, row in entry['rows'].items() if pk in collections and pk not in stale}
+  if stale:
+    rows.update(count_rows(queryset.filter(collection_id__in=stale)))
+    cache.set(key, {'rows': rows, 'generations': generations})
+  return build_facets(rows, collections)
+
+
+def build_facets(rows, collections):
+  return {
+    'count': sum(row['count'] for row in rows.values()),
+    'collections': sorted(
+      [{'id': pk, 'title': collections[pk], 'count': row['count']} for pk, row in rows.items() if row['count']],
+      key=lambda collection: (collection['title'], collection['id'])),
+    'price': [
+      {'label': label, 'min': low, 'max': high, 'count': sum(row['price_%d' % index] for row in rows.values())}
+      for index, (label, low, high) in enumerate(PRICE_BUCKETS)
+    ],
+    'stock': {name: sum(row[name] for row in rows.values()) for name in STOCK_BUCKETS},
+  }
@@ -0,0 +1,135 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.serializers import ListSerializer
+
+
+def parse_field_list(value):
+  if value is None:
+    return None
+  return [name.strip() for name in value.split(',') if name.strip()]
+
+
+class SparseFieldsSerializerMixin:
+  # ?fields=id,title keeps only the named fields and ?expand=collection replaces a related id with
+  # the nested object (Meta.expandable_fields). The names come from the context and only apply to the
+  # top level serializer, so nested serializers always render in full.
+  #
+  # Meta.expandable_fields = {name: (serializer class or dotted path, serializer kwargs)}
+  # Meta.field_dependencies = {name: [model fields a computed field reads]}
+  # Meta.field_relations = {name: [lookups to prefetch when the field is rendered]}
+  # Meta.field_annotations = {name: {annotation: factory of the expression the field reads}}
+
+  def is_top_level(self):
+    parent = self.parent
+    if isinstance(parent, ListSerializer):
+      parent = parent.parent
+    return parent is None
+
+  def get_fields(self):
+    fields = super().get_fields()
+    if not self.is_top_level():
+      return fields
+
+    requested = self.context.get('fields')
+    expand = [name for name in self.context.get('expand') or () if name in self.get_expandable_fields()]
+    for name in expand:
+      path, kwargs = self.get_expandable_fields()[name]
+      serializer_class = import_string(path) if isinstance(path, str) else path
+      fields[name] = serializer_class(read_only=True, **kwargs)
+
+    if requested is not None:
+      allowed = set(requested) | set(expand)
+      for name in list(fields):
+        if name not in allowed:
+          fields.pop(name)
+    return fields
+
+  @classmethod
+  def get_expandable_fields(cls):
+    return getattr(cls.Meta, 'expandable_fields', {})
+
+  @classmethod
+  def plan_queryset(cls, queryset, fields=None, expand=()):
+    # load only the columns the requested fields read and join/prefetch only the relations they render,
+    # a narrow request selects fewer columns and a wide one still runs a fixed number of queries
+    opts = queryset.model._meta
+    expandable = cls.get_expandable_fields()
+    dependencies = getattr(cls.Meta, 'field_dependencies', {})
+    relations = getattr(cls.Meta, 'field_relations', {})
+    annotations = getattr(cls.Meta, 'field_annotations', {})
+
+    expand = [name for name in expand or () if name in expandable]
+    names = list(cls.Meta.fields) if fields is None else [name for name in fields if name in cls.Meta.fields]
+    names += [name for name in expand if name not in names]
+
+    columns = {opts.pk.name}
+    select_related = []
+    prefetch_related = []
+    annotate = {}
+    for name in names:
+      columns.update(dependencies.get(name, []))
+      prefetch_related.extend(relations.get(name, []))
+      annotate.update({annotation: factory() for annotation, factory in annotations.get(name, {}).items()})
+      try:
+        field = opts.get_field(name)
+      except FieldDoesNotExist:
+        continue # a field computed by the serializer
+      if field.concrete and not field.many_to_many:
+        columns.add(name)
+        if name in expand and field.is_relation:
+          select_related.append(name)
+      elif field.is_relation and name not in relations:
+        prefetch_related.append(name) # m2m and reverse relations render as a list
+
+    if annotate:
+      queryset = queryset.annotate(**annotate)
+    if select_related:
+      queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+      # several fields can share a lookup, prefetch it once
+      unique = {getattr(lookup, 'prefetch_to', lookup): lookup for lookup in prefetch_related}
+      queryset = queryset.prefetch_related(*unique.values())
+    if fields is not None:
+      queryset = queryset.only(*columns)
+    return queryset
+
+
+class SparseFieldsViewSetMixin:
+  # reads ?fields= and ?expand= on reads, passes them to the serializer and plans the queryset from them
+  fields_query_param = 'fields'
+  expand_query_param = 'expand'
+
+  def get_requested_fields(self):
+    if self.request is None or self.request.method not in SAFE_METHODS:
+      return None, []
+    params = self.request.query_params
+    fields, expand = parse_field_list(params.get(self.fields_query_param)), parse_field_list(params.get(self.expand_query_param)) or []
+    self.check_requested_fields(fields, expand)
+    return fields, expand
+
+  def check_requested_fields(self, fields, expand):
+    # a misspelled name is a 400, not a response silently missing the field
+    serializer_class = self.get_serializer_class()
+    if not hasattr(serializer_class, 'get_expandable_fields'):
+      return
+    expandable = serializer_class.get_expandable_fields()
+    unknown = {
+      self.fields_query_param: [name for name in fields or () if name not in serializer_class.Meta.fields and name not in expandable],
+      self.expand_query_param: [name for name in expand if name not in expandable],
+    }
+    errors = {param: [f'Unknown field "{name}".' for name in names] for param, names in unknown.items() if names}
+    if errors:
+      raise ValidationError(errors)
+
+  def get_serializer_context(self):
+    context = super().get_serializer_context()
+    context['fields'], context['expand'] = self.get_requested_fields()
+    return context
+
+  def plan_queryset(self, queryset):
+    if self.action not in ('list', 'retrieve'):
+      return queryset
+    fields, expand = self.get_requested_fields()
+    return self.get_serializer_class().plan_queryset(queryset, fields, expand)
@@ -1,6 +1,8 @@
-from django_filters.rest_framework import FilterSet
+from django_filters.rest_framework import ChoiceFilter, FilterSet, IsoDateTimeFilter
+from rest_framework.filters import SearchFilter
 
-from store.models import Product
+from store.models import Order, OrderItem, Product
+from store.search import get_search_backend
 
 class ProductFilter(FilterSet):
   class Meta:
@@ -8,4 +10,35 @@ class ProductFilter(FilterSet):
     fields = {
       'collection_id': ['exact'],
       'unit_price': ['gt', 'lt'],
-    }
\ No newline at end of file
+    }
+
+
+class OrderExportFilter(FilterSet):
+  # ?placed_at__gte=2024-01-01&placed_at__lt=2024-02-01&payment_status=C
+  class Meta:
+    model = Order
+    fields = {
+      'placed_at': ['gte', 'lt'],
+      'payment_status': ['exact'],
+    }
+
+
+class OrderItemExportFilter(FilterSet):
+  # the same parameters as OrderExportFilter, applied to the order of the item
+  placed_at__gte = IsoDateTimeFilter(field_name='order__placed_at', lookup_expr='gte')
+  placed_at__lt = IsoDateTimeFilter(field_name='order__placed_at', lookup_expr='lt')
+  payment_status = ChoiceFilter(field_name='order__payment_status', choices=Order.PAYMENT_STATUS_CHOICES)
+
+  class Meta:
+    model = OrderItem
+    fields = []
+
+
+class ProductSearchFilter(SearchFilter):
+  # same ?search= parameter as SearchFilter, the actual lookup is done by settings.STORE_SEARCH_BACKEND
+  def filter_queryset(self, request, queryset, view):
+    search_fields = self.get_search_fields(view, request)
+    search_terms = self.get_search_terms(request)
+    if not search_fields or not search_terms:
+      return queryset
+    return get_search_backend().search(queryset, search_terms, search_fields)
@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Min, Sum, Value
+from django.db.models.functions import Coalesce
+
+from store.models import Customer, CustomerStats, Order
+from store.pricing import PRICE, line_total_expression
+
+# the lifetime aggregates of a customer count every order placed, whatever its payment status. A customer
+# gets their CustomerStats row when created (store.signals.handlers) and every order adds to it; customers
+# from before the table are aggregated on the first read (or by manage.py rebuild_customer_stats)
+
+
+def aggregates():
+  # the aggregates of the orders, over their items; a values() queryset grouped by customer gets them per customer
+  return {
+    'orders_count': Count('pk', distinct=True),
+    'items_count': Coalesce(Sum('items__quantity'), 0),
+    'lifetime_spend': Coalesce(
+      Sum(line_total_expression('items__quantity', 'items__unit_price')), Value(Decimal('0.00')), output_field=PRICE),
+    'first_purchase_at': Min('placed_at'),
+    'last_purchase_at': Max('placed_at'),
+  }
+
+
+def record_order(order, order_items):
+  # adds an order being placed to the aggregates of its customer, in the caller's transaction
+  CustomerStats.objects.filter(pk=order.customer_id).update(
+    orders_count=F('orders_count') + 1,
+    items_count=F('items_count') + sum(item.quantity for item in order_items),
+    lifetime_spend=F('lifetime_spend') + sum([item.quantity * item.unit_price for item in order_items], Decimal('0.00')),
+    first_purchase_at=Coalesce(F('first_purchase_at'), Value(order.placed_at)),
+    last_purchase_at=order.placed_at,
+  )
+
+
+def get_stats(customer_id):
+  # the CustomerStats of the customer, aggregated with one query the first time; None if there is no such customer
+  stats = CustomerStats.objects.filter(pk=customer_id).first()
+  if stats is not None:
+    return stats
+  values = Order.objects.filter(customer_id=customer_id).aggregate(**aggregates())
+  if not values['orders_count'] and not Customer.objects.filter(pk=customer_id).exists():
+    return None
+  stats = CustomerStats(customer_id=customer_id, **values)
+  CustomerStats.objects.bulk_create([stats], ignore_conflicts=True)
+  return stats
+
+
+def rebuild(chunk_size=1000):
+  # aggregates the orders of every customer again, chunk_size customers per transaction; returns how many
+  written = 0
+  after = 0
+  while True:
+    ids = list(Customer.objects.filter(pk__gt=after).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+    if not ids:
+      return written
+    after = ids[-1]
+    with transaction.atomic():
+      rows = {
+        row.pop('customer_id'): row
+        for row in Order.objects.filter(customer_id__in=ids).order_by().values('customer_id').annotate(**aggregates())
+      }
+      CustomerStats.objects.bulk_create(
+        [CustomerStats(customer_id=customer_id, **rows.get(customer_id, {})) for customer_id in ids],
+        update_conflicts=True,
+        # MySQL's ON DUPLICATE KEY UPDATE takes no conflict target
+        unique_fields=['customer'] if connection.features.supports_update_conflicts_with_target else None,
+        update_fields=['orders_count', 'items_count', 'lifetime_spend', 'first_purchase_at', 'last_purchase_at'],
+      )
+    written += len(ids)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from store.models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+
+
+class IdempotencyKeyReused(APIException):
+  status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+  default_detail = 'This Idempotency-Key was already used with a different request.'
+  default_code = 'idempotency_key_reused'
+
+
+def get_ttl():
+  return timedelta(seconds=getattr(settings, 'STORE_IDEMPOTENCY_TTL', 24 * 60 * 60))
+
+
+def get_scope(request):
+  # a key only replays the same endpoint for the same user
+  user = request.user.pk if request.user and request.user.is_authenticated else ''
+  return hashlib.sha256(f'{user}|{request.method}|{request.path}'.encode()).hexdigest()
+
+
+def claim(scope, key, fingerprint):
+  # (record, created): a new record for this key, or the one of the first request with it. A concurrent
+  # request with the same key waits on the unique index until the first one commits and then replays it
+  now = timezone.now()
+  for attempt in range(2):
+    try:
+      with transaction.atomic():
+        return IdempotencyKey.objects.create(scope=scope, key=key, fingerprint=fingerprint, expires_at=now + get_ttl()), True
+    except IntegrityError:
+      record = IdempotencyKey.objects.select_for_update().filter(scope=scope, key=key).first()
+      if record is None: # purged meanwhile
+        continue
+      if record.expires_at > now:
+        return record, False
+      record.delete() # expired, the key starts over
+  raise IntegrityError('could not claim idempotency key %r' % key)
+
+
+def idempotent(view_method):
+  # for POST/PATCH/DELETE view methods: with an Idempotency-Key header the first successful response is
+  # stored (for STORE_IDEMPOTENCY_TTL seconds) and a retry with the same key gets it back, with an
+  # Idempotent-Replayed header, without running the view again. The view runs in the transaction that
+  # claims the key, so it is claimed only if it succeeds; an error isn't stored and can be retried
+  @wraps(view_method)
+  def wrapper(self, request, *args, **kwargs):
+    key = request.headers.get(HEADER)
+    if not key or request.method in SAFE_METHODS:
+      return view_method(self, request, *args, **kwargs)
+    if len(key) > MAX_KEY_LENGTH:
+      raise ValidationError({HEADER: [f'Ensure this header has no more than {MAX_KEY_LENGTH} characters.']})
+
+    fingerprint = hashlib.sha256(request.content_type.encode() + b'|' + request.body).hexdigest()
+    with transaction.atomic():
+      record, created = claim(get_scope(request), key, fingerprint)
+      if not created:
+        if record.fingerprint != fingerprint:
+          raise IdempotencyKeyReused()
+        return Response(json.loads(record.response), status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+      response = view_method(self, request, *args, **kwargs)
+      if not status.is_success(response.status_code):
+        record.delete() # not stored, a retry runs the view again
+        return response
+      record.status_code = response.status_code
+      record.response = json.dumps(response.data, cls=JSONEncoder)
+      record.save(update_fields=['status_code', 'response'])
+      return response
+  return wrapper
+
+
+def purge_expired(chunk_size=1000):
+  # deletes the expired keys in chunks, returns how many
+  deleted = 0
+  while True:
+    ids = list(IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('pk', flat=True)[:chunk_size])
+    if not ids:
+      return deleted
+    deleted += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,136 @@
+import csv
+import json
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from store.caching import response_cache
+from store.facets import invalidate_collections
+from store.models import Collection, Product
+from store.search import get_search_backend
+from store.serializers import ProductImportSerializer
+
+# media types of the request body for the import endpoint
+FORMATS = {
+  'text/csv': 'csv',
+  'application/x-ndjson': 'jsonl',
+  'application/jsonl': 'jsonl',
+  'application/x-jsonlines': 'jsonl',
+}
+
+
+def read_records(lines, format):
+  # yields (line number, record, error) for every product of a JSON Lines or CSV stream of text lines
+  if format == 'csv':
+    reader = csv.DictReader(lines)
+    for record in reader:
+      record.pop(None, None) # values beyond the header
+      yield reader.line_num, record, None
+    return
+
+  for number, line in enumerate(lines, start=1):
+    if not line.strip():
+      continue
+    try:
+      record = json.loads(line)
+    except ValueError as error:
+      yield number, None, {'non_field_errors': ['Invalid JSON: %s' % error]}
+      continue
+    if not isinstance(record, dict):
+      yield number, None, {'non_field_errors': ['Expected a JSON object.']}
+      continue
+    yield number, record, None
+
+
+class ProductImporter:
+  # upserts products by slug: each batch is validated with the ProductSerializer rules, its collection
+  # ids are checked with one query and it is written with bulk_create/bulk_update in one transaction.
+  # A row that fails validation is reported and skipped, it doesn't abort the rest of its batch.
+  update_fields = ['title', 'description', 'unit_price', 'inventory', 'collection_id', 'last_update']
+  max_errors = 1000 # errors reported in full, the rest are only counted
+
+  def __init__(self, batch_size=500):
+    self.batch_size = batch_size
+    self.created = 0
+    self.updated = 0
+    self.failed = 0
+    self.errors = []
+
+  def run(self, records):
+    records = iter(records)
+    while True:
+      batch = list(islice(records, self.batch_size))
+      if not batch:
+        break
+      self.import_batch(batch)
+    return self.report()
+
+  def report(self):
+    return {
+      'created': self.created,
+      'updated': self.updated,
+      'failed': self.failed,
+      'errors': self.errors,
+    }
+
+  def add_error(self, line, errors):
+    self.failed += 1
+    if len(self.errors) < self.max_errors:
+      self.errors.append({'line': line, 'errors': errors})
+
+  def import_batch(self, batch):
+    rows = {} # slug -> (line, validated data), a slug repeated in the batch keeps its last row
+    for line, record, errors in batch:
+      if errors is None:
+        serializer = ProductImportSerializer(data=record)
+        if serializer.is_valid():
+          rows[serializer.validated_data['slug']] = (line, serializer.validated_data)
+          continue
+        errors = serializer.errors
+      self.add_error(line, errors)
+
+    collection_ids = {data['collection_id'] for line, data in rows.values()}
+    known_collections = set(Collection.objects.filter(pk__in=collection_ids).values_list('pk', flat=True))
+    for slug, (line, data) in list(rows.items()):
+      if data['collection_id'] not in known_collections:
+        self.add_error(line, {'collection': ['Invalid pk "%s" - object does not exist.' % data['collection_id']]})
+        del rows[slug]
+    if not rows:
+      return
+
+    with transaction.atomic():
+      existing = {}
+      for product in Product.objects.filter(slug__in=rows).order_by('pk'):
+        existing.setdefault(product.slug, product) # slug isn't unique, the oldest product is the one updated
+
+      # the facet counts of the collections products are added to or moved out of
+      collections = {data['collection_id'] for line, data in rows.values()}
+      collections.update(product.collection_id for product in existing.values())
+
+      now = timezone.now()
+      created, updated = [], []
+      for slug, (line, data) in rows.items():
+        product = existing.get(slug)
+        if product is None:
+          created.append(Product(**data))
+          continue
+        for name, value in data.items():
+          setattr(product, name, value)
+        product.last_update = now # bulk_update doesn't apply auto_now
+        updated.append(product)
+
+      Product.objects.bulk_create(created, batch_size=self.batch_size)
+      Product.objects.bulk_update(updated, self.update_fields, batch_size=self.batch_size)
+      if any(product.pk is None for product in created):
+        # not every backend returns the ids of a bulk insert
+        created = list(Product.objects.filter(slug__in=[product.slug for product in created]))
+
+      # the bulk queries don't send post_save, do what the signal handlers in store.signals.handlers do
+      products = created + updated
+      get_search_backend().index_products(products)
+      response_cache.invalidate('products', 'collections', *['products:%s' % product.pk for product in updated])
+      invalidate_collections(*collections)
+
+    self.created += len(created)
+    self.updated += len(updated)
@@ -0,0 +1,68 @@
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ErrorDetail
+
+from store.caching import response_cache
+from store.facets import invalidate_collections
+from store.models import Product
+
+
+class OutOfStock(APIException):
+  # 409 with the products that don't have enough units:
+  # {"detail": "...", "products": [{"id": 1, "title": "...", "requested": 3, "available": 1}]}
+  status_code = status.HTTP_409_CONFLICT
+  default_detail = 'Some products of the cart are out of stock.'
+  default_code = 'out_of_stock'
+
+  def __init__(self, products):
+    super().__init__()
+    self.products = products
+    self.detail = {'detail': ErrorDetail(self.default_detail, self.default_code), 'products': products}
+
+
+def shortages(quantities, rows):
+  # rows: (pk, title, inventory) of the products, a deleted product has nothing available
+  found = {pk: (title, inventory) for pk, title, inventory in rows}
+  short = []
+  for pk, quantity in sorted(quantities.items()):
+    title, inventory = found.get(pk, (None, 0))
+    if inventory < quantity:
+      short.append({'id': pk, 'title': title, 'requested': quantity, 'available': max(inventory, 0)})
+  return short
+
+
+def reserve(quantities):
+  # takes {product_id: quantity} units out of Product.inventory in the caller's transaction, or raises
+  # OutOfStock and takes none. The product rows are locked in id order, so two orders sharing products
+  # always lock them in the same order and can't deadlock; then one conditional UPDATE takes the units.
+  if not quantities:
+    return
+  product_ids = sorted(quantities)
+  locks = connection.features.has_select_for_update
+  with transaction.atomic(savepoint=False):
+    rows = list(
+      Product.objects.filter(pk__in=product_ids).order_by('pk').select_for_update()
+        .values_list('pk', 'title', 'inventory', 'collection_id'))
+    short = shortages(quantities, [row[:3] for row in rows])
+    if short:
+      raise OutOfStock(short)
+
+    requested = Case(*[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()], output_field=IntegerField())
+    try:
+      with transaction.atomic(savepoint=not locks): # with the rows locked the update can't come up short
+        # the plain update, the rows are already locked and the invalidation is below
+        updated = Product._base_manager \
+          .filter(pk__in=product_ids, inventory__gte=requested) \
+          .update(inventory=F('inventory') - requested, last_update=timezone.now())
+        if updated != len(product_ids):
+          raise OutOfStock([])
+    except OutOfStock:
+      # only without row locks (SQLite): another order took the units between the check and the update
+      rows = Product.objects.filter(pk__in=product_ids).values_list('pk', 'title', 'inventory')
+      raise OutOfStock(shortages(quantities, rows))
+
+  # the bulk update doesn't send post_save, the product responses and stock facets are stale
+  response_cache.invalidate('products', *['products:%s' % pk for pk in product_ids])
+  invalidate_collections(*{row[3] for row in rows})
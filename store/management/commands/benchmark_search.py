@@ -0,0 +1,92 @@
+import random
+import time
+from decimal import Decimal
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from store.models import Collection, Product
+from store.search import InvertedIndexSearchBackend, LikeSearchBackend
+
+
+class Command(BaseCommand):
+  help = 'Compares the LIKE based SearchFilter with the inverted index search backend on a generated catalog.'
+
+  search_fields = ['title', 'description']
+
+  def add_arguments(self, parser):
+    parser.add_argument('--products', type=int, default=1_000_000)
+    parser.add_argument('--vocabulary', type=int, default=20_000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+
+  def handle(self, *args, **options):
+    # everything runs in a throwaway test database so the benchmark never touches real data
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+      self.run(options)
+    finally:
+      connection.creation.destroy_test_db(old_name, verbosity=0)
+
+  def run(self, options):
+    rng = random.Random(options['seed'])
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = list({''.join(rng.choices(letters, k=rng.randint(4, 10))) for _ in range(options['vocabulary'])})
+    # zipf-like, a few words are in most products and most words are in a handful of products
+    weights = list(accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+    started = time.perf_counter()
+    self.generate_catalog(rng, words, weights, options['products'], options['batch_size'])
+    self.stdout.write(f'Generated {options["products"]} products in {time.perf_counter() - started:.1f}s')
+
+    index = InvertedIndexSearchBackend()
+    started = time.perf_counter()
+    last_id = 0
+    while True:
+      products = list(Product.objects.filter(pk__gt=last_id).order_by('pk')
+        .only('id', 'title', 'description')[:options['batch_size']])
+      if not products:
+        break
+      index.index_products(products)
+      last_id = products[-1].pk
+    self.stdout.write(f'Built the search index in {time.perf_counter() - started:.1f}s')
+
+    # typical searches name a specific product (words picked uniformly), the common set picks
+    # the words most products share, which is the worst case for the index
+    query_sets = {
+      'typical': [rng.sample(words, rng.randint(1, 2)) for _ in range(options['queries'])],
+      'common': [rng.sample(words[:50], rng.randint(1, 2)) for _ in range(options['queries'])],
+    }
+    self.stdout.write(f'{"queries":<10}{"backend":<28}{"total":>10}{"per query":>12}')
+    for label, queries in query_sets.items():
+      like_total = self.time_backend(LikeSearchBackend(), queries)
+      index_total = self.time_backend(index, queries)
+      for name, total in [('LikeSearchBackend', like_total), ('InvertedIndexSearchBackend', index_total)]:
+        self.stdout.write(f'{label:<10}{name:<28}{total:>9.3f}s{total / len(queries) * 1000:>10.1f}ms')
+      self.stdout.write(self.style.SUCCESS(f'{label} speedup: {like_total / index_total:.1f}x'))
+
+  def generate_catalog(self, rng, words, weights, count, batch_size):
+    collection = Collection.objects.create(title='Benchmark')
+    for start in range(0, count, batch_size):
+      Product.objects.bulk_create([
+        Product(
+          title=' '.join(rng.choices(words, cum_weights=weights, k=3)),
+          slug='product-%d' % (start + i),
+          description=' '.join(rng.choices(words, cum_weights=weights, k=20)),
+          unit_price=Decimal('10.00'),
+          inventory=10,
+          collection=collection,
+        ) for i in range(min(batch_size, count - start))
+      ])
+
+  def time_backend(self, backend, queries):
+    # what a ?search= request costs: the page count plus the first page of ten products
+    started = time.perf_counter()
+    for terms in queries:
+      queryset = backend.search(Product.objects.all(), terms, self.search_fields)
+      queryset.count()
+      list(queryset[:10])
+    return time.perf_counter() - started
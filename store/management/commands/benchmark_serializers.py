@@ -0,0 +1,129 @@
+import gc
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+
+from store.compiled import get_compiled_serializer
+from store.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product, Promotion
+from store.pricing import with_discounts
+from store.serializers import CartItemSerializer, OrderItemSerializer, OrderSerializer, ProductSerializer, SimpleProductSerializer
+from core.models import User
+
+
+class Command(BaseCommand):
+  help = 'Compares DRF serializers with their compiled (store.compiled) version on generated data, per 1,000 rows.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+
+  def handle(self, *args, **options):
+    # everything runs in a throwaway test database so the benchmark never touches real data
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+      self.run(options)
+    finally:
+      connection.creation.destroy_test_db(old_name, verbosity=0)
+
+  def run(self, options):
+    rng = random.Random(options['seed'])
+    started = time.perf_counter()
+    self.generate_data(rng, options['rows'], options['batch_size'])
+    self.stdout.write(f'Generated {options["rows"]} rows per table in {time.perf_counter() - started:.1f}s')
+
+    # the querysets the viewsets render, each serializer is timed from the query to the json bytes
+    cases = [
+      (ProductSerializer, with_discounts(Product.objects.all())),
+      (SimpleProductSerializer, Product.objects.all()),
+      (CartItemSerializer, CartItem.objects.prefetch_related(Prefetch('product', queryset=with_discounts(Product.objects.all())))),
+      (OrderItemSerializer, OrderItem.objects.select_related('product')),
+      (OrderSerializer, Order.objects.prefetch_related('items__product')),
+    ]
+    # end to end is the query plus the json bytes, rendering leaves out the queries (rows and
+    # instances are loaded beforehand) which is the part the compiled serializer replaces
+    self.stdout.write(f'{"":<26}{"":>8}{"end to end per 1k rows":^36}{"rendering per 1k rows":^36}')
+    self.stdout.write(f'{"serializer":<26}{"rows":>8}' + f'{"drf":>12}{"compiled":>12}{"speedup":>12}' * 2)
+    for serializer_class, queryset in cases:
+      queryset = queryset.order_by('pk')
+      compiled = get_compiled_serializer(serializer_class)
+      if compiled is None:
+        raise CommandError(f'{serializer_class.__name__} can not be compiled')
+
+      timings = []
+      drf_time, drf_output = self.time(options['repeat'], lambda: serializer_class(queryset, many=True).data)
+      compiled_time, compiled_output = self.time(options['repeat'], lambda: compiled.serialize(compiled.values(queryset)))
+      if drf_output != compiled_output:
+        raise CommandError(f'{serializer_class.__name__}: the compiled output is different')
+      timings.append((drf_time, compiled_time))
+
+      instances = list(queryset)
+      rows = compiled.load(compiled.values(queryset))
+      drf_time, drf_output = self.time(options['repeat'], lambda: serializer_class(instances, many=True).data)
+      compiled_time, compiled_output = self.time(options['repeat'], lambda: compiled.render(rows))
+      if drf_output != compiled_output:
+        raise CommandError(f'{serializer_class.__name__}: the compiled output is different')
+      timings.append((drf_time, compiled_time))
+
+      line = f'{serializer_class.__name__:<26}{len(rows):>8}'
+      for drf_time, compiled_time in timings:
+        line += f'{drf_time / len(rows) * 1_000_000:>10.1f}ms{compiled_time / len(rows) * 1_000_000:>10.1f}ms{drf_time / compiled_time:>11.1f}x'
+      self.stdout.write(line)
+    self.stdout.write(self.style.SUCCESS('The compiled output is byte for byte identical for every serializer'))
+
+  def time(self, repeat, serialize):
+    # best of n without gc pauses (like timeit), the rendered bytes are returned to compare both versions
+    renderer = JSONRenderer()
+    best = None
+    gc.disable()
+    try:
+      for _ in range(repeat):
+        started = time.perf_counter()
+        output = renderer.render(serialize())
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    finally:
+      gc.enable()
+    return best, output
+
+  def generate_data(self, rng, count, batch_size):
+    collection = Collection.objects.create(title='Benchmark')
+    promotions = [Promotion.objects.create(description='Promotion %d' % i, discount=rng.choice([0.05, 0.1, 0.15, 0.333])) for i in range(5)]
+    for start in range(0, count, batch_size):
+      Product.objects.bulk_create([
+        Product(
+          title='Product %d' % (start + i),
+          slug='product-%d' % (start + i),
+          description='Description of product %d' % (start + i) if i % 4 else None,
+          unit_price=Decimal(rng.randint(100, 99999)) / 100,
+          inventory=rng.randint(0, 100),
+          collection=collection,
+        ) for i in range(min(batch_size, count - start))
+      ])
+    product_ids = list(Product.objects.values_list('pk', flat=True))
+    Through = Product.promotions.through
+    Through.objects.bulk_create([
+      Through(product_id=product_id, promotion_id=rng.choice(promotions).pk) for product_id in product_ids[::3]
+    ])
+
+    cart = Cart.objects.create()
+    CartItem.objects.bulk_create([
+      CartItem(cart=cart, product_id=product_id, quantity=rng.randint(1, 5)) for product_id in product_ids
+    ], batch_size=batch_size)
+
+    user = User.objects.create_user(username='benchmark', email='benchmark@example.com', password=None)
+    customer = Customer.objects.get_or_create(user=user)[0]
+    # about three items per order, count order items in total
+    Order.objects.bulk_create([Order(customer=customer) for _ in range(count // 3 + 1)], batch_size=batch_size)
+    order_ids = list(Order.objects.values_list('pk', flat=True)) # bulk_create doesn't set the pks on every backend
+    OrderItem.objects.bulk_create([
+      OrderItem(order_id=rng.choice(order_ids), product_id=product_id, quantity=rng.randint(1, 5), unit_price=Decimal('9.99'))
+      for product_id in product_ids
+    ], batch_size=batch_size)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from store.recommendations import RecommendationBuilder
+
+
+class Command(BaseCommand):
+  help = 'Counts the products bought together in the orders placed since the last build (or in every order with --full) and stores the top ones of every product.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--full', action='store_true', help='count every order again instead of adding the new ones')
+    parser.add_argument('--top-k', type=int, default=None, help='recommendations kept per product (default: STORE_RECOMMENDATIONS_TOP_K)')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='orders read at a time')
+
+  def handle(self, *args, **options):
+    build = RecommendationBuilder(top_k=options['top_k'], chunk_size=options['chunk_size']).build(full=options['full'])
+    kind = 'Full' if build.full else 'Incremental'
+    self.stdout.write(self.style.SUCCESS(
+      f'{kind} build: counted {build.orders_count} orders up to #{build.last_order_id}, '
+      f'wrote the recommendations of {build.products_count} products.'))
@@ -0,0 +1,35 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.importing import ProductImporter, read_records
+
+
+class Command(BaseCommand):
+  help = 'Upserts products by slug from a JSON Lines or CSV file (- for stdin), in batches.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='defaults to the file extension')
+    parser.add_argument('--batch-size', type=int, default=500)
+
+  def handle(self, *args, **options):
+    path = options['path']
+    format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl' if path != '-' else None)
+    if format is None:
+      raise CommandError('--format is required when reading from stdin')
+
+    importer = ProductImporter(batch_size=options['batch_size'])
+    if path == '-':
+      report = importer.run(read_records(sys.stdin, format))
+    else:
+      with open(path, encoding='utf-8-sig', newline='') as lines:
+        report = importer.run(read_records(lines, format))
+
+    for error in report['errors']:
+      self.stderr.write(f'line {error["line"]}: {json.dumps(error["errors"])}')
+    if report['failed'] > len(report['errors']):
+      self.stderr.write(f'... and {report["failed"] - len(report["errors"])} more errors')
+    self.stdout.write(self.style.SUCCESS(
+      f'{report["created"]} products created, {report["updated"]} updated, {report["failed"]} rows failed.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+  help = 'Deletes the stored responses of Idempotency-Key requests older than STORE_IDEMPOTENCY_TTL, in chunks.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=1000)
+
+  def handle(self, *args, **options):
+    deleted = purge_expired(chunk_size=options['chunk_size'])
+    self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys.'))
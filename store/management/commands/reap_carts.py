@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from store.reaper import CartReaper, cart_reaper
+
+
+class Command(BaseCommand):
+  help = 'Deletes the carts (and their items) untouched for STORE_CART_EXPIRY_DAYS, in chunks of short transactions.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--dry-run', action='store_true', help='only count the carts and items that would be deleted')
+    parser.add_argument('--chunk-size', type=int, default=cart_reaper.chunk_size)
+    parser.add_argument('--pause', type=float, default=cart_reaper.pause, help='seconds to sleep between chunks')
+
+  def handle(self, *args, **options):
+    reaper = CartReaper(chunk_size=options['chunk_size'], pause=options['pause'])
+    report = reaper.run(dry_run=options['dry_run'])
+
+    verb = 'Would delete' if report['dry_run'] else 'Deleted'
+    self.stdout.write(self.style.SUCCESS(
+      f'{verb} {report["carts"]} carts and {report["items"]} cart items last updated before '
+      f'{report["cutoff"].isoformat()} ({report["chunks"]} chunks, {report["seconds"]}s).'))
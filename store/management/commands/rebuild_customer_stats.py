@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store import history
+
+
+class Command(BaseCommand):
+  help = 'Aggregates the orders of every customer into store.models.CustomerStats again, in chunks of short transactions.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=1000)
+
+  def handle(self, *args, **options):
+    written = history.rebuild(chunk_size=options['chunk_size'])
+    self.stdout.write(self.style.SUCCESS(f'Aggregated the orders of {written} customers.'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from store import snapshots
+from store.serializers import OrderSerializer
+
+
+class Command(BaseCommand):
+  help = 'Writes the snapshots (store.models.OrderSnapshot) of the orders, in chunks of short transactions.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--missing', action='store_true', help='only the orders that have no snapshot')
+    parser.add_argument('--chunk-size', type=int, default=500)
+
+  def handle(self, *args, **options):
+    written = snapshots.rebuild(OrderSerializer, chunk_size=options['chunk_size'], missing=options['missing'])
+    self.stdout.write(self.style.SUCCESS(f'Wrote the snapshots of {written} orders.'))
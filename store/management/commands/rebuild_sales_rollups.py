@@ -0,0 +1,30 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from store import rollups
+from store.models import Order
+
+
+class Command(BaseCommand):
+  help = 'Recomputes the daily sales rollups (store.rollups) of a range of days from the completed orders, a chunk of days per transaction.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--start', type=date.fromisoformat, help='first day, YYYY-MM-DD (default: the day of the first order)')
+    parser.add_argument('--end', type=date.fromisoformat, help='last day, YYYY-MM-DD (default: today)')
+    parser.add_argument('--chunk-days', type=int, default=7)
+
+  def handle(self, *args, **options):
+    end = options['end'] or timezone.localdate()
+    start = options['start']
+    if start is None:
+      first_order = Order.objects.order_by('placed_at').values_list('placed_at', flat=True).first()
+      start = timezone.localdate(first_order) if first_order else end
+    if start > end:
+      raise CommandError('--start is after --end')
+    if options['chunk_days'] < 1:
+      raise CommandError('--chunk-days must be at least 1')
+
+    chunks = rollups.rebuild(start, end, chunk_days=options['chunk_days'])
+    self.stdout.write(self.style.SUCCESS(f'Rebuilt the sales rollups from {start} to {end} ({chunks} chunks).'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.search import get_search_backend
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the product search index in batches of products.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=1000)
+
+  def handle(self, *args, **options):
+    backend = get_search_backend()
+    batch_size = options['batch_size']
+    last_id = 0
+    indexed = 0
+    while True:
+      products = list(
+        Product.objects.filter(pk__gt=last_id).order_by('pk').only('id', 'title', 'description')[:batch_size])
+      if not products:
+        break
+      backend.index_products(products)
+      indexed += len(products)
+      last_id = products[-1].pk
+      self.stdout.write(f'{indexed} products indexed')
+
+    self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} products with {backend.__class__.__name__}.'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Collection, recount_products
+
+
+class Command(BaseCommand):
+  help = 'Recounts Collection.products_count from the products table in batches of collections and repairs any drift.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=100)
+
+  def handle(self, *args, **options):
+    batch_size = options['batch_size']
+    last_id = 0
+    checked = 0
+    repaired = 0
+    while True:
+      collection_ids = list(
+        Collection.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+      if not collection_ids:
+        break
+      # one short transaction per batch, the collections of a batch are locked while they are recounted
+      drifted = recount_products(collection_ids)
+      for collection_id, count in drifted.items():
+        self.stdout.write(f'collection {collection_id}: products_count set to {count}')
+      checked += len(collection_ids)
+      repaired += len(drifted)
+      last_id = collection_ids[-1]
+
+    self.stdout.write(self.style.SUCCESS(f'Checked {checked} collections, repaired {repaired}.'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from store.outbox import OutboxWorker
+
+
+class Command(BaseCommand):
+  help = 'Delivers the outbox events (order_created...) to the signal receivers, in batches on a pool of threads.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--once', action='store_true', help='stop when the outbox is empty')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4, help='threads delivering the events of a batch')
+    parser.add_argument('--max-attempts', type=int, default=8)
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds between polls of an empty outbox')
+
+  def handle(self, *args, **options):
+    worker = OutboxWorker(
+      batch_size=options['batch_size'],
+      workers=options['workers'],
+      max_attempts=options['max_attempts'],
+    )
+    try:
+      processed = worker.run(once=options['once'], poll_interval=options['poll_interval'])
+    except KeyboardInterrupt:
+      worker.stop()
+      return
+    self.stdout.write(self.style.SUCCESS(f'Processed {processed} outbox events.'))
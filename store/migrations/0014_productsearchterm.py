@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'product'], name='store_produ_term_4f8082_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:25
+
+from django.db import migrations, models
+
+
+def backfill_cart_last_update(apps, schema_editor):
+    # AddField gave the existing carts the time of the migration, which would keep abandoned carts
+    # from expiring (store.reaper) for another STORE_CART_EXPIRY_DAYS; created_at is the best we know
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.update(last_update=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_productsearchterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_cart_last_update, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='collection',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_last_update_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        # fill the counter for the existing products, from here on it is kept up to date by the models
+        migrations.RunSQL("""
+            UPDATE store_collection
+            SET products_count = (
+                SELECT COUNT(*) FROM store_product
+                WHERE store_product.collection_id = store_collection.id
+            )
+        """, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_collection_products_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='last_update',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
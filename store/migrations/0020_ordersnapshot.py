@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderSnapshot',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='store.order')),
+                ('placed_at', models.DateTimeField()),
+                ('document', models.JSONField()),
+                ('last_update', models.DateTimeField()),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.customer')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['customer', 'placed_at', 'order'], name='store_order_custome_7f71f7_idx'), models.Index(fields=['placed_at', 'order'], name='store_order_placed__3e89c9_idx')],
+            },
+        ),
+    ]
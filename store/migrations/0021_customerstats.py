@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_ordersnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStats',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='store.customer')),
+                ('orders_count', models.PositiveIntegerField(default=0)),
+                ('items_count', models.PositiveIntegerField(default=0)),
+                ('lifetime_spend', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('first_purchase_at', models.DateTimeField(null=True)),
+                ('last_purchase_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'placed_at', 'id'], name='store_order_custome_c64870_idx'),
+        ),
+    ]
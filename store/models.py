@@ -1,8 +1,11 @@
 from django.contrib import admin
 from django.conf import settings
+from collections import Counter
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from uuid import uuid4
+from store.signals import collection_counts_changed, order_completion_changed, products_updated
 
 
 
@@ -15,14 +18,109 @@ class Collection(models.Model):
     title = models.CharField(max_length=255)
     featured_product = models.ForeignKey(
         'Product', on_delete=models.SET_NULL, null=True, related_name='+')
+    last_update = models.DateTimeField(auto_now=True)
+    products_count = models.PositiveIntegerField(default=0) # kept up to date by Product and ProductQuerySet, see adjust_products_count
 
     def __str__(self) -> str:
         # return super().__str__() # this is the default implementation of __str__ method
         return self.title
 
+    def save(self, *args, **kwargs):
+        # products_count is only written by adjust_products_count (F() updates) and recount_products: saving a
+        # collection loaded earlier must not write its count back over a change made since
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname != 'products_count' and field.attname not in deferred
+            ]
+        return super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['title']
 
+
+def adjust_products_count(deltas):
+    # deltas = {collection_id: products added (or removed when negative)}, applied with F() so concurrent
+    # changes add up; last_update moves too since the count is part of the collection's representation
+    deltas = {collection_id: delta for collection_id, delta in deltas.items() if collection_id is not None and delta}
+    now = timezone.now()
+    for collection_id in sorted(deltas): # always the same order, two transactions can't deadlock on the counters
+        Collection.objects.filter(pk=collection_id).update(
+            products_count=models.F('products_count') + deltas[collection_id], last_update=now)
+    if deltas:
+        collection_counts_changed.send(sender=Collection, collection_ids=sorted(deltas))
+
+
+class ProductQuerySet(models.QuerySet):
+    # the bulk paths never call Product.save/delete, they keep Collection.products_count in step themselves
+
+    def update(self, **kwargs):
+        # every update moves last_update (auto_now only applies to save()) for the ETags and sends
+        # products_updated for the cached responses and facets of the rows
+        kwargs.setdefault('last_update', timezone.now())
+        with transaction.atomic(using=self.db):
+            rows = list(self.select_for_update().order_by().values_list('pk', 'collection_id'))
+            updated = super().update(**kwargs)
+            collection_ids = {collection_id for _, collection_id in rows}
+            if 'collection' in kwargs or 'collection_id' in kwargs:
+                # the new value can be an expression, read back where the rows ended up
+                deltas = Counter(Product._base_manager.using(self.db).filter(pk__in=[pk for pk, _ in rows]).values_list('collection_id', flat=True))
+                collection_ids.update(deltas)
+                deltas.subtract(collection_id for _, collection_id in rows)
+                adjust_products_count(deltas)
+            if rows:
+                products_updated.send(sender=Product, product_ids=[pk for pk, _ in rows], collection_ids=sorted(collection_ids))
+        return updated
+
+    update.alters_data = True
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            rows = list(self.select_for_update().order_by().values_list('pk', 'collection_id'))
+            deleted = Product._base_manager.using(self.db).filter(pk__in=[pk for pk, _ in rows]).delete()
+            adjust_products_count({collection_id: -count for collection_id, count in Counter(collection_id for _, collection_id in rows).items()})
+        return deleted
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            if kwargs.get('ignore_conflicts') or kwargs.get('update_conflicts'):
+                # some of the rows may not have been inserted, count those collections again
+                recount_products({obj.collection_id for obj in objs})
+            else:
+                adjust_products_count(Counter(obj.collection_id for obj in objs))
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        # bulk_update runs update() (above) for every batch, which adjusts the counters
+        objs = list(objs)
+        updated = super().bulk_update(objs, fields, *args, **kwargs)
+        for obj in objs:
+            obj._loaded_collection_id = obj.collection_id
+        return updated
+
+
+def recount_products(collection_ids):
+    # sets the counters of these collections from the products table (the reconcile command repairs drift
+    # with it), the collection rows are locked first so a concurrent adjust_products_count waits for us
+    collection_ids = sorted(collection_id for collection_id in collection_ids if collection_id is not None)
+    with transaction.atomic():
+        stored = dict(Collection.objects.select_for_update().filter(pk__in=collection_ids).order_by('pk').values_list('pk', 'products_count'))
+        actual = dict(Product.objects.filter(collection_id__in=stored).order_by().values('collection_id')
+            .annotate(count=models.Count('pk')).values_list('collection_id', 'count'))
+        drifted = {pk: actual.get(pk, 0) for pk, count in stored.items() if actual.get(pk, 0) != count}
+        now = timezone.now()
+        for pk, count in drifted.items():
+            Collection.objects.filter(pk=pk).update(products_count=count, last_update=now)
+        if drifted:
+            collection_counts_changed.send(sender=Collection, collection_ids=sorted(drifted))
+    return drifted
+
 class Product(models.Model):
     title = models.CharField(max_length=255)
     slug = models.SlugField()
@@ -33,11 +131,60 @@ class Product(models.Model):
     collection = models.ForeignKey(Collection, on_delete=models.PROTECT, related_name='products')
     promotions = models.ManyToManyField(Promotion, blank=True)
 
+    objects = ProductQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.title
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'collection' not in update_fields and 'collection_id' not in update_fields:
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic(using=kwargs.get('using')):
+            if not self._state.adding and self.__dict__.get('_loaded_collection_id') is not None:
+                previous = self._loaded_collection_id
+            elif self.pk is None:
+                previous = None
+            else: # not loaded with its collection (e.g. only() or a Product(pk=...) built by hand)
+                previous = Product._base_manager.filter(pk=self.pk).values_list('collection_id', flat=True).first()
+            super().save(*args, **kwargs)
+            if previous != self.collection_id:
+                adjust_products_count({previous: -1, self.collection_id: 1})
+        self._loaded_collection_id = self.collection_id
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            result = super().delete(*args, **kwargs)
+            adjust_products_count({self.collection_id: -1})
+        return result
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        # the collection the row had when it was loaded, to tell when a product is moved to another one
+        product._loaded_collection_id = product.__dict__.get('collection_id')
+        return product
+
     class Meta:
         ordering = ['title']
+        indexes = [ # one index per ordering the product list supports, with id as tie-breaker for keyset pagination
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['unit_price', 'id']),
+            models.Index(fields=['last_update', 'id']),
+        ]
+
+
+class ProductSearchTerm(models.Model):
+    # inverted index over Product.title and Product.description, maintained by store.search
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=64)
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'product']),
+        ]
 
 
 class Customer(models.Model):
@@ -91,11 +238,41 @@ class Order(models.Model):
     payment_status = models.CharField(
         max_length=1, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_STATUS_PENDING)
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
+    last_update = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        # an order entering or leaving PAYMENT_STATUS_COMPLETE moves the sales rollups (store.rollups),
+        # in the same transaction; queryset.update(payment_status=...) doesn't (manage.py rebuild_sales_rollups)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'payment_status' not in update_fields:
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            if self._state.adding:
+                previous = None
+            elif 'payment_status' in self.__dict__ and '_loaded_payment_status' in self.__dict__:
+                previous = self._loaded_payment_status
+            else: # not loaded with its payment status (e.g. only() or an Order(pk=...) built by hand)
+                previous = Order._base_manager.filter(pk=self.pk).values_list('payment_status', flat=True).first()
+            super().save(*args, **kwargs)
+            completed = self.payment_status == self.PAYMENT_STATUS_COMPLETE
+            if completed != (previous == self.PAYMENT_STATUS_COMPLETE):
+                order_completion_changed.send(sender=Order, order=self, completed=completed)
+        self._loaded_payment_status = self.payment_status
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super().from_db(db, field_names, values)
+        order._loaded_payment_status = order.__dict__.get('payment_status')
+        return order
 
     class Meta:
         permissions = [
             ('cancel_order', 'Can cancel order') # is is custom permission
         ]
+        indexes = [
+            models.Index(fields=['customer', 'placed_at', 'id']), # the orders of a customer, newest first (history)
+        ]
 
 
 class OrderItem(models.Model):
@@ -115,6 +292,7 @@ class Address(models.Model):
 class Cart(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4) # creating id manually so its hard for hackers to guess the id (by default it would be like 1, 2, 3)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_update = models.DateTimeField(auto_now=True, db_index=True) # also touched whenever an item is added, changed or removed; expired carts are reaped by store.reaper
 
 
 class CartItem(models.Model):
@@ -127,6 +305,18 @@ class CartItem(models.Model):
     class Meta:
         unique_together = [['cart', 'product']] # this is to ensure that each product can only be added once to a cart
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.touch_cart()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.touch_cart()
+        return result
+
+    def touch_cart(self):
+        Cart.objects.filter(pk=self.cart_id).update(last_update=timezone.now())
+
 
 class Review(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reviews')
@@ -140,4 +330,110 @@ class Review(models.Model):
 # for creating a model there are 3 steps:
 # 1. create the model class
 # 2. create the migration file
-# 3. run the migration
\ No newline at end of file
+# 3. run the migration
+
+class IdempotencyKey(models.Model):
+    # the response of a POST/PATCH/DELETE sent with an Idempotency-Key header, replayed to retries of it (store.idempotency)
+    scope = models.CharField(max_length=64) # sha256 of the user, method and path the key was used with
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64) # sha256 of the request body
+    status_code = models.PositiveSmallIntegerField(null=True) # null until the response is stored
+    response = models.TextField(blank=True) # json
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = [['scope', 'key']]
+
+
+class OutboxEvent(models.Model):
+    # a signal to send after the transaction that wrote it commits, delivered by store.outbox.OutboxWorker
+    event = models.CharField(max_length=64) # a name in store.outbox.EVENTS
+    sender = models.CharField(max_length=255) # dotted path of the sender
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField() # the next attempt, pushed back while a worker holds it and after failures
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    failed_at = models.DateTimeField(null=True) # gave up after the last attempt
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed_at', 'available_at']),
+        ]
+
+
+class OrderSnapshot(models.Model):
+    # the order as OrderSerializer rendered it at checkout (store.snapshots), read without joining the items and products
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, primary_key=True, related_name='snapshot')
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='+')
+    placed_at = models.DateTimeField()
+    document = models.JSONField()
+    last_update = models.DateTimeField() # Order.last_update when the document was written
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', 'placed_at', 'order']), # the orders of a customer, newest first
+            models.Index(fields=['placed_at', 'order']),
+        ]
+
+
+class CustomerStats(models.Model):
+    # lifetime aggregates of the orders of a customer, added to as orders are placed (store.history)
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    orders_count = models.PositiveIntegerField(default=0)
+    items_count = models.PositiveIntegerField(default=0) # units
+    lifetime_spend = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    first_purchase_at = models.DateTimeField(null=True)
+    last_purchase_at = models.DateTimeField(null=True)
+
+
+class DailyProductSales(models.Model):
+    # the completed orders (payment_status C) of a product by the day they were placed, store.rollups
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    orders_count = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['day', 'product']]
+        indexes = [
+            models.Index(fields=['product', 'day']),
+        ]
+
+
+class DailyCollectionSales(models.Model):
+    # the same for the collection the products were in when the order completed
+    day = models.DateField()
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='+')
+    orders_count = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['day', 'collection']]
+        indexes = [
+            models.Index(fields=['collection', 'day']),
+        ]
+
+
+class ProductRecommendation(models.Model):
+    # the top products bought together with a product, best first (store.recommendations)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField() # 0 is the best
+    score = models.PositiveIntegerField() # orders with both products
+
+    class Meta:
+        unique_together = [['product', 'rank']]
+
+
+class RecommendationBuild(models.Model):
+    # a run of store.recommendations.RecommendationBuilder, the last one tells the next where to start
+    full = models.BooleanField()
+    last_order_id = models.BigIntegerField() # the orders up to this id are counted
+    orders_count = models.PositiveIntegerField(default=0)
+    products_count = models.PositiveIntegerField(default=0) # products whose recommendations were written
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,181 @@
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from store.models import Order, OutboxEvent
+from store.signals import order_created
+
+logger = logging.getLogger(__name__)
+
+
+class Skip(Exception):
+  # the object of the event is gone, there is nothing to deliver
+  pass
+
+
+def load_order(payload):
+  order = Order.objects.filter(pk=payload['order_id']).first()
+  if order is None:
+    raise Skip()
+  return {'order': order}
+
+
+# name -> (signal, function turning the stored payload back into the keyword arguments of the signal)
+EVENTS = {
+  'order_created': (order_created, load_order),
+}
+
+_wakeup = threading.Event() # set after a commit that published events, for a worker in this process
+
+
+def publish(event, sender, **payload):
+  # writes the event in the current transaction: it is delivered only if the transaction commits, and
+  # then even if this process dies before delivering it. The payload must be json (ids, not objects)
+  if event not in EVENTS:
+    raise ValueError('unknown outbox event %r' % event)
+  OutboxEvent.objects.create(
+    event=event,
+    sender='%s.%s' % (sender.__module__, sender.__qualname__),
+    payload=payload,
+    available_at=timezone.now(),
+  )
+  transaction.on_commit(_wakeup.set)
+  if delivers_inline():
+    transaction.on_commit(deliver_pending)
+
+
+def delivers_inline():
+  # without a worker thread (STORE_OUTBOX_WORKER) the events are delivered right after the commit that
+  # published them, unless manage.py run_outbox_worker delivers them (STORE_OUTBOX_INLINE = False)
+  return not getattr(settings, 'STORE_OUTBOX_WORKER', False) and getattr(settings, 'STORE_OUTBOX_INLINE', True)
+
+
+def deliver_pending():
+  # one batch of the due events (this commit's and the retries) in the thread of the request, which
+  # already committed: an error is logged, the events stay in the outbox for the next commit
+  try:
+    OutboxWorker().process_batch()
+  except Exception:
+    logger.exception('outbox delivery failed')
+
+
+class OutboxWorker:
+  # delivers the events to the receivers of their signal, a batch at a time on a pool of threads.
+  # Delivery is at least once: an event is deleted once every receiver ran without raising, otherwise all
+  # its receivers get it again after a backoff (retry_delay * 2 ** attempts, up to max_retry_delay) and
+  # after max_attempts it is left in the table with failed_at set. A batch is leased for lease seconds,
+  # workers in other processes skip it meanwhile.
+
+  def __init__(self, batch_size=100, workers=4, max_attempts=8, retry_delay=2, max_retry_delay=60 * 60, lease=5 * 60):
+    self.batch_size = batch_size
+    self.workers = workers
+    self.max_attempts = max_attempts
+    self.retry_delay = retry_delay
+    self.max_retry_delay = max_retry_delay
+    self.lease = lease
+    self._stopped = threading.Event()
+
+  def claim(self):
+    now = timezone.now()
+    with transaction.atomic():
+      events = list(
+        OutboxEvent.objects
+          .filter(failed_at__isnull=True, available_at__lte=now)
+          .order_by('available_at', 'pk')
+          .select_for_update(skip_locked=True)[:self.batch_size])
+      if events:
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(available_at=now + timedelta(seconds=self.lease))
+    return events
+
+  def deliver(self, event):
+    try:
+      return self.send(event)
+    finally:
+      close_old_connections() # the pool's threads each have their own connection
+
+  def send(self, event):
+    # returns None when delivered, or the error
+    try:
+      signal, load = EVENTS[event.event]
+      try:
+        kwargs = load(event.payload)
+      except Skip:
+        return None
+      errors = [
+        ''.join(traceback.format_exception(type(response), response, response.__traceback__))
+        for receiver, response in signal.send_robust(import_string(event.sender), **kwargs)
+        if isinstance(response, Exception)
+      ]
+      return '\n'.join(errors) or None
+    except Exception:
+      return traceback.format_exc()
+
+  def process_batch(self, executor=None):
+    # on the executor's threads, or one event after the other in this thread without one
+    events = self.claim()
+    if not events:
+      return 0
+    errors = list(executor.map(self.deliver, events) if executor else map(self.send, events))
+
+    now = timezone.now()
+    delivered = [event.pk for event, error in zip(events, errors) if error is None]
+    OutboxEvent.objects.filter(pk__in=delivered).delete()
+    for event, error in zip(events, errors):
+      if error is None:
+        continue
+      event.attempts += 1
+      event.last_error = error
+      if event.attempts >= self.max_attempts:
+        event.failed_at = now
+        logger.error('outbox event %s (%s) failed %d times, giving up', event.pk, event.event, event.attempts)
+      else:
+        event.available_at = now + timedelta(seconds=min(self.retry_delay * 2 ** event.attempts, self.max_retry_delay))
+      event.save(update_fields=['attempts', 'last_error', 'failed_at', 'available_at'])
+    return len(events)
+
+  def run(self, once=False, poll_interval=1.0):
+    # delivers until the outbox is empty (once) or until stop(); wakes up after every poll_interval
+    # seconds or right after a commit that published events in this process
+    processed = 0
+    with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox') as executor:
+      while not self._stopped.is_set():
+        _wakeup.clear()
+        count = self.process_batch(executor)
+        processed += count
+        if count:
+          continue
+        if once:
+          break
+        _wakeup.wait(poll_interval)
+    return processed
+
+  def stop(self):
+    self._stopped.set()
+    _wakeup.set()
+
+
+def start_outbox_worker():
+  # STORE_OUTBOX_WORKER: deliver the events from a daemon thread of this process, e.g. with runserver
+  if not getattr(settings, 'STORE_OUTBOX_WORKER', False):
+    return None
+  worker = OutboxWorker()
+
+  def run():
+    while True:
+      try:
+        worker.run()
+        return
+      except Exception: # e.g. the database is away, start over
+        logger.exception('outbox worker failed')
+        connection.close()
+        worker._stopped.wait(5)
+
+  threading.Thread(target=run, name='outbox-worker', daemon=True).start()
+  return worker
@@ -1,4 +1,177 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 class DefaultPagination(PageNumberPagination):
-  page_size = 10
\ No newline at end of file
+  page_size = 10
+
+
+class KeysetPagination(CursorPagination):
+  # unlike PageNumberPagination this never runs COUNT(*) or OFFSET, every page is a
+  # "WHERE (ordering, pk) > (last seen values) ORDER BY ordering, pk LIMIT n" range scan
+  # so page 5000 costs the same as page 1 (as long as (ordering, pk) is indexed)
+  page_size = 10
+  ordering = 'title'
+  count_query_param = 'include_count'
+  count_cache_timeout = 60 # the total is approximate, it can be off by whatever changed in the last minute
+
+  def paginate_queryset(self, queryset, request, view=None):
+    self.request = request
+    self.page_size = self.get_page_size(request)
+    if not self.page_size:
+      return None
+
+    self.base_url = request.build_absolute_uri()
+    self.ordering = self.get_keyset_ordering(request, queryset, view)
+    self.fields = [self.get_ordering_field(queryset.model, name) for name in self.ordering]
+
+    self.position, self.reverse = self.decode_cursor(request)
+
+    self.count = None
+    if request.query_params.get(self.count_query_param) in ('1', 'true'):
+      self.count = self.get_approximate_count(queryset)
+
+    field_names, defer = queryset.query.deferred_loading
+    if queryset._fields is not None:
+      # same for values() rows (store.compiled), the cursor reads the ordering columns from them
+      missing = [field.attname for field in self.fields if field.attname not in queryset._fields]
+      if missing:
+        queryset = queryset.values(*queryset._fields, *missing)
+    elif field_names and not defer:
+      # the cursor is built from the ordering columns, never leave them out with only()
+      queryset = queryset.only(*field_names, *[field.name for field in self.fields])
+
+    ordering = self.ordering
+    if self.reverse:
+      ordering = tuple(name[1:] if name.startswith('-') else '-' + name for name in ordering)
+    queryset = queryset.order_by(*ordering)
+    if self.position is not None:
+      queryset = queryset.filter(self.get_keyset_filter(ordering, self.position))
+
+    # fetch one extra row to find out if there is a following page without counting
+    results = list(queryset[:self.page_size + 1])
+    has_following = len(results) > self.page_size
+    self.page = results[:self.page_size]
+    if self.reverse:
+      self.page.reverse()
+
+    if self.reverse:
+      self.has_next = self.position is not None
+      self.has_previous = has_following
+    else:
+      self.has_next = has_following
+      self.has_previous = self.position is not None
+
+    return self.page
+
+  def get_keyset_ordering(self, request, queryset, view):
+    ordering = list(self.get_ordering(request, queryset, view))
+    pk_name = queryset.model._meta.pk.name
+    if not any(name.lstrip('-') in ('pk', pk_name) for name in ordering):
+      # the pk breaks ties between equal prices/titles so the cursor position is always unique
+      ordering.append('-' + pk_name if ordering[0].startswith('-') else pk_name)
+    return tuple(ordering)
+
+  def get_ordering_field(self, model, name):
+    name = name.lstrip('-')
+    if name == 'pk':
+      return model._meta.pk
+    return model._meta.get_field(name)
+
+  def get_keyset_filter(self, ordering, position):
+    # (a, b) > (x, y)  ==  a > x OR (a = x AND b > y); the leading a >= x lets the index range scan start at x
+    first = ordering[0]
+    keyset = Q(**{'%s__%s' % (first.lstrip('-'), 'lte' if first.startswith('-') else 'gte'): position[0]})
+    condition = Q()
+    equal = {}
+    for name, value in zip(ordering, position):
+      field_name = name.lstrip('-')
+      lookup = 'lt' if name.startswith('-') else 'gt'
+      condition |= Q(**equal, **{'%s__%s' % (field_name, lookup): value})
+      equal[field_name] = value
+    return keyset & condition
+
+  def get_approximate_count(self, queryset):
+    queryset = queryset.order_by()
+    key = 'store:count:' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+    return cache.get_or_set(key, queryset.count, self.count_cache_timeout)
+
+  def decode_cursor(self, request):
+    encoded = request.query_params.get(self.cursor_query_param)
+    if not encoded:
+      return None, False
+
+    try:
+      payload = json.loads(urlsafe_b64decode(encoded.encode('ascii') + b'=' * (-len(encoded) % 4)))
+      if payload['o'] != list(self.ordering) or len(payload['p']) != len(self.fields):
+        # a cursor only makes sense for the ordering it was created with
+        raise ValueError
+      position = [field.to_python(value) for field, value in zip(self.fields, payload['p'])]
+      reverse = bool(payload.get('r'))
+    except (TypeError, ValueError, KeyError, AttributeError, ValidationError):
+      raise NotFound(self.invalid_cursor_message)
+
+    return position, reverse
+
+  def encode_cursor(self, position, reverse):
+    position = [value.isoformat() if hasattr(value, 'isoformat') else str(value) for value in position]
+    payload = {'o': list(self.ordering), 'p': position}
+    if reverse:
+      payload['r'] = 1
+    encoded = urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode('ascii').rstrip('=')
+    return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+  def get_position(self, instance):
+    if isinstance(instance, dict):
+      return [instance[field.attname] for field in self.fields]
+    return [getattr(instance, field.attname) for field in self.fields]
+
+  def get_next_link(self):
+    if not self.has_next:
+      return None
+    if not self.page:
+      return self.encode_cursor(self.position, reverse=False)
+    return self.encode_cursor(self.get_position(self.page[-1]), reverse=False)
+
+  def get_previous_link(self):
+    if not self.has_previous:
+      return None
+    if not self.page:
+      return self.encode_cursor(self.position, reverse=True)
+    return self.encode_cursor(self.get_position(self.page[0]), reverse=True)
+
+  def get_paginated_response(self, data):
+    response = {
+      'next': self.get_next_link(),
+      'previous': self.get_previous_link(),
+      'results': data,
+    }
+    if self.count is not None:
+      response['count'] = self.count
+    return Response(response)
+
+
+class OrderKeysetPagination(KeysetPagination):
+  ordering = '-placed_at' # newest first, ties broken by -id
+
+
+class KeysetSwitchMixin:
+  # paginates with pagination_class, or with keyset_pagination_class when the client asks for ?cursor=
+  keyset_pagination_class = KeysetPagination
+
+  @property
+  def paginator(self):
+    if not hasattr(self, '_paginator'):
+      if self.keyset_pagination_class.cursor_query_param in self.request.query_params:
+        self._paginator = self.keyset_pagination_class()
+      else:
+        self._paginator = self.pagination_class()
+    return self._paginator
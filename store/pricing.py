@@ -0,0 +1,122 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Least, Round
+
+from store.models import CartItem, OrderItem, Product
+
+# all prices are rounded half up to the cent, discounts are promotion fractions (0.15 = 15% off)
+# kept to 4 decimal places so float noise from Promotion.discount never leaks into a price
+CENT = Decimal('0.01')
+DISCOUNT_PLACES = Decimal('0.0001')
+TAX_RATE = Decimal(getattr(settings, 'STORE_TAX_RATE', '0.1'))
+TAX_MULTIPLIER = 1 + TAX_RATE
+
+
+def best_discount(product_ref='pk'):
+  # a product with several promotions gets the biggest one, promotions don't stack
+  return Subquery(
+    Product.promotions.through.objects
+      .filter(product_id=OuterRef(product_ref))
+      .order_by('-promotion__discount')
+      .values('promotion__discount')[:1]
+  )
+
+
+def with_discounts(queryset, product_ref='pk'):
+  # one correlated subquery in the same SELECT instead of a query (or a python loop) per product
+  return queryset.annotate(best_discount=best_discount(product_ref))
+
+
+def to_discount(value):
+  if not value:
+    return Decimal(0)
+  discount = Decimal(str(value)).quantize(DISCOUNT_PLACES, ROUND_HALF_UP)
+  return min(max(discount, Decimal(0)), Decimal(1))
+
+
+def get_discount(product):
+  if hasattr(product, 'best_discount'):
+    return to_discount(product.best_discount)
+  # not loaded through with_discounts (e.g. a product that was just saved)
+  return to_discount(max((promotion.discount for promotion in product.promotions.all()), default=0))
+
+
+def sale_price(unit_price, discount):
+  if not discount:
+    return unit_price.quantize(CENT, ROUND_HALF_UP)
+  return (unit_price * (1 - discount)).quantize(CENT, ROUND_HALF_UP)
+
+
+def price_with_tax(unit_price, discount):
+  return (sale_price(unit_price, discount) * TAX_MULTIPLIER).quantize(CENT, ROUND_HALF_UP)
+
+
+def line_total(quantity, unit_price, discount):
+  return quantity * sale_price(unit_price, discount)
+
+
+def product_sale_price(product):
+  return sale_price(product.unit_price, get_discount(product))
+
+
+def product_price_with_tax(product):
+  return price_with_tax(product.unit_price, get_discount(product))
+
+
+# the same prices computed by the database, for totals that shouldn't load every item and product.
+# ROUND on DECIMAL is half up for prices on MySQL and PostgreSQL, like the functions above
+# (SQLite calculates in floating point, fine for development)
+PRICE = DecimalField(max_digits=12, decimal_places=2)
+
+
+def discount_expression(discount):
+  # to_discount(): no promotion is 0, 4 decimal places, within 0..1
+  discount = Round(Cast(Coalesce(discount, Value(0.0)), DecimalField(max_digits=10, decimal_places=6)), 4)
+  return Least(Greatest(discount, Value(Decimal(0))), Value(Decimal(1)))
+
+
+def sale_price_expression(unit_price, discount):
+  return Round(F(unit_price) * (Value(Decimal(1)) - discount_expression(discount)), 2, output_field=PRICE)
+
+
+def line_total_expression(quantity='quantity', sale_price='sale_price'):
+  return ExpressionWrapper(F(quantity) * F(sale_price), output_field=PRICE)
+
+
+def with_line_totals(cart_items):
+  # sale_price and line_total (quantity * sale_price) of every cart item
+  return cart_items \
+    .annotate(sale_price=sale_price_expression('product__unit_price', best_discount('product_id'))) \
+    .annotate(line_total=line_total_expression())
+
+
+def cart_total(cart_ref='pk'):
+  # the sum of the line totals of a cart, as a subquery to annotate carts with
+  totals = with_line_totals(CartItem.objects.filter(cart_id=OuterRef(cart_ref))) \
+    .order_by() \
+    .values('cart_id') \
+    .annotate(total=Sum('line_total')) \
+    .values('total')
+  return Coalesce(Subquery(totals), Value(Decimal('0.00')), output_field=PRICE)
+
+
+def cart_summary(carts):
+  # number of items, units and total of each cart in one aggregate over a left join of the items
+  line_total = F('items__quantity') * sale_price_expression('items__product__unit_price', best_discount('items__product_id'))
+  return carts.annotate(
+    items_count=Count('items'),
+    quantity=Coalesce(Sum('items__quantity'), 0),
+    total_price=Coalesce(Sum(line_total, output_field=PRICE), Value(Decimal('0.00')), output_field=PRICE),
+  )
+
+
+def order_total(order_ref='pk'):
+  # the sum of quantity * unit_price (the price paid) of the items of an order, to annotate orders with
+  totals = OrderItem.objects.filter(order_id=OuterRef(order_ref)) \
+    .order_by() \
+    .values('order_id') \
+    .annotate(total=Sum(line_total_expression(sale_price='unit_price'))) \
+    .values('total')
+  return Coalesce(Subquery(totals), Value(Decimal('0.00')), output_field=PRICE)
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from store.models import Cart, CartItem
+
+logger = logging.getLogger(__name__)
+
+
+def get_cutoff(now=None):
+  # a cart expires when nothing touched it (Cart.last_update, see CartItem.touch_cart) for STORE_CART_EXPIRY_DAYS
+  days = getattr(settings, 'STORE_CART_EXPIRY_DAYS', 30)
+  return (now or timezone.now()) - timedelta(days=days)
+
+
+class CartReaper:
+  # deletes expired carts and their items in chunks of chunk_size carts, one short transaction per
+  # chunk, oldest first through the last_update index, so no transaction holds many locks for long.
+  # A cart touched again after it was picked for a chunk is left alone.
+
+  def __init__(self, chunk_size=500, pause=0):
+    self.chunk_size = chunk_size
+    self.pause = pause # seconds between chunks, to leave room for the requests
+    self.runs = 0
+    self.carts_reaped = 0
+    self.items_reaped = 0
+    self.last_run = None
+    self._lock = threading.Lock()
+    self._run_lock = threading.Lock()
+
+  def expired(self, cutoff):
+    return Cart.objects.filter(last_update__lt=cutoff)
+
+  def run(self, dry_run=False, now=None):
+    # returns the report of this run: {'carts', 'items', 'chunks', 'cutoff', 'seconds', 'dry_run'}
+    cutoff = get_cutoff(now)
+    started = time.monotonic()
+    with self._run_lock: # one run at a time per process
+      if dry_run:
+        carts = self.expired(cutoff).count()
+        items = CartItem.objects.filter(cart__last_update__lt=cutoff).count()
+        chunks = -(-carts // self.chunk_size)
+      else:
+        carts, items, chunks = self.reap(cutoff)
+
+    report = {
+      'carts': carts,
+      'items': items,
+      'chunks': chunks,
+      'cutoff': cutoff,
+      'seconds': round(time.monotonic() - started, 3),
+      'dry_run': dry_run,
+    }
+    if not dry_run:
+      with self._lock:
+        self.runs += 1
+        self.carts_reaped += carts
+        self.items_reaped += items
+        self.last_run = report
+    return report
+
+  def reap(self, cutoff):
+    carts = items = chunks = 0
+    after = None # (last_update, pk) of the last cart of the previous chunk
+    while True:
+      queryset = self.expired(cutoff)
+      if after is not None:
+        queryset = queryset.filter(Q(last_update__gt=after[0]) | Q(last_update=after[0], pk__gt=after[1]))
+      chunk = list(queryset.order_by('last_update', 'pk').values_list('last_update', 'pk')[:self.chunk_size])
+      if not chunk:
+        break
+      after = chunk[-1]
+      with transaction.atomic():
+        # carts locked right now are in use, they are skipped; last_update is checked again under the lock
+        cart_ids = list(
+          self.expired(cutoff).filter(pk__in=[pk for last_update, pk in chunk])
+            .select_for_update(skip_locked=True).values_list('pk', flat=True))
+        _, counts = Cart.objects.filter(pk__in=cart_ids).delete()
+      carts += counts.get(Cart._meta.label, 0)
+      items += counts.get(CartItem._meta.label, 0)
+      chunks += 1
+      if len(chunk) < self.chunk_size:
+        break
+      if self.pause:
+        time.sleep(self.pause)
+    return carts, items, chunks
+
+  def stats(self):
+    with self._lock:
+      return {
+        'runs': self.runs,
+        'carts_reaped': self.carts_reaped,
+        'items_reaped': self.items_reaped,
+        'last_run': self.last_run,
+      }
+
+
+cart_reaper = CartReaper(
+  chunk_size=getattr(settings, 'STORE_CART_REAPER_CHUNK_SIZE', 500),
+  pause=getattr(settings, 'STORE_CART_REAPER_PAUSE', 0),
+)
+
+
+class ReaperSchedule:
+  # runs cart_reaper every interval seconds in a daemon thread of this process (STORE_CART_REAPER_INTERVAL).
+  # Several processes can run it at the same time, a chunk only deletes carts the others haven't locked.
+
+  def __init__(self, reaper, interval):
+    self.reaper = reaper
+    self.interval = interval
+    self._timer = None
+    self._stopped = threading.Event()
+
+  def start(self):
+    self._stopped.clear()
+    self.schedule()
+
+  def stop(self):
+    self._stopped.set()
+    if self._timer is not None:
+      self._timer.cancel()
+
+  def schedule(self):
+    if self._stopped.is_set():
+      return
+    self._timer = threading.Timer(self.interval, self.tick)
+    self._timer.daemon = True
+    self._timer.start()
+
+  def tick(self):
+    try:
+      report = self.reaper.run()
+      logger.info('reaped %(carts)d carts and %(items)d cart items in %(seconds)ss', report)
+    except Exception: # e.g. the database is away, the next tick tries again
+      logger.exception('cart reaper run failed')
+    finally:
+      connection.close() # the thread's own connection, don't keep it open between runs
+      self.schedule()
+
+
+def start_reaper_schedule():
+  interval = getattr(settings, 'STORE_CART_REAPER_INTERVAL', None)
+  if not interval:
+    return None
+  schedule = ReaperSchedule(cart_reaper, interval)
+  schedule.start()
+  return schedule
@@ -0,0 +1,124 @@
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from store.models import Order, OrderItem, ProductRecommendation, RecommendationBuild
+
+# "frequently bought together": the score of a pair of products is the number of orders that have both.
+# The pairs are counted with numpy over the (order, product) rows of the items, never with a self join
+# of store_orderitem, and only the best top_k pairs of every product are stored
+
+
+def empty():
+  return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+
+def merge(first, second, counts):
+  # the same pairs added up, sorted by (first, second)
+  if not len(first):
+    return empty()
+  base = int(max(first.max(), second.max())) + 1
+  keys, inverse = np.unique(first * base + second, return_inverse=True)
+  return keys // base, keys % base, np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+
+
+def pair_counts(order_ids, product_ids):
+  # (first, second, counts) of every ordered pair of distinct products that share orders, from the
+  # (order, product) rows of the items in any order
+  if not len(order_ids):
+    return empty()
+  items = np.unique(np.stack([order_ids, product_ids], axis=1), axis=0) # by order, a product once per order
+  orders, products = items[:, 0], items[:, 1]
+  starts = np.flatnonzero(np.r_[True, orders[1:] != orders[:-1]])
+  sizes = np.diff(np.r_[starts, len(orders)])
+
+  # every item is paired with every item of its order, n * n pairs for an order of n products
+  repeats = np.repeat(sizes, sizes)
+  firsts = np.repeat(starts, sizes)
+  left = np.repeat(np.arange(len(orders)), repeats)
+  right = np.repeat(firsts, repeats) + np.arange(len(left)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+  keep = left != right
+  return merge(products[left[keep]], products[right[keep]], np.ones(int(keep.sum()), dtype=np.int64))
+
+
+def top_k(first, second, counts, k):
+  # the k pairs with the biggest counts of every first product (ties go to the smaller id) and their ranks
+  if not len(first):
+    return (*empty(), np.empty(0, dtype=np.int64))
+  order = np.lexsort((second, -counts, first))
+  first, second, counts = first[order], second[order], counts[order]
+  starts = np.flatnonzero(np.r_[True, first[1:] != first[:-1]])
+  ranks = np.arange(len(first)) - np.repeat(starts, np.diff(np.r_[starts, len(first)]))
+  keep = ranks < k
+  return first[keep], second[keep], counts[keep], ranks[keep]
+
+
+class RecommendationBuilder:
+  # a full build counts every order again, chunk_size orders at a time. An incremental one counts the
+  # orders placed since the last build (RecommendationBuild.last_order_id) and adds them to the stored
+  # scores of the products they touch: a pair that had fallen out of the top_k starts over from the new
+  # orders, so the scores run a little under the exact ones until the next full build. Orders whose
+  # payment failed aren't counted.
+
+  def __init__(self, top_k=None, chunk_size=5000):
+    self.top_k = top_k or getattr(settings, 'STORE_RECOMMENDATIONS_TOP_K', 10)
+    self.chunk_size = chunk_size
+
+  def orders(self):
+    return Order.objects.exclude(payment_status=Order.PAYMENT_STATUS_FAILED)
+
+  def count(self, after, upto):
+    # the pair counts of the orders after..upto and how many orders there were
+    pairs = empty()
+    orders_count = 0
+    while True:
+      ids = list(self.orders().filter(pk__gt=after, pk__lte=upto).order_by('pk').values_list('pk', flat=True)[:self.chunk_size])
+      if not ids:
+        return pairs, orders_count
+      after = ids[-1]
+      orders_count += len(ids)
+      rows = np.array(
+        OrderItem.objects
+          .filter(order_id__gte=ids[0], order_id__lte=ids[-1])
+          .exclude(order__payment_status=Order.PAYMENT_STATUS_FAILED)
+          .values_list('order_id', 'product_id'),
+        dtype=np.int64).reshape(-1, 2)
+      chunk = pair_counts(rows[:, 0], rows[:, 1])
+      pairs = merge(*[np.concatenate(arrays) for arrays in zip(pairs, chunk)])
+
+  def stored(self, product_ids):
+    rows = np.array(
+      ProductRecommendation.objects.filter(product_id__in=product_ids).values_list('product_id', 'recommended_id', 'score'),
+      dtype=np.int64).reshape(-1, 3)
+    return rows[:, 0], rows[:, 1], rows[:, 2]
+
+  def build(self, full=False):
+    # returns the RecommendationBuild of this run
+    started_at = timezone.now()
+    last = RecommendationBuild.objects.order_by('-pk').first()
+    full = full or last is None
+    after = 0 if full else last.last_order_id
+    upto = Order.objects.aggregate(last=Max('pk'))['last'] or 0
+
+    pairs, orders_count = self.count(after, upto)
+    products = np.unique(pairs[0]).tolist()
+    if not full and products:
+      pairs = merge(*[np.concatenate(arrays) for arrays in zip(pairs, self.stored(products))])
+    first, second, counts, ranks = top_k(*pairs, self.top_k)
+
+    with transaction.atomic():
+      stale = ProductRecommendation.objects.all() if full else ProductRecommendation.objects.filter(product_id__in=products)
+      stale.delete()
+      ProductRecommendation.objects.bulk_create([
+        ProductRecommendation(product_id=product_id, recommended_id=recommended_id, score=score, rank=rank)
+        for product_id, recommended_id, score, rank in zip(first.tolist(), second.tolist(), counts.tolist(), ranks.tolist())
+      ], batch_size=1000)
+      return RecommendationBuild.objects.create(
+        full=full,
+        last_order_id=max(upto, after),
+        orders_count=orders_count,
+        products_count=len(products),
+        started_at=started_at,
+      )
@@ -0,0 +1,106 @@
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from store.db import upsert_increment
+from store.models import DailyCollectionSales, DailyProductSales, Order, OrderItem
+from store.pricing import line_total_expression
+
+# sales of the completed orders (payment_status C) by the day they were placed, in the current time zone, per
+# product and per collection: reports read a few rows per day instead of summing store_orderitem
+COUNTERS = ['orders_count', 'units', 'revenue']
+
+
+def add_order(order, sign=1):
+  # adds the items of an order that just completed to its day, sign=-1 takes them out again (store.signals.handlers)
+  products = {}
+  collections = {}
+  items = OrderItem.objects.filter(order_id=order.pk).values_list('product_id', 'product__collection_id', 'quantity', 'unit_price')
+  for product_id, collection_id, quantity, unit_price in items:
+    for totals, key in ((products, product_id), (collections, collection_id)):
+      units, revenue = totals.get(key, (0, Decimal('0.00')))
+      totals[key] = (units + quantity, revenue + quantity * unit_price)
+
+  day = timezone.localdate(order.placed_at)
+  for model, name, totals in ((DailyProductSales, 'product', products), (DailyCollectionSales, 'collection', collections)):
+    rows = [
+      {'day': day, name + '_id': key, 'orders_count': sign, 'units': sign * units, 'revenue': sign * revenue}
+      for key, (units, revenue) in sorted(totals.items())
+    ]
+    upsert_increment(model, rows, ['day', name], COUNTERS)
+
+
+def day_start(day):
+  return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def rebuild_days(first, last):
+  # the rollups of the days first..last (inclusive) from the order items, in the caller's transaction
+  DailyProductSales.objects.filter(day__range=(first, last)).delete()
+  DailyCollectionSales.objects.filter(day__range=(first, last)).delete()
+  items = OrderItem.objects \
+    .filter(
+      order__payment_status=Order.PAYMENT_STATUS_COMPLETE,
+      order__placed_at__gte=day_start(first),
+      order__placed_at__lt=day_start(last + timedelta(days=1))) \
+    .annotate(day=TruncDate('order__placed_at')) \
+    .order_by()
+  for model, attname, lookup in ((DailyProductSales, 'product_id', 'product_id'), (DailyCollectionSales, 'collection_id', 'product__collection_id')):
+    rows = items.values('day', lookup).annotate(
+      orders_count=Count('order_id', distinct=True),
+      units=Sum('quantity'),
+      revenue=Sum(line_total_expression('quantity', 'unit_price')),
+    )
+    model.objects.bulk_create([
+      model(day=row['day'], **{attname: row[lookup]}, **{counter: row[counter] for counter in COUNTERS})
+      for row in rows
+    ], batch_size=1000)
+
+
+def rebuild(first, last, chunk_days=7):
+  # rebuild_days over first..last, chunk_days at a time in short transactions; returns how many chunks.
+  # An order completing while its day is rebuilt can be counted twice or missed, run it off peak
+  chunks = 0
+  while first <= last:
+    stop = min(first + timedelta(days=chunk_days - 1), last)
+    with transaction.atomic():
+      rebuild_days(first, stop)
+    first = stop + timedelta(days=1)
+    chunks += 1
+  return chunks
+
+
+def top_sellers(first, last, limit=10, collection_id=None):
+  # the products that made the most revenue over the days, with the collection they are in now
+  sales = DailyProductSales.objects.filter(day__range=(first, last))
+  if collection_id is not None:
+    sales = sales.filter(product__collection_id=collection_id)
+  return list(
+    sales.values('product_id', title=F('product__title'))
+      .annotate(orders_count=Sum('orders_count'), units=Sum('units'), revenue=Sum('revenue'))
+      .order_by('-revenue', 'product_id')[:limit])
+
+
+def revenue_series(first, last, collection_id=None, product_id=None):
+  # units and revenue of every day, of one product, one collection or the whole store; days without sales are zeros
+  if product_id is not None:
+    sales = DailyProductSales.objects.filter(product_id=product_id)
+  elif collection_id is not None:
+    sales = DailyCollectionSales.objects.filter(collection_id=collection_id)
+  else:
+    sales = DailyCollectionSales.objects.all()
+  totals = {
+    row['day']: row
+    for row in sales.filter(day__range=(first, last)).values('day').annotate(units=Sum('units'), revenue=Sum('revenue')).order_by('day')
+  }
+  series = []
+  day = first
+  while day <= last:
+    row = totals.get(day, {})
+    series.append({'day': day, 'units': row.get('units', 0), 'revenue': row.get('revenue', Decimal('0.00'))})
+    day += timedelta(days=1)
+  return series
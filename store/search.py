@@ -0,0 +1,106 @@
+import re
+from functools import lru_cache, reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery, Sum
+from django.utils.module_loading import import_string
+from rest_framework.filters import SearchFilter
+
+from store.models import ProductSearchTerm
+
+TITLE_WEIGHT = 3 # a word in the title counts three times as much as a word in the description
+DESCRIPTION_WEIGHT = 1
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = ProductSearchTerm._meta.get_field('term').max_length
+
+_word = re.compile(r'\w+')
+
+
+def tokenize(text):
+  if not text:
+    return []
+  return [
+    word[:MAX_TERM_LENGTH] for word in _word.findall(text.lower())
+    if len(word) >= MIN_TERM_LENGTH
+  ]
+
+
+def build_postings(product):
+  weights = {}
+  for term in tokenize(product.title):
+    weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+  for term in tokenize(product.description):
+    weights[term] = weights.get(term, 0) + DESCRIPTION_WEIGHT
+  return [ProductSearchTerm(product_id=product.pk, term=term, weight=weight) for term, weight in weights.items()]
+
+
+def prefix_lookup(word):
+  # term >= 'abc' AND term < 'abd' rather than LIKE 'abc%', every database can answer it from the term index
+  return Q(term__gte=word, term__lt=word[:-1] + chr(ord(word[-1]) + 1))
+
+
+class SearchBackend:
+  def search(self, queryset, terms, search_fields):
+    raise NotImplementedError
+
+  def index_products(self, products):
+    pass
+
+  def remove_products(self, product_ids):
+    pass
+
+
+class LikeSearchBackend(SearchBackend):
+  # the plain DRF behaviour: every term must appear in one of the search fields (LIKE '%term%')
+  def search(self, queryset, terms, search_fields):
+    lookups = [SearchFilter().construct_search(str(field), queryset) for field in search_fields]
+    for term in terms:
+      queryset = queryset.filter(reduce(or_, [Q(**{lookup: term}) for lookup in lookups]))
+    return queryset
+
+
+class InvertedIndexSearchBackend(SearchBackend):
+  # keeps one (term, product, weight) row per distinct word of a product in store_productsearchterm;
+  # a search is an index range scan on term per word instead of a LIKE scan over the product table
+  batch_size = 1000
+
+  def search(self, queryset, terms, search_fields):
+    words = [word for term in terms for word in tokenize(term)]
+    if not words:
+      return LikeSearchBackend().search(queryset, terms, search_fields)
+
+    # every word has to match (AND between words, like SearchFilter); complete words are exact
+    # index lookups and only the last word, which may still be being typed, is a prefix range scan
+    lookups = [Q(term=word) for word in words[:-1]] + [prefix_lookup(words[-1])]
+    for lookup in lookups:
+      queryset = queryset.filter(pk__in=ProductSearchTerm.objects.filter(lookup).values('product_id'))
+
+    matches = reduce(or_, lookups)
+    rank = ProductSearchTerm.objects \
+      .filter(matches, product_id=OuterRef('pk')) \
+      .values('product_id') \
+      .annotate(rank=Sum('weight')) \
+      .values('rank')
+    return queryset.annotate(search_rank=Subquery(rank)).order_by('-search_rank', 'pk')
+
+  def index_products(self, products):
+    products = list(products)
+    with transaction.atomic():
+      ProductSearchTerm.objects.filter(product_id__in=[product.pk for product in products]).delete()
+      ProductSearchTerm.objects.bulk_create(
+        [posting for product in products for posting in build_postings(product)],
+        batch_size=self.batch_size)
+
+  def remove_products(self, product_ids):
+    ProductSearchTerm.objects.filter(product_id__in=product_ids).delete()
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+  return import_string(path)()
+
+
+def get_search_backend():
+  return _load_backend(getattr(settings, 'STORE_SEARCH_BACKEND', 'store.search.LikeSearchBackend'))
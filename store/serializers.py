@@ -1,19 +1,37 @@
+from datetime import timedelta
 from decimal import Decimal
+
 from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
 from rest_framework import serializers
-from store.models import Cart, CartItem, Customer, Order, OrderItem, Product, Collection, Review
-from store.signals import order_created
+from store import history, inventory, outbox, pricing, snapshots
+from store.compiled import row_method
+from store.carts import get_cart_store
+from store.db import set_prefetched
+from store.fieldsets import SparseFieldsSerializerMixin
+from store.models import Cart, CartItem, Customer, CustomerStats, Order, OrderItem, Product, Collection, Promotion, Review
 
 # this will be external representation of the product model, the one in models.py is the internal representation (maybe there are some fields that we don't wanna expose to the client)
 # API Model (interface) != Data Model (implementation)
 
-class CollectionSerializer(serializers.ModelSerializer):
+class CollectionSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
   class Meta:
     model = Collection
     fields = ['id', 'title', 'products_count']
 
   products_count = serializers.IntegerField(read_only = True)
 
+class SimpleCollectionSerializer(serializers.ModelSerializer):
+  class Meta:
+    model = Collection
+    fields = ['id', 'title']
+
+class PromotionSerializer(serializers.ModelSerializer):
+  class Meta:
+    model = Promotion
+    fields = ['id', 'description', 'discount']
+
 # class ProductSerializer(serializers.Serializer):
 #   id = serializers.IntegerField()
 #   title = serializers.CharField(max_length=255)
@@ -34,16 +52,38 @@ class CollectionSerializer(serializers.ModelSerializer):
 
 # OR
 
-class ProductSerializer(serializers.ModelSerializer): # this enables us to not write the validations and all of the fields again in the serializer when they were already defined in the model
+class ProductSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer): # this enables us to not write the validations and all of the fields again in the serializer when they were already defined in the model
   class Meta:
     model = Product
-    fields = ['id', 'title', 'description', 'slug', 'inventory', 'unit_price', 'price_with_tax', 'collection']
-
+    fields = ['id', 'title', 'description', 'slug', 'inventory', 'unit_price', 'sale_price', 'price_with_tax', 'collection']
+    expandable_fields = { # ?expand=collection,promotions,reviews
+      'collection': ('store.serializers.SimpleCollectionSerializer', {}),
+      'promotions': ('store.serializers.PromotionSerializer', {'many': True}),
+      'reviews': ('store.serializers.ReviewSerializer', {'many': True}),
+    }
+    field_dependencies = {
+      'sale_price': ['unit_price'],
+      'price_with_tax': ['unit_price'],
+    }
+    row_annotations = {'best_discount': pricing.best_discount} # for store.compiled
+
+  sale_price = serializers.SerializerMethodField(method_name='calculate_sale_price')
   price_with_tax = serializers.SerializerMethodField(method_name='calculate_tax')
   
+  # both read the discount annotated by pricing.with_discounts on the viewset queryset
+  def calculate_sale_price(self, product: Product):
+    return pricing.product_sale_price(product)
 
   def calculate_tax(self, product: Product):
-    return product.unit_price * Decimal(1.1);
+    return pricing.product_price_with_tax(product)
+
+  @row_method('unit_price', 'best_discount')
+  def row_sale_price(self, unit_price, discount):
+    return pricing.sale_price(unit_price, pricing.to_discount(discount))
+
+  @row_method('unit_price', 'best_discount')
+  def row_price_with_tax(self, unit_price, discount):
+    return pricing.price_with_tax(unit_price, pricing.to_discount(discount))
 
   # def create(self, validated_data): # helps to override the create method of the serializer
   #   product = Product(**validated_data) # ** is used to unpack the dictionary into keyword arguments
@@ -57,6 +97,15 @@ class ProductSerializer(serializers.ModelSerializer): # this enables us to not w
   #   return instance
 
 
+class ProductImportSerializer(ProductSerializer):
+  # the ProductSerializer rules for one row of a bulk import (store.importing), the collection is
+  # a plain id here because the importer checks the ids of a whole batch with one query
+  collection = serializers.IntegerField(source='collection_id')
+
+  class Meta(ProductSerializer.Meta):
+    fields = ['title', 'slug', 'description', 'unit_price', 'inventory', 'collection']
+
+
 class ReviewSerializer(serializers.ModelSerializer):
   class Meta:
     model = Review
@@ -75,25 +124,54 @@ class SimpleProductSerializer(serializers.ModelSerializer):
 
 class CartItemSerializer(serializers.ModelSerializer):
   product = SimpleProductSerializer()
+  unit_price = serializers.SerializerMethodField(method_name='get_unit_price') # after promotions
   total_price = serializers.SerializerMethodField(method_name='get_total_price')
 
+  # sale_price and line_total are computed by the database (pricing.with_line_totals)
+  def get_unit_price(self, cart_item: CartItem):
+    if hasattr(cart_item, 'sale_price'):
+      return cart_item.sale_price
+    return pricing.product_sale_price(cart_item.product)
+
   def get_total_price(self, cart_item: CartItem):
-    return cart_item.quantity * cart_item.product.unit_price
+    if hasattr(cart_item, 'line_total'):
+      return cart_item.line_total
+    return cart_item.quantity * pricing.product_sale_price(cart_item.product)
+
+  @row_method('sale_price')
+  def row_unit_price(self, sale_price):
+    return sale_price
+
+  @row_method('line_total')
+  def row_total_price(self, line_total):
+    return line_total
   class Meta:
     model = CartItem
-    fields = ['id', 'product', 'quantity', 'total_price']
+    fields = ['id', 'product', 'quantity', 'unit_price', 'total_price']
+    row_annotations = { # applied in this order, line_total reads sale_price
+      'sale_price': lambda: pricing.sale_price_expression('product__unit_price', pricing.best_discount('product_id')),
+      'line_total': lambda: pricing.line_total_expression(),
+    }
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
   id = serializers.UUIDField(read_only=True)
   items = CartItemSerializer(many=True, read_only=True)
   total_price = serializers.SerializerMethodField(method_name='get_total_price')
 
   def get_total_price(self, cart: Cart):
-    return sum([item.quantity * item.product.unit_price for item in cart.items.all()])
+    if hasattr(cart, 'items_total'): # pricing.cart_total
+      return cart.items_total
+    return sum([item.quantity * pricing.product_sale_price(item.product) for item in cart.items.all()])
   class Meta: 
     model = Cart
     fields = ['id', 'items', 'total_price'] # we added related name to cartitem model, thats why we can add 'items' field
+    field_relations = {
+      'items': [Prefetch('items', queryset=pricing.with_line_totals(CartItem.objects.select_related('product')))],
+    }
+    field_annotations = {
+      'total_price': {'items_total': pricing.cart_total},
+    }
 
 
 class AddCartItemSerializer(serializers.ModelSerializer):
@@ -105,20 +183,8 @@ class AddCartItemSerializer(serializers.ModelSerializer):
     return value
 
   def save(self, **kwargs):
-    cart_id = self.context['cart_id']
-    product_id = self.validated_data['product_id']
-    quantity = self.validated_data['quantity']
-
-    try: 
-      # update an existing item
-      cart_item = CartItem.objects.get(cart_id=cart_id, product_id=product_id)
-      cart_item.quantity += quantity
-      cart_item.save()
-      self.instance = cart_item # this is similar to how save is implemented in ModelSerializer
-    except CartItem.DoesNotExist:
-      # create a new item
-      self.instance = CartItem.objects.create(cart_id=cart_id, **self.validated_data)
-
+    # adds to the quantity of the item already in the cart, or creates it
+    self.instance = get_cart_store().add_items(self.context['cart_id'], [self.validated_data])[0]
     return self.instance
 
   class Meta:
@@ -127,13 +193,42 @@ class AddCartItemSerializer(serializers.ModelSerializer):
 
 
 
+class BatchCartItemSerializer(serializers.Serializer):
+  product_id = serializers.IntegerField()
+  quantity = serializers.IntegerField(min_value=1, max_value=32767)
+
+
+class BatchAddCartItemsSerializer(serializers.Serializer):
+  # {"items": [{"product_id": 1, "quantity": 2}, ...]}, like AddCartItemSerializer for many products at once
+  items = BatchCartItemSerializer(many=True, allow_empty=False)
+
+  def validate_items(self, items):
+    # the products of all the items are checked with one query
+    product_ids = {item['product_id'] for item in items}
+    found = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+    errors = [
+      {} if item['product_id'] in found else {'product_id': ['No product with the given ID was found.']}
+      for item in items
+    ]
+    if any(errors):
+      raise serializers.ValidationError(errors)
+    return items
+
+  def save(self, **kwargs):
+    self.instance = get_cart_store().add_items(self.context['cart_id'], self.validated_data['items'])
+    return self.instance
+
+
 class UpdateCartItemSerializer(serializers.ModelSerializer):
+  def update(self, instance, validated_data):
+    return get_cart_store().update_item(instance, validated_data['quantity'])
+
   class Meta:
     model = CartItem
     fields = ['quantity']
 
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
   user_id = serializers.IntegerField(read_only=True)
   class Meta:
     model = Customer
@@ -141,55 +236,129 @@ class CustomerSerializer(serializers.ModelSerializer):
 
 
 
+class CustomerStatsSerializer(serializers.ModelSerializer):
+  class Meta:
+    model = CustomerStats
+    fields = ['orders_count', 'items_count', 'lifetime_spend', 'first_purchase_at', 'last_purchase_at']
+
+
+class SalesReportSerializer(serializers.Serializer):
+  # the query parameters of the sales reports (store.rollups): ?start=&end= dates, inclusive, the last
+  # 30 days by default; ?collection= or ?product= narrow them and ?limit= sizes the top sellers
+  start = serializers.DateField(required=False)
+  end = serializers.DateField(required=False)
+  collection = serializers.IntegerField(required=False)
+  product = serializers.IntegerField(required=False)
+  limit = serializers.IntegerField(required=False, min_value=1, max_value=100, default=10)
+
+  def validate(self, data):
+    data['end'] = data.get('end') or timezone.localdate()
+    data['start'] = data.get('start') or data['end'] - timedelta(days=29)
+    if data['start'] > data['end']:
+      raise serializers.ValidationError({'start': ['Ensure start is not after end.']})
+    if (data['end'] - data['start']).days >= 3660:
+      raise serializers.ValidationError({'start': ['Ensure the report spans at most 3660 days.']})
+    return data
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
   product = SimpleProductSerializer()
+  total_price = serializers.SerializerMethodField(method_name='get_total_price')
+
+  def get_total_price(self, order_item: OrderItem):
+    return order_item.quantity * order_item.unit_price
+
+  @row_method('quantity', 'unit_price')
+  def row_total_price(self, quantity, unit_price):
+    return quantity * unit_price
   class Meta:
     model = OrderItem
-    fields = ['id', 'product', 'unit_price', 'quantity']
+    fields = ['id', 'product', 'unit_price', 'quantity', 'total_price']
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
   items = OrderItemSerializer(many=True)
+  total_price = serializers.SerializerMethodField(method_name='get_total_price')
+
+  def get_total_price(self, order: Order):
+    if hasattr(order, 'items_total'): # pricing.order_total
+      return order.items_total
+    return sum([item.quantity * item.unit_price for item in order.items.all()], Decimal('0.00'))
+
+  @row_method('items_total')
+  def row_total_price(self, items_total):
+    return items_total
   class Meta:
     model = Order
-    fields = ['id', 'customer', 'placed_at', 'payment_status', 'items']
+    fields = ['id', 'customer', 'placed_at', 'payment_status', 'items', 'total_price']
+    field_relations = {
+      'items': [Prefetch('items', queryset=OrderItem.objects.select_related('product'))], # items and products in one query
+    }
+    field_annotations = {
+      'total_price': {'items_total': pricing.order_total},
+    }
+    row_annotations = {'items_total': pricing.order_total} # for store.compiled
 
 
 class UpdateOrderSerializer(serializers.ModelSerializer):
+  def update(self, instance, validated_data):
+    with transaction.atomic():
+      order = super().update(instance, validated_data)
+      snapshots.update(order, list(validated_data), OrderSerializer)
+    return order
+
   class Meta:
     model = Order
     fields = ['payment_status'] # we can also add other fields here if we want to update them
 
 class CreateOrderSerializer(serializers.Serializer):
+  # context: customer_id (store.customers.get_customer_id). The items of the cart are loaded once, with
+  # their products and prices, by the validation; the order is returned with its items and their
+  # products in memory, ready for OrderSerializer without another query, and its snapshot is written
+  # from them (store.snapshots)
   cart_id = serializers.UUIDField()
 
   def validate_cart_id(self, cart_id):
-    if not Cart.objects.filter(pk=cart_id).exists():
+    items = get_cart_store().get_items(cart_id)
+    if items is None:
       raise serializers.ValidationError('No cart with given ID was found.')
-    if CartItem.objects.filter(cart_id=cart_id).count() == 0:
+    if not items:
       raise serializers.ValidationError('The cart is empty.')
+    self.cart_items = items
     return cart_id
 
   def save(self, **kwargs):
+    cart_store = get_cart_store()
     with transaction.atomic():
       cart_id = self.validated_data['cart_id']
-      customer = Customer.objects.get(user_id=self.context['user_id'])
-      order =Order.objects.create(customer=customer)
+      cart_items = self.cart_items
+
+      inventory.reserve({item.product_id: item.quantity for item in cart_items}) # raises OutOfStock (409), nothing is written then
+      order =Order.objects.create(customer_id=self.context['customer_id'])
 
-      cart_items = CartItem.objects.select_related('product').filter(cart_id=cart_id)
       order_items = [
         OrderItem(
           order=order,
           product=item.product,
           quantity=item.quantity,
-          unit_price=item.product.unit_price,
+          unit_price=item.sale_price, # the price after promotions is what the customer pays
         ) for item in cart_items
       ]
 
       OrderItem.objects.bulk_create(order_items)
-
-      Cart.objects.filter(pk=cart_id).delete()
-
-      order_created.send_robust(self.__class__, order=order) # this is to send the custom signal to the listeners
+      if any(order_item.pk is None for order_item in order_items):
+        # not every backend returns the ids of a bulk insert, a product is only once in an order
+        ids = dict(OrderItem.objects.filter(order=order).values_list('product_id', 'pk'))
+        for order_item in order_items:
+          order_item.pk = ids[order_item.product_id]
+      set_prefetched(order, 'items', order_items)
+      snapshots.write([order], OrderSerializer)
+      history.record_order(order, order_items)
+
+      cart_store.delete_cart(cart_id)
+
+      # order_created is sent by store.outbox.OutboxWorker once this transaction has committed, the
+      # receivers don't hold up the request
+      outbox.publish('order_created', self.__class__, order_id=order.pk)
 
       return order
 
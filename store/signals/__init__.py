@@ -1,3 +1,9 @@
 from django.dispatch import Signal
 
-order_created = Signal()
\ No newline at end of file
+order_created = Signal()
+
+collection_counts_changed = Signal() # collection_ids, sent when Collection.products_count is adjusted
+
+products_updated = Signal() # product_ids, collection_ids: Product.objects...update(), which sends no post_save
+
+order_completion_changed = Signal() # order, completed: an order entered (or left) payment status complete
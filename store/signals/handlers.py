@@ -1,9 +1,96 @@
 from django.conf import settings
 from django.db.models.base import post_save
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
 from django.dispatch import receiver
-from store.models import Customer
+from django.utils import timezone
+from store.caching import response_cache
+from store.customers import forget_customer
+from store.facets import invalidate_collections
+from store.models import Collection, Customer, CustomerStats, Product, Promotion, Review
+from store import rollups
+from store.signals import collection_counts_changed, order_completion_changed, products_updated
+from store.search import get_search_backend
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_customer_for_new_user(sender, **kwargs): # this function is called signal handler 
   if kwargs['created']:
-    Customer.objects.create(user=kwargs['instance'])
\ No newline at end of file
+    Customer.objects.create(user=kwargs['instance'])
+
+@receiver(post_save, sender=Customer)
+def create_customer_stats(sender, instance, created, **kwargs):
+  if created: # the orders add to it (store.history)
+    CustomerStats.objects.create(customer=instance)
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def forget_customer_id(sender, instance, created=True, **kwargs):
+  if created: # a customer never moves to another user, only a new or deleted one changes the mapping
+    forget_customer(instance.user_id)
+
+@receiver(order_completion_changed)
+def update_sales_rollups(sender, order, completed, **kwargs):
+  rollups.add_order(order, 1 if completed else -1)
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+  get_search_backend().index_products([instance])
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+  get_search_backend().remove_products([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_responses(sender, instance, **kwargs):
+  response_cache.invalidate('products', 'products:%s' % instance.pk, 'collections')
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_facets(sender, instance, **kwargs):
+  # a moved product changes the counts of the collection it left as well
+  invalidate_collections(instance.collection_id, getattr(instance, '_loaded_collection_id', None))
+
+@receiver([post_save, pre_delete], sender=Collection)
+def invalidate_collection_responses(sender, instance, **kwargs):
+  # products render the collection title with ?expand=collection
+  product_ids = list(instance.products.values_list('id', flat=True))
+  response_cache.invalidate('collections', 'products', *['products:%s' % product_id for product_id in product_ids])
+
+@receiver(collection_counts_changed)
+def invalidate_collection_counts(sender, collection_ids, **kwargs):
+  # also sent by the bulk paths (queryset.update(collection=...), bulk_create...) that send no post_save
+  response_cache.invalidate('collections', 'products')
+  invalidate_collections(*collection_ids)
+
+@receiver(products_updated)
+def invalidate_updated_products(sender, product_ids, collection_ids, **kwargs):
+  response_cache.invalidate('products', 'collections', *['products:%s' % product_id for product_id in product_ids])
+  invalidate_collections(*collection_ids)
+
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_review_responses(sender, instance, **kwargs):
+  response_cache.invalidate('products', 'products:%s' % instance.product_id) # ?expand=reviews
+
+@receiver([post_save, pre_delete], sender=Promotion) # pre_delete, after the delete the promoted products are gone
+def invalidate_promotion_responses(sender, instance, **kwargs):
+  product_ids = list(instance.product_set.values_list('id', flat=True))
+  touch_products(product_ids)
+  response_cache.invalidate('products', *['products:%s' % product_id for product_id in product_ids])
+
+@receiver(m2m_changed, sender=Product.promotions.through)
+def invalidate_product_promotions_responses(sender, instance, action, reverse, pk_set, **kwargs):
+  if action not in ('post_add', 'post_remove', 'pre_clear'):
+    return
+  if not reverse:
+    product_ids = [instance.pk]
+  elif action == 'pre_clear': # promotion.product_set.clear()
+    product_ids = list(instance.product_set.values_list('id', flat=True))
+  else: # promotion.product_set.add(...) / remove(...)
+    product_ids = pk_set
+  touch_products(product_ids)
+  response_cache.invalidate('products', *['products:%s' % product_id for product_id in product_ids])
+
+def touch_products(product_ids):
+  # a promotion changes the product's prices, moving last_update keeps the ETag/Last-Modified validators honest
+  if product_ids:
+    # the plain update, the callers invalidate the responses themselves
+    Product._base_manager.filter(pk__in=product_ids).update(last_update=timezone.now())
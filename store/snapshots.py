@@ -0,0 +1,77 @@
+import json
+
+from django.db import connection, transaction
+from rest_framework.utils.encoders import JSONEncoder
+
+from store.models import Order, OrderSnapshot
+
+# an order is rendered once, when it is placed, and its document is served as is afterwards: the items keep
+# the product titles and prices of the checkout. serializer_class is OrderSerializer (store.serializers)
+
+
+def to_json(data):
+  # what the JSON renderer makes of the serializer data (decimals, dates...), the document reads back the same
+  return json.loads(json.dumps(data, cls=JSONEncoder))
+
+
+def load(order_ids, serializer_class):
+  # the orders with everything their representation reads, in a fixed number of queries
+  return list(serializer_class.plan_queryset(Order.objects.filter(pk__in=order_ids)))
+
+
+def write(orders, serializer_class):
+  # upserts the snapshots of the orders, whose items and products are loaded (load, or in memory at checkout)
+  snapshots = [
+    OrderSnapshot(
+      order_id=order.pk,
+      customer_id=order.customer_id,
+      placed_at=order.placed_at,
+      last_update=order.last_update,
+      document=to_json(serializer_class(order).data),
+    ) for order in orders
+  ]
+  OrderSnapshot.objects.bulk_create(
+    snapshots,
+    update_conflicts=True,
+    # MySQL's ON DUPLICATE KEY UPDATE takes no conflict target
+    unique_fields=['order'] if connection.features.supports_update_conflicts_with_target else None,
+    update_fields=['customer', 'placed_at', 'document', 'last_update'],
+  )
+
+
+def update(order, fields, serializer_class):
+  # the fields of the order changed (UpdateOrderSerializer): only they are rendered again, the items stay
+  # as they were at checkout. An order without a snapshot gets one
+  with transaction.atomic():
+    snapshot = OrderSnapshot.objects.select_for_update().filter(order_id=order.pk).first()
+    if snapshot is None:
+      write(load([order.pk], serializer_class), serializer_class)
+      return
+    snapshot.document.update(to_json(serializer_class(order, context={'fields': fields}).data))
+    snapshot.last_update = order.last_update
+    snapshot.save(update_fields=['document', 'last_update'])
+
+
+def render(rows, fields=None):
+  # the documents of values('document') rows, with only the fields of ?fields= like SparseFieldsSerializerMixin
+  if fields is None:
+    return [row['document'] for row in rows]
+  return [{name: value for name, value in row['document'].items() if name in fields} for row in rows]
+
+
+def rebuild(serializer_class, chunk_size=500, missing=False):
+  # writes the snapshots of every order (or of the orders that have none) in pk order, chunk_size orders per
+  # transaction; returns how many. Orders placed before snapshots existed get the current product titles
+  written = 0
+  after = 0
+  while True:
+    queryset = Order.objects.filter(pk__gt=after).order_by('pk')
+    if missing:
+      queryset = queryset.filter(snapshot__isnull=True)
+    ids = list(queryset.values_list('pk', flat=True)[:chunk_size])
+    if not ids:
+      return written
+    after = ids[-1]
+    with transaction.atomic():
+      write(load(ids, serializer_class), serializer_class)
+    written += len(ids)
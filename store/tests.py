@@ -1,3 +1,1492 @@
-from django.test import TestCase
+import atexit
+import csv
+import io
+import json
+import os
+import random
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Prefetch, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from store import history
+from store.apps import serves_requests
+from store.carts import CacheCartStore
+from store.compiled import CompiledSerializer, get_compiled_serializer
+from store.db import upsert_increment, upsert_rows
+from store.exports import EXPORTS
+from store.facets import count_rows
+from store.customers import forget_customer, get_customer_id
+from store.importing import ProductImporter, read_records
+from store.inventory import OutOfStock
+from store.models import (
+  Cart, CartItem, Collection, Customer, CustomerStats, DailyCollectionSales, DailyProductSales, IdempotencyKey, Order, OrderItem, OutboxEvent, Product, ProductRecommendation, ProductSearchTerm, Promotion,
+  Review,
+)
+from store.outbox import OutboxWorker, publish
+from store.pricing import get_discount, line_total, sale_price, to_discount, with_discounts, with_line_totals
+from store.reaper import CartReaper, start_reaper_schedule
+from store.recommendations import RecommendationBuilder
+from store.rollups import day_start, rebuild_days
+from store.search import InvertedIndexSearchBackend
+from store.serializers import (
+  CartItemSerializer, CreateOrderSerializer, CustomerStatsSerializer, OrderItemSerializer, OrderSerializer, ProductSerializer, SimpleProductSerializer,
+)
+from store.signals import order_created
+from store.views import ExportView
+
+
+class StoreTestMixin:
+  # the caches outlive the test transactions (responses, customer ids, carts): every test starts empty
+  def setUp(self):
+    super().setUp()
+    for alias in settings.CACHES:
+      caches[alias].clear()
+
+  def make_products(self, count, collection=None, **fields):
+    # 'Product 0', 'Product 1'... in one new collection; a callable field (the collection too) is called with the index
+    fields = {
+      'title': lambda index: f'Product {index}', 'slug': lambda index: f'product-{index}', 'unit_price': 10, 'inventory': 100,
+      'collection': collection or Collection.objects.create(title='Collection'), **fields,
+    }
+    return [
+      Product.objects.create(**{name: value(index) if callable(value) else value for name, value in fields.items()})
+      for index in range(count)
+    ]
+
+  def make_product(self, collection=None, **fields):
+    return self.make_products(1, collection, **{'title': 'Product', 'slug': 'product', **fields})[0]
+
+  def make_customer(self, username='buyer', **fields):
+    user = get_user_model().objects.create_user(username, f'{username}@example.com', 'password', **fields)
+    return Customer.objects.get(user=user)
+
+
+class StoreTestCase(StoreTestMixin, TestCase):
+  pass
+
+
+class StoreTransactionTestCase(StoreTestMixin, TransactionTestCase):
+  pass
+
+
+@unittest.skipUnless(connection.features.has_select_for_update, 'needs a database with row locks (MySQL, PostgreSQL)')
+class InventoryReservationStressTest(StoreTransactionTestCase):
+  # thousands of orders placed by concurrent threads against a small stock: the inventory never goes
+  # below zero and every unit that left it is in an order item
+  orders = 2000
+  threads = 16
+  stock = 100
+
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(3, inventory=self.stock)
+    User = get_user_model()
+    self.user_ids = [
+      User.objects.create_user(f'buyer{index}', f'buyer{index}@example.com', 'password').id
+      for index in range(self.threads)
+    ]
+    self.assertEqual(Customer.objects.filter(user_id__in=self.user_ids).count(), self.threads)
+
+    rng = random.Random(16)
+    carts = Cart.objects.bulk_create([Cart() for _ in range(self.orders)])
+    CartItem.objects.bulk_create([
+      CartItem(cart=cart, product=product, quantity=rng.randint(1, 3))
+      for cart in carts
+      for product in rng.sample(self.products, rng.randint(1, 2))
+    ])
+    self.cart_ids = [cart.id for cart in carts]
+
+  def place_orders(self, user_id, cart_ids, results):
+    try:
+      for cart_id in cart_ids:
+        serializer = CreateOrderSerializer(data={'cart_id': cart_id}, context={'customer_id': get_customer_id(user_id)})
+        serializer.is_valid(raise_exception=True)
+        try:
+          serializer.save()
+          results['placed'] += 1
+        except OutOfStock:
+          results['out_of_stock'] += 1
+    except Exception as error:
+      results['errors'].append(error)
+    finally:
+      connection.close()
+
+  def test_concurrent_orders_never_oversell(self):
+    results = [{'placed': 0, 'out_of_stock': 0, 'errors': []} for _ in range(self.threads)]
+    workers = [
+      threading.Thread(target=self.place_orders, args=(user_id, self.cart_ids[index::self.threads], results[index]))
+      for index, user_id in enumerate(self.user_ids)
+    ]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+    self.assertEqual([error for result in results for error in result['errors']], [])
+    self.assertEqual(sum(result['placed'] + result['out_of_stock'] for result in results), self.orders)
+    self.assertGreater(sum(result['out_of_stock'] for result in results), 0) # the stock was too small for every order
+
+    sold = dict(OrderItem.objects.values_list('product_id').annotate(units=Sum('quantity')))
+    for product in Product.objects.filter(pk__in=[product.pk for product in self.products]):
+      self.assertGreaterEqual(product.inventory, 0)
+      self.assertEqual(product.inventory + sold.get(product.pk, 0), self.stock)
+
+
+class CheckoutQueryCountTest(StoreTestCase):
+  # placing an order: the cart items with their products and prices, locking and decrementing the
+  # inventory, the order, its items and deleting the cart; the customer id is cached and the response
+  # is rendered from the objects in memory
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(5, unit_price=lambda index: 10 + index)
+    self.user = self.make_customer().user
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def make_cart(self):
+    cart = Cart.objects.create()
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=2) for product in self.products])
+    return cart
+
+  def expected_queries(self):
+    features = connection.features
+    return (
+      1 # cart items, products and discounts
+      + 2 # savepoint of the view's transaction (the test case wraps everything in a transaction)
+      + 2 # product rows locked, inventory update
+      + (0 if features.has_select_for_update else 2) # savepoint around the update without row locks
+      + 2 # order, order items
+      + 1 # order_created outbox event
+      + 1 # order snapshot
+      + 1 # lifetime aggregates of the customer
+      + (0 if features.can_return_rows_from_bulk_insert else 1) # ids of the order items
+      + 2 # cart items, cart
+    )
+
+  def test_checkout_query_count(self):
+    self.client.post('/store/orders/', {'cart_id': self.make_cart().pk}) # caches the customer id
+    cart = self.make_cart()
+
+    with self.assertNumQueries(self.expected_queries()):
+      response = self.client.post('/store/orders/', {'cart_id': cart.pk})
+
+    self.assertEqual(response.status_code, 200)
+    order = Order.objects.get(pk=response.data['id'])
+    self.assertEqual(response.data['customer'], Customer.objects.get(user=self.user).pk)
+    self.assertEqual(
+      [(item['id'], item['product']['id'], item['quantity']) for item in response.data['items']],
+      list(order.items.order_by('pk').values_list('pk', 'product_id', 'quantity')))
+    self.assertFalse(Cart.objects.filter(pk=cart.pk).exists())
+
+
+class OrderListQueryCountTest(StoreTestCase):
+  # listing orders: the validators, the count, the page of orders and their items with their products,
+  # whatever the number of orders and items; the customer id comes from the token or the cache
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(3, unit_price=lambda index: 10 + index)
+    self.customer = self.make_customer()
+    self.user = self.customer.user
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def place_orders(self, count):
+    for _ in range(count):
+      order = Order.objects.create(customer=self.customer)
+      OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=1, unit_price=product.unit_price) for product in self.products])
+
+  def test_list_query_count_is_constant(self):
+    self.place_orders(1)
+    self.client.get('/store/orders/') # caches the customer id
+    with self.assertNumQueries(4):
+      self.client.get('/store/orders/')
+
+    self.place_orders(15)
+    for compiled in (False, True): # the items are prefetched by the serializers and by the compiled values()
+      with self.subTest(compiled=compiled), override_settings(STORE_COMPILED_SERIALIZERS=compiled):
+        with self.assertNumQueries(4):
+          response = self.client.get('/store/orders/')
+        self.assertEqual(response.data['count'], 16)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual([len(order['items']) for order in response.data['results']], [3] * 10)
+
+  def test_customer_id_claim(self):
+    self.place_orders(2)
+    tokens = APIClient().post('/auth/jwt/create/', {'username': 'buyer', 'password': 'password'}).data
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='JWT ' + tokens['access'])
+    client.get('/store/orders/') # caches the user of the token (core.authentication)
+    forget_customer(self.user.id)
+    with self.assertNumQueries(4): # the validators, the count, the orders, their items
+      response = client.get('/store/orders/')
+    self.assertEqual(response.data['count'], 2)
+
+
+class CartReaperTest(StoreTransactionTestCase):
+  # carts nobody touched for STORE_CART_EXPIRY_DAYS are deleted with their items, by a run or by the
+  # schedule StoreConfig.ready starts in the processes serving requests; fresh carts stay
+  def setUp(self):
+    super().setUp()
+    product = self.make_product()
+    carts = [Cart.objects.create() for _ in range(5)]
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1) for cart in carts])
+    self.abandoned = [cart.pk for cart in carts[:4]]
+    self.fresh = carts[4].pk
+    Cart.objects.filter(pk__in=self.abandoned).update(last_update=timezone.now() - timedelta(days=31))
+
+  @override_settings(STORE_CART_EXPIRY_DAYS=30)
+  def test_run_reaps_abandoned_carts(self):
+    report = CartReaper(chunk_size=3).run()
+    self.assertEqual((report['carts'], report['items'], report['chunks']), (4, 4, 2))
+    self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [self.fresh])
+    self.assertEqual(CartItem.objects.filter(cart_id=self.fresh).count(), 1)
+
+  @override_settings(STORE_CART_EXPIRY_DAYS=30, STORE_CART_REAPER_INTERVAL=0.05)
+  def test_schedule_reaps_abandoned_carts(self):
+    schedule = start_reaper_schedule()
+    try:
+      deadline = time.monotonic() + 5
+      while Cart.objects.filter(pk__in=self.abandoned).exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    finally:
+      schedule.stop()
+    self.assertEqual(list(Cart.objects.values_list('pk', flat=True)), [self.fresh])
+
+  def test_schedule_needs_an_interval(self):
+    self.assertIsNone(start_reaper_schedule())
+
+  def test_serves_requests(self):
+    for argv, run_main, expected in (
+      (['manage.py', 'runserver'], 'true', True), # the child process of the autoreloader
+      (['manage.py', 'runserver'], None, False), # the autoreloader
+      (['manage.py', 'runserver', '--noreload'], None, True),
+      (['manage.py', 'migrate'], None, False),
+      (['manage.py', 'test'], None, False),
+      (['/usr/bin/gunicorn', 'storefront.wsgi'], None, True),
+    ):
+      environ = {'RUN_MAIN': run_main} if run_main else {}
+      with mock.patch('sys.argv', argv), mock.patch.dict('os.environ', environ):
+        if not run_main:
+          os.environ.pop('RUN_MAIN', None)
+        self.assertEqual(serves_requests(), expected, argv)
+
+
+@override_settings(STORE_OUTBOX_INLINE=False)
+class OutboxTest(StoreTransactionTestCase):
+  # order_created is written to the outbox in the transaction of the order and delivered by OutboxWorker
+  # after the commit (or inline, see below), again after a backoff when a receiver raises
+  def setUp(self):
+    super().setUp()
+    self.product = self.make_product()
+    self.customer = self.make_customer()
+    self.user = self.customer.user
+    self.received = []
+    order_created.connect(self.receive, dispatch_uid='outbox-test')
+    self.addCleanup(order_created.disconnect, dispatch_uid='outbox-test')
+    self.failing = False
+
+  def receive(self, sender, order, **kwargs):
+    if self.failing:
+      raise RuntimeError('receiver failed')
+    self.received.append((sender, order.pk))
+
+  def process(self, worker):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      return worker.process_batch(executor)
+
+  def test_checkout_publishes_in_the_order_transaction(self):
+    cart = Cart.objects.create()
+    CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+    serializer = CreateOrderSerializer(data={'cart_id': cart.pk}, context={'customer_id': self.customer.pk})
+    serializer.is_valid(raise_exception=True)
+    order = serializer.save()
+    self.assertEqual(list(OutboxEvent.objects.values_list('event', 'payload')), [('order_created', {'order_id': order.pk})])
+    self.assertEqual(self.received, []) # nothing is sent before a worker delivers it
+
+  def test_rolled_back_events_are_never_delivered(self):
+    order = Order.objects.create(customer=self.customer)
+    with transaction.atomic():
+      publish('order_created', Order, order_id=order.pk)
+      transaction.set_rollback(True)
+    self.assertFalse(OutboxEvent.objects.exists())
+    self.assertEqual(self.process(OutboxWorker()), 0)
+
+  def test_process_batch_delivers_and_deletes(self):
+    orders = [Order.objects.create(customer=self.customer) for _ in range(3)]
+    for order in orders:
+      publish('order_created', CreateOrderSerializer, order_id=order.pk)
+    self.assertEqual(self.process(OutboxWorker(batch_size=2)), 2)
+    self.assertEqual(self.process(OutboxWorker(batch_size=2)), 1)
+    self.assertEqual(sorted(self.received), [(CreateOrderSerializer, order.pk) for order in orders])
+    self.assertFalse(OutboxEvent.objects.exists())
+
+  def test_failed_delivery_is_retried_after_a_backoff(self):
+    order = Order.objects.create(customer=self.customer)
+    publish('order_created', CreateOrderSerializer, order_id=order.pk)
+    worker = OutboxWorker(max_attempts=3, retry_delay=10)
+
+    self.failing = True
+    before = timezone.now()
+    self.assertEqual(self.process(worker), 1)
+    event = OutboxEvent.objects.get()
+    self.assertEqual(event.attempts, 1)
+    self.assertIn('receiver failed', event.last_error)
+    self.assertIsNone(event.failed_at)
+    self.assertGreaterEqual(event.available_at, before + timedelta(seconds=20)) # retry_delay * 2 ** attempts
+    self.assertEqual(self.process(worker), 0) # not available before the backoff
+
+    OutboxEvent.objects.update(available_at=timezone.now())
+    self.assertEqual(self.process(worker), 1)
+    OutboxEvent.objects.update(available_at=timezone.now())
+    with self.assertLogs('store.outbox', 'ERROR'):
+      self.assertEqual(self.process(worker), 1)
+    event = OutboxEvent.objects.get()
+    self.assertEqual(event.attempts, 3)
+    self.assertIsNotNone(event.failed_at) # given up after max_attempts
+    OutboxEvent.objects.update(available_at=timezone.now())
+    self.assertEqual(self.process(worker), 0)
+
+    self.failing = False
+    OutboxEvent.objects.update(attempts=0, failed_at=None)
+    self.assertEqual(self.process(worker), 1)
+    self.assertEqual(self.received, [(CreateOrderSerializer, order.pk)])
+    self.assertFalse(OutboxEvent.objects.exists())
+
+  @override_settings(STORE_OUTBOX_INLINE=True)
+  def test_delivered_inline_without_a_worker(self):
+    cart = Cart.objects.create()
+    CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+    client = APIClient()
+    client.force_authenticate(self.user)
+    response = client.post('/store/orders/', {'cart_id': cart.pk})
+    self.assertEqual(self.received, [(CreateOrderSerializer, response.data['id'])])
+    self.assertFalse(OutboxEvent.objects.exists())
+
+    # a failed event is retried by the commits after its backoff
+    orders = [Order.objects.create(customer=self.customer) for _ in range(2)]
+    self.failing = True
+    publish('order_created', Order, order_id=orders[0].pk)
+    self.assertEqual(OutboxEvent.objects.get().attempts, 1)
+    self.failing = False
+    OutboxEvent.objects.update(available_at=timezone.now())
+    publish('order_created', Order, order_id=orders[1].pk)
+    self.assertEqual(self.received[1:], [(Order, orders[0].pk), (Order, orders[1].pk)])
+    self.assertFalse(OutboxEvent.objects.exists())
+
+  @override_settings(STORE_OUTBOX_INLINE=True, STORE_OUTBOX_WORKER=True)
+  def test_not_inline_with_a_worker(self):
+    publish('order_created', Order, order_id=Order.objects.create(customer=self.customer).pk)
+    self.assertEqual((self.received, OutboxEvent.objects.count()), ([], 1))
+
+
+class CompiledOrderSerializerTest(StoreTestCase):
+  # the compiled OrderSerializer reads total_price from its items_total row annotation and renders the
+  # same json as OrderSerializer, for orders with and without items
+  def setUp(self):
+    super().setUp()
+    products = self.make_products(3, unit_price=lambda index: 10 + index)
+    customer = self.make_customer()
+    for count in range(4):
+      order = Order.objects.create(customer=customer)
+      OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=product, quantity=index + 1, unit_price=product.unit_price - Decimal('0.01'))
+        for index, product in enumerate(products[:count])
+      ])
+
+  def test_compiled_output_is_the_drf_output(self):
+    queryset = Order.objects.prefetch_related('items__product').order_by('pk')
+    compiled = get_compiled_serializer(OrderSerializer)
+    self.assertIsNotNone(compiled)
+    renderer = JSONRenderer()
+    self.assertEqual(
+      renderer.render(compiled.serialize(compiled.values(queryset))),
+      renderer.render(OrderSerializer(queryset, many=True).data))
+
+
+class CompiledSerializersTest(StoreTestCase):
+  # every serializer of manage.py benchmark_serializers renders the same json compiled (store.compiled)
+  # as through DRF, on the querysets the benchmark uses and with ?fields= and ?expand=
+  def setUp(self):
+    super().setUp()
+    promotions = [Promotion.objects.create(description=f'Promotion {index}', discount=discount) for index, discount in enumerate([0.1, 0.333])]
+    products = self.make_products(
+      6, description=lambda index: f'Description {index}' if index % 2 else None, unit_price=lambda index: Decimal('9.99') + index,
+      inventory=lambda index: index)
+    products[0].promotions.set(promotions)
+    products[1].promotions.set(promotions[:1])
+    Review.objects.create(product=products[0], name='Reviewer', description='Good')
+
+    self.cart = Cart.objects.create()
+    CartItem.objects.bulk_create([CartItem(cart=self.cart, product=product, quantity=index + 1) for index, product in enumerate(products)])
+    self.customer = self.make_customer()
+    for count in range(4):
+      order = Order.objects.create(customer=self.customer)
+      OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=product, quantity=2, unit_price=product.unit_price) for product in products[:count]
+      ])
+
+  def cases(self):
+    # (serializer, queryset, ?fields=, ?expand=)
+    products = with_discounts(Product.objects.all())
+    orders = Order.objects.prefetch_related('items__product')
+    return [
+      (ProductSerializer, products, None, ()),
+      (ProductSerializer, products, ('id', 'title', 'sale_price'), ()),
+      (ProductSerializer, products, None, ('collection', 'promotions', 'reviews')),
+      (ProductSerializer, products, ('id', 'price_with_tax'), ('collection',)),
+      (SimpleProductSerializer, Product.objects.all(), None, ()),
+      (CartItemSerializer, CartItem.objects.prefetch_related(Prefetch('product', queryset=with_discounts(Product.objects.all()))), None, ()),
+      (OrderItemSerializer, OrderItem.objects.select_related('product'), None, ()),
+      (OrderSerializer, orders, None, ()),
+      (OrderSerializer, orders, ('id', 'total_price'), ()),
+      (OrderSerializer, orders, ('id', 'items'), ()),
+    ]
+
+  def test_compiled_output_is_the_drf_output(self):
+    renderer = JSONRenderer()
+    for serializer_class, queryset, fields, expand in self.cases():
+      with self.subTest(serializer=serializer_class.__name__, fields=fields, expand=expand):
+        queryset = queryset.order_by('pk')
+        compiled = get_compiled_serializer(serializer_class, fields, expand)
+        self.assertIsNotNone(compiled)
+        context = {'fields': None if fields is None else list(fields), 'expand': list(expand)}
+        self.assertEqual(
+          renderer.render(compiled.serialize(compiled.values(queryset))),
+          renderer.render(serializer_class(queryset, many=True, context=context).data))
+
+  def test_list_pages_with_the_setting(self):
+    # STORE_COMPILED_SERIALIZERS is off by default; on, the list pages are compiled and unchanged
+    client = APIClient()
+    client.force_authenticate(self.customer.user)
+    urls = (
+      '/store/products/', '/store/products/?fields=id,title,sale_price&expand=collection', f'/store/carts/{self.cart.pk}/items/',
+      '/store/orders/', '/store/orders/?fields=id,total_price',
+    )
+    for url in urls:
+      with self.subTest(url=url):
+        with mock.patch('store.compiled.CompiledSerializer.serialize', autospec=True, side_effect=CompiledSerializer.serialize) as serialize:
+          caches['store'].clear()
+          drf = client.get(url)
+          self.assertFalse(serialize.called)
+          caches['store'].clear()
+          with override_settings(STORE_COMPILED_SERIALIZERS=True):
+            compiled = client.get(url)
+          self.assertTrue(serialize.called)
+        self.assertEqual((drf.status_code, compiled.content), (200, drf.content))
+
+
+class CollectionProductsCountTest(StoreTestCase):
+  # Collection.products_count only moves with the products: saving a collection loaded before a product
+  # was added keeps the count the F() update wrote
+  def test_save_keeps_a_concurrent_count(self):
+    collection = Collection.objects.create(title='Before')
+    stale = Collection.objects.get(pk=collection.pk)
+    self.make_product(collection)
+    self.assertEqual(stale.products_count, 0)
+
+    stale.title = 'After'
+    stale.save()
+    collection.refresh_from_db()
+    self.assertEqual((collection.title, collection.products_count), ('After', 1))
+
+  def test_moving_the_same_instance_twice(self):
+    first, second = [Collection.objects.create(title=title) for title in ('First', 'Second')]
+    product = self.make_product(first)
+    for collection, counts in ((second, [0, 1]), (first, [1, 0])):
+      product.collection = collection
+      product.save()
+      self.assertEqual([collection.products_count for collection in Collection.objects.filter(pk__in=[first.pk, second.pk]).order_by('pk')], counts)
+
+  def test_title_edit_through_the_api(self):
+    client = APIClient()
+    client.force_authenticate(self.make_customer('admin', is_staff=True).user)
+    collection = Collection.objects.create(title='Before')
+    self.make_product(collection)
+
+    response = client.put(f'/store/collections/{collection.pk}/', {'title': 'After', 'products_count': 7})
+    self.assertEqual(response.status_code, 200)
+    collection.refresh_from_db()
+    self.assertEqual((collection.title, collection.products_count), ('After', 1))
+
+
+class RecommendationBuilderTest(StoreTestCase):
+  # the score of a pair is the number of orders that have both products, the top_k of every product
+  # are ranked by score and then by id; an incremental build adds the new orders to the stored scores
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(4)
+    self.customer = self.make_customer()
+
+  def place_order(self, *indexes, payment_status=Order.PAYMENT_STATUS_COMPLETE):
+    order = Order.objects.create(customer=self.customer, payment_status=payment_status)
+    OrderItem.objects.bulk_create([
+      OrderItem(order=order, product=self.products[index], quantity=1, unit_price=10) for index in indexes
+    ])
+
+  def recommendations(self):
+    # {product index: [(recommended index, score)] by rank}
+    index = {product.pk: position for position, product in enumerate(self.products)}
+    result = {}
+    for product_id, recommended_id, score, rank in ProductRecommendation.objects.order_by('product_id', 'rank').values_list('product_id', 'recommended_id', 'score', 'rank'):
+      self.assertEqual(rank, len(result.setdefault(index[product_id], [])))
+      result[index[product_id]].append((index[recommended_id], score))
+    return result
+
+  def test_full_and_incremental_builds(self):
+    self.place_order(0, 1, 2)
+    self.place_order(0, 1)
+    self.place_order(1, 2)
+    self.place_order(0, 3, payment_status=Order.PAYMENT_STATUS_FAILED)
+    build = RecommendationBuilder(top_k=2).build()
+    self.assertTrue(build.full)
+    self.assertEqual((build.orders_count, build.products_count), (3, 3))
+    self.assertEqual(self.recommendations(), {
+      0: [(1, 2), (2, 1)],
+      1: [(0, 2), (2, 2)], # a tie goes to the smaller id
+      2: [(1, 2), (0, 1)],
+    })
+
+    self.place_order(2, 3)
+    self.place_order(0, 2)
+    build = RecommendationBuilder(top_k=2).build()
+    self.assertFalse(build.full)
+    self.assertEqual((build.orders_count, build.products_count), (2, 3))
+    self.assertEqual(self.recommendations(), {
+      0: [(1, 2), (2, 2)],
+      1: [(0, 2), (2, 2)], # no new order has it, left as it was
+      2: [(0, 2), (1, 2)],
+      3: [(2, 1)],
+    })
+
+    self.assertEqual(RecommendationBuilder(top_k=2).build().orders_count, 0) # nothing new
+    self.assertEqual(len(self.recommendations()), 4)
+
+  def test_endpoint(self):
+    self.place_order(0, 1)
+    RecommendationBuilder().build()
+    first, second = self.products[:2]
+    with self.assertNumQueries(1):
+      response = self.client.get(f'/store/products/{first.pk}/recommendations/')
+    self.assertEqual(response.data, [{'id': second.pk, 'title': second.title, 'unit_price': second.unit_price, 'score': 1}])
+    self.assertEqual(self.client.get(f'/store/products/{self.products[3].pk}/recommendations/').data, []) # never ordered
+    for pk in (0, 'abc'):
+      self.assertEqual(self.client.get(f'/store/products/{pk}/recommendations/').status_code, 404, pk)
+
+
+class KeysetPaginationTest(StoreTestCase):
+  # ?cursor= pages through the products by (ordering, pk): every product once, ties on the ordering
+  # broken by the pk, the previous links walk the same pages back, and rows added before the cursor
+  # don't shift the following pages
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(23, title=lambda index: 'ABC'[index % 3], unit_price=lambda index: 10 + index % 4)
+    self.client = APIClient()
+
+  def walk(self, url, link):
+    pages = []
+    while url:
+      response = self.client.get(url)
+      self.assertEqual(response.status_code, 200)
+      pages.append([product['id'] for product in response.data['results']])
+      url = response.data[link]
+    return pages, response
+
+  def test_round_trip(self):
+    for ordering, key in (
+      ('', lambda product: (product.title, product.pk)),
+      ('-unit_price', lambda product: (-product.unit_price, -product.pk)),
+    ):
+      with self.subTest(ordering=ordering):
+        pages, last = self.walk(f'/store/products/?cursor=&ordering={ordering}', 'next')
+        self.assertEqual([len(page) for page in pages], [10, 10, 3])
+        self.assertEqual(sum(pages, []), [product.pk for product in sorted(self.products, key=key)])
+
+        back, _ = self.walk(last.data['previous'], 'previous')
+        self.assertEqual(back, pages[-2::-1])
+
+  def test_rows_before_the_cursor_dont_shift_the_pages(self):
+    first = self.client.get('/store/products/?cursor=')
+    expected = [product.pk for product in sorted(self.products, key=lambda product: (product.title, product.pk))]
+    self.make_product(self.products[0].collection, title='A', slug='new')
+    caches['store'].clear() # the invalidation waits for a commit the test never makes
+    second = self.client.get(first.data['next'])
+    self.assertEqual([product['id'] for product in second.data['results']], expected[10:20])
+
+  def test_invalid_cursors(self):
+    next_url = self.client.get('/store/products/?cursor=').data['next']
+    self.assertEqual(self.client.get('/store/products/?cursor=garbage').status_code, 404)
+    # a cursor is only valid for the ordering it was created with
+    self.assertEqual(self.client.get(next_url + '&ordering=-unit_price').status_code, 404)
+
+
+class InvertedIndexSearchTest(StoreTestCase):
+  # products are ranked by the weights of the matching words (title 3, description 1) and then by pk;
+  # saving or deleting a product reindexes just that product
+  def setUp(self):
+    super().setUp()
+    self.collection = Collection.objects.create(title='Search')
+    self.backend = InvertedIndexSearchBackend()
+    self.products = [
+      self.create('Green tea', 'Loose leaf tea'), # tea: 3 + 1
+      self.create('Coffee mug', 'For coffee or tea'), # tea: 1
+      self.create('Teapot', 'Cast iron'), # prefix of teapot
+      self.create('Coffee beans', None),
+    ]
+
+  def create(self, title, description):
+    return self.make_product(self.collection, title=title, description=description)
+
+  def search(self, *terms):
+    return list(self.backend.search(Product.objects.all(), terms, ['title', 'description']).values_list('pk', flat=True))
+
+  def test_ranking(self):
+    green_tea, mug, teapot, beans = self.products
+    self.assertEqual(self.search('tea'), [green_tea.pk, teapot.pk, mug.pk]) # 4, 3 (teapot), 1; the last word is a prefix
+    self.assertEqual(self.search('coffee'), [mug.pk, beans.pk]) # 3 + 1, 3
+    self.assertEqual(self.search('coffee tea'), [mug.pk]) # every word has to match
+    self.assertEqual(self.search('tea coffee'), [mug.pk])
+    self.assertEqual(self.search('zz'), [])
+
+    response = self.client.get('/store/products/?search=tea')
+    self.assertEqual([product['id'] for product in response.data['results']], [green_tea.pk, teapot.pk, mug.pk])
+
+  def test_incremental_reindexing(self):
+    green_tea, mug, teapot, beans = self.products
+    beans.title = 'Tea beans'
+    beans.save()
+    self.assertEqual(self.search('beans'), [beans.pk])
+    self.assertEqual(self.search('coffee'), [mug.pk])
+    self.assertEqual(self.search('tea'), [green_tea.pk, teapot.pk, beans.pk, mug.pk])
+
+    green_tea.delete()
+    self.assertFalse(ProductSearchTerm.objects.filter(product_id=green_tea.pk).exists())
+    self.assertEqual(self.search('tea'), [teapot.pk, beans.pk, mug.pk])
+    # the other products kept their postings
+    self.assertEqual(ProductSearchTerm.objects.filter(product_id=mug.pk).count(), 5) # coffee, mug, for, or, tea
+
+
+class FacetsTest(StoreTestCase):
+  # /products/facets/ counts the products per collection, price bucket and stock level; the counts of a
+  # collection are cached until one of its products changes, the other collections are reused
+  def setUp(self):
+    super().setUp()
+    self.first, self.second = [Collection.objects.create(title=title) for title in ('A', 'B')]
+    prices = [5, 10, 24, 60, 150]
+    self.products = self.make_products(
+      5, lambda index: self.first if index < 3 else self.second, unit_price=lambda index: prices[index], inventory=lambda index: [0, 5, 50][index % 3])
+    self.client = APIClient()
+
+  def facets(self, url='/store/products/facets/'):
+    with mock.patch('store.facets.count_rows', wraps=count_rows) as counted:
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    collection_ids = {collection_id for call in counted.call_args_list for collection_id in call.args[0].values_list('collection_id', flat=True)}
+    return response.data, collection_ids
+
+  def test_counts(self):
+    data, _ = self.facets()
+    self.assertEqual(data['count'], 5)
+    self.assertEqual([(collection['title'], collection['count']) for collection in data['collections']], [('A', 3), ('B', 2)])
+    self.assertEqual([bucket['count'] for bucket in data['price']], [1, 2, 0, 1, 1]) # 5 | 10, 24 | - | 60 | 150
+    self.assertEqual(data['stock'], {'in_stock': 3, 'low_stock': 2, 'out_of_stock': 2}) # inventory 0, 5, 50, 0, 5
+
+    data, _ = self.facets('/store/products/facets/?unit_price__lt=25')
+    self.assertEqual([(collection['title'], collection['count']) for collection in data['collections']], [('A', 3)])
+
+  def test_a_change_recounts_its_collection(self):
+    self.assertEqual(self.facets()[1], {self.first.pk, self.second.pk})
+    self.assertEqual(self.facets()[1], set()) # cached
+
+    with self.captureOnCommitCallbacks(execute=True):
+      self.products[0].unit_price = 30
+      self.products[0].save()
+    data, counted = self.facets()
+    self.assertEqual(counted, {self.first.pk})
+    self.assertEqual([bucket['count'] for bucket in data['price']], [0, 2, 1, 1, 1])
+
+    with self.captureOnCommitCallbacks(execute=True): # moved: both collections
+      self.products[3].collection = self.first
+      self.products[3].save()
+    data, counted = self.facets()
+    self.assertEqual(counted, {self.first.pk, self.second.pk})
+    self.assertEqual([(collection['title'], collection['count']) for collection in data['collections']], [('A', 4), ('B', 1)])
+
+
+class ResponseCacheTest(StoreTestCase):
+  # the product and collection responses are cached until a write to something they render commits:
+  # the product, its collection, its promotions or reviews
+  def setUp(self):
+    super().setUp()
+    self.collection = Collection.objects.create(title='Cached')
+    self.products = self.make_products(2, self.collection)
+    self.client = APIClient()
+
+  def get(self, url):
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    return response['X-Cache'], response.data
+
+  def test_reads_are_cached(self):
+    for url in ('/store/products/', f'/store/products/{self.products[0].pk}/', '/store/collections/'):
+      self.assertEqual(self.get(url)[0], 'MISS')
+      self.assertEqual(self.get(url)[0], 'HIT')
+    self.assertEqual(self.get('/store/products/?ordering=unit_price')[0], 'MISS') # another query string
+
+  def test_product_write_invalidates(self):
+    first, second = self.products
+    for url in ('/store/products/', f'/store/products/{first.pk}/', f'/store/products/{second.pk}/', '/store/collections/'):
+      self.get(url)
+
+    with self.captureOnCommitCallbacks(execute=True):
+      first.title = 'Renamed'
+      first.save()
+    status, data = self.get(f'/store/products/{first.pk}/')
+    self.assertEqual((status, data['title']), ('MISS', 'Renamed'))
+    status, data = self.get('/store/products/')
+    self.assertEqual((status, [product['title'] for product in data['results']]), ('MISS', ['Product 1', 'Renamed']))
+    self.assertEqual(self.get('/store/collections/')[0], 'MISS') # the counts can change
+    self.assertEqual(self.get(f'/store/products/{second.pk}/')[0], 'HIT') # another product
+
+  def test_related_writes_invalidate(self):
+    first, second = self.products
+    url = f'/store/products/{first.pk}/?expand=collection,promotions,reviews'
+    self.get(url)
+
+    with self.captureOnCommitCallbacks(execute=True):
+      self.collection.title = 'Renamed'
+      self.collection.save()
+    status, data = self.get(url)
+    self.assertEqual((status, data['collection']['title']), ('MISS', 'Renamed'))
+
+    with self.captureOnCommitCallbacks(execute=True):
+      first.promotions.add(Promotion.objects.create(description='Sale', discount=0.5))
+    status, data = self.get(url)
+    self.assertEqual((status, len(data['promotions']), data['sale_price']), ('MISS', 1, Decimal('5.00')))
+
+    with self.captureOnCommitCallbacks(execute=True):
+      Review.objects.create(product=first, name='Reviewer', description='Good')
+    status, data = self.get(url)
+    self.assertEqual((status, len(data['reviews'])), ('MISS', 1))
+
+  def test_queryset_update_invalidates(self):
+    # the admin's clear inventory action and price changes go through ProductQuerySet.update, no post_save
+    first, second = self.products
+    self.client.get('/store/products/facets/')
+    urls = ('/store/products/', f'/store/products/{first.pk}/', f'/store/products/{second.pk}/')
+    etags = {url: self.client.get(url)['ETag'] for url in urls}
+
+    with self.captureOnCommitCallbacks(execute=True):
+      Product.objects.filter(pk=first.pk).update(inventory=0, unit_price=60)
+    status, data = self.get(f'/store/products/{first.pk}/')
+    self.assertEqual((status, data['inventory'], data['unit_price']), ('MISS', 0, Decimal('60.00')))
+    self.assertEqual(self.get('/store/products/')[0], 'MISS')
+    self.assertEqual(self.client.get('/store/products/facets/').data['stock']['out_of_stock'], 1)
+    for url in urls[:2]:
+      self.assertNotEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 304, url)
+    self.assertEqual(self.client.get(urls[2], HTTP_IF_NONE_MATCH=etags[urls[2]]).status_code, 304) # another product
+
+  def test_rolled_back_write_keeps_the_cache(self):
+    self.get('/store/products/')
+    with transaction.atomic():
+      self.products[0].save()
+      transaction.set_rollback(True)
+    self.assertEqual(self.get('/store/products/')[0], 'HIT')
+
+
+class SparseFieldsTest(StoreTestCase):
+  # ?fields= keeps the named fields and reads only their columns, ?expand= nests the relations with a
+  # join (collection) or one prefetch query each (promotions, reviews) whatever the number of products;
+  # a name the serializer doesn't have is a 400
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(3)
+    self.products[0].promotions.add(Promotion.objects.create(description='Sale', discount=0.1))
+    Review.objects.create(product=self.products[0], name='Reviewer', description='Good')
+
+  def get(self, url):
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    return response.data, [query['sql'] for query in queries]
+
+  def test_fields(self):
+    data, queries = self.get('/store/products/?fields=id,title')
+    self.assertEqual([set(product) for product in data['results']], [{'id', 'title'}] * 3)
+    self.assertEqual(len(queries), 3) # the validators, the count, the page
+    self.assertNotIn('"store_product"."description"', queries[-1])
+    self.assertNotIn('store_collection', queries[-1])
+
+    data, _ = self.get(f'/store/products/{self.products[0].pk}/?fields=id,sale_price')
+    self.assertEqual(data, {'id': self.products[0].pk, 'sale_price': Decimal('9.00')}) # sale_price reads unit_price
+
+  def test_expand(self):
+    data, queries = self.get(f'/store/products/{self.products[0].pk}/?fields=id,title&expand=collection')
+    self.assertEqual(data['collection'], {'id': self.products[0].collection_id, 'title': 'Collection'})
+    self.assertEqual(set(data), {'id', 'title', 'collection'})
+    self.assertIn('JOIN "store_collection"', queries[-1])
+
+    url = '/store/products/?expand=collection,promotions,reviews'
+    data, queries = self.get(url)
+    self.assertEqual(
+      [(len(product['promotions']), len(product['reviews'])) for product in data['results']],
+      [(1, 1), (0, 0), (0, 0)])
+    self.make_products(5, self.products[0].collection, slug=lambda index: f'more-{index}')
+    caches['store'].clear() # the invalidation waits for a commit the test never makes
+    with self.assertNumQueries(len(queries)): # the count, the page, the promotions, the reviews
+      self.client.get(url)
+
+  def test_unknown_names(self):
+    for url, param in (
+      ('/store/products/?fields=id,titel', 'fields'),
+      (f'/store/products/{self.products[0].pk}/?expand=collection,promotion', 'expand'),
+      ('/store/collections/?fields=products', 'fields'),
+    ):
+      for headers in ({}, {'HTTP_IF_NONE_MATCH': 'W/"etag"'}):
+        response = self.client.get(url, **headers)
+        self.assertEqual((response.status_code, list(response.data)), (400, [param]), url)
+
+
+class ConditionalGetTest(StoreTestCase):
+  # If-None-Match and If-Modified-Since get a 304 from one aggregate query, and the ETag changes with
+  # whatever the representation depends on: a product's promotions, a cart's product prices, the
+  # products of a collection
+  def setUp(self):
+    super().setUp()
+    self.collection = Collection.objects.create(title='Conditional')
+    self.product = self.make_product(self.collection)
+    self.client = APIClient()
+
+  def etag(self, url):
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    return response['ETag']
+
+  def test_not_modified(self):
+    for url in ('/store/products/', f'/store/products/{self.product.pk}/', '/store/collections/'):
+      response = self.client.get(url)
+      with self.assertNumQueries(1):
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+      self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+      self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='W/"other"').status_code, 200)
+    # the url is part of the ETag
+    etag = self.etag('/store/products/')
+    self.assertEqual(self.client.get('/store/products/?fields=id', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+  def test_malformed_pk_is_a_404(self):
+    client = APIClient()
+    client.force_authenticate(self.make_customer('admin', is_staff=True).user)
+    for url in ('/store/products/abc/', '/store/collections/abc/', '/store/carts/not-a-uuid/', '/store/orders/abc/'):
+      self.assertEqual(client.get(url).status_code, 404, url)
+      self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH='W/"etag"').status_code, 404, url)
+
+  def test_promotion_changes_the_product_etag(self):
+    url = f'/store/products/{self.product.pk}/'
+    etag = self.etag(url)
+    self.product.promotions.add(Promotion.objects.create(description='Sale', discount=0.5))
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+
+  def test_product_price_changes_the_cart_etag(self):
+    cart = Cart.objects.create()
+    CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+    for url in (f'/store/carts/{cart.pk}/', f'/store/carts/{cart.pk}/items/'):
+      etag = self.etag(url)
+      self.product.unit_price += 1
+      self.product.save()
+      response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+      self.assertEqual(response.status_code, 200)
+      self.assertNotEqual(response['ETag'], etag)
+
+  def test_new_product_changes_the_collection_etag(self):
+    url = f'/store/collections/{self.collection.pk}/'
+    etag = self.etag(url)
+    self.make_product(self.collection, title='Another', slug='another')
+    caches['store'].clear() # the invalidation waits for a commit the test never makes
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual((response.status_code, response.data['products_count']), (200, 2))
+    self.assertNotEqual(response['ETag'], etag)
+
+
+class ProductImportTest(StoreTestCase):
+  # every row of an import is validated like ProductSerializer and upserted by slug; the rows that fail
+  # are reported with their line and skipped, the others of their batch are still written
+  def setUp(self):
+    super().setUp()
+    self.collections = [Collection.objects.create(title=f'Collection {index}') for index in range(2)]
+    self.existing = self.make_product(self.collections[0], title='Existing', slug='existing', inventory=1)
+    self.client = APIClient()
+    self.client.force_authenticate(self.make_customer('admin', is_staff=True).user)
+
+  def row(self, slug, **fields):
+    return json.dumps({'title': slug.title(), 'slug': slug, 'unit_price': '12.50', 'inventory': 3, 'collection': self.collections[0].pk, **fields})
+
+  def test_partial_failure_report(self):
+    lines = [
+      self.row('first'),
+      '{not json',
+      self.row('cheap', unit_price='0.50'),
+      '',
+      self.row('existing', title='Updated', collection=self.collections[1].pk),
+      self.row('orphan', collection=999999),
+      '[1, 2]',
+      self.row('second', inventory='many'),
+      self.row('third'),
+    ]
+    response = self.client.post('/store/products/import/', '\n'.join(lines), content_type='application/x-ndjson')
+    self.assertEqual(response.status_code, 200)
+    report = response.data
+    self.assertEqual((report['created'], report['updated'], report['failed']), (2, 1, 5))
+    self.assertEqual(
+      [(error['line'], sorted(error['errors'])) for error in sorted(report['errors'], key=lambda error: error['line'])],
+      [(2, ['non_field_errors']), (3, ['unit_price']), (6, ['collection']), (7, ['non_field_errors']), (8, ['inventory'])])
+
+    self.assertEqual(sorted(Product.objects.values_list('slug', flat=True)), ['existing', 'first', 'third'])
+    self.existing.refresh_from_db()
+    self.assertEqual((self.existing.title, self.existing.collection_id), ('Updated', self.collections[1].pk))
+    self.assertEqual(
+      [collection.products_count for collection in Collection.objects.filter(pk__in=[c.pk for c in self.collections]).order_by('pk')],
+      [2, 1])
+    self.assertTrue(ProductSearchTerm.objects.filter(term='updated', product=self.existing).exists())
+
+  def test_failures_dont_abort_their_batch(self):
+    lines = [self.row('first'), self.row('bad', unit_price='-1'), self.row('second'), self.row('third', collection=999999), self.row('fourth')]
+    report = ProductImporter(batch_size=2).run(read_records(lines, 'jsonl'))
+    self.assertEqual((report['created'], report['updated'], report['failed']), (3, 0, 2))
+    self.assertEqual([error['line'] for error in report['errors']], [2, 4])
+
+  def test_csv(self):
+    body = 'title,slug,unit_price,inventory,collection\nFirst,first,3,1,%d\n"Second, in quotes",existing,4,2,%d\nBad,bad,x,1,%d\n' % (
+      (self.collections[0].pk,) * 3)
+    response = self.client.post('/store/products/import/', body, content_type='text/csv')
+    self.assertEqual((response.data['created'], response.data['updated'], response.data['failed']), (1, 1, 1))
+    self.assertEqual(response.data['errors'][0]['line'], 4)
+    self.existing.refresh_from_db()
+    self.assertEqual(self.existing.title, 'Second, in quotes')
+
+  def test_unsupported_media_type(self):
+    self.assertEqual(self.client.post('/store/products/import/', 'x', content_type='text/plain').status_code, 415)
+
+
+class ExportTest(StoreTestCase):
+  # /store/exports/ streams every row matching the filters once, in pk order, read in keyset chunks of
+  # ExportView.chunk_size rows (one query each)
+  def setUp(self):
+    super().setUp()
+    self.collections = [Collection.objects.create(title=f'Collection {index}') for index in range(2)]
+    self.products = self.make_products(
+      5, lambda index: self.collections[index % 2], description=lambda index: 'Comma, "quotes"' if index == 0 else None)
+    customer = self.make_customer()
+    now = timezone.now()
+    self.orders = []
+    for days_ago in (3, 2, 1, 0):
+      order = Order.objects.create(customer=customer, payment_status=Order.PAYMENT_STATUS_COMPLETE if days_ago % 2 else Order.PAYMENT_STATUS_PENDING)
+      OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=1, unit_price=product.unit_price) for product in self.products[:2]])
+      Order.objects.filter(pk=order.pk).update(placed_at=now - timedelta(days=days_ago))
+      self.orders.append(Order.objects.get(pk=order.pk))
+    self.client = APIClient()
+    self.client.force_authenticate(self.make_customer('admin', is_staff=True).user)
+
+  def export(self, url, queries):
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    with self.assertNumQueries(queries): # the rows are read while the response is streamed
+      return b''.join(response.streaming_content).decode()
+
+  @mock.patch.object(ExportView, 'chunk_size', 2)
+  def test_csv(self):
+    rows = list(csv.reader(io.StringIO(self.export('/store/exports/products.csv', 3)))) # 2 + 2 + 1 rows
+    self.assertEqual(rows[0], EXPORTS['products'].columns)
+    self.assertEqual([row[:5] for row in rows[1:]], [
+      [str(product.pk), product.title, product.slug, product.description or '', '10.00'] for product in self.products
+    ])
+    self.assertEqual(rows[1][3], 'Comma, "quotes"')
+
+    rows = list(csv.reader(io.StringIO(self.export(f'/store/exports/products.csv?collection_id={self.collections[1].pk}', 2))))
+    self.assertEqual([int(row[0]) for row in rows[1:]], [product.pk for product in self.products[1::2]])
+
+  @mock.patch.object(ExportView, 'chunk_size', 2)
+  def test_ndjson(self):
+    lines = [json.loads(line) for line in self.export('/store/exports/orders.ndjson', 3).splitlines()] # 2 + 2 + an empty chunk
+    self.assertEqual([line['id'] for line in lines], [order.pk for order in self.orders])
+    self.assertEqual(lines[0], {
+      'id': self.orders[0].pk, 'customer_id': self.orders[0].customer_id, 'placed_at': self.orders[0].placed_at.isoformat(),
+      'payment_status': 'C', 'last_update': self.orders[0].last_update.isoformat(),
+    })
+
+    placed_at = self.orders[1].placed_at.isoformat().replace('+', '%2B')
+    lines = [json.loads(line) for line in self.export(f'/store/exports/order-items.ndjson?placed_at__gte={placed_at}&payment_status=P', 3).splitlines()]
+    self.assertEqual(
+      [(line['order_id'], line['product_id'], line['unit_price']) for line in lines],
+      [(order.pk, product.pk, '10.00') for order in self.orders[1::2] for product in self.products[:2]])
+
+  def test_chunks_cover_every_row_once(self):
+    for chunk_size in (1, 2, 3, 5, 6):
+      with self.subTest(chunk_size=chunk_size):
+        chunks = list(EXPORTS['products'].rows(Product.objects.all(), chunk_size))
+        self.assertTrue(all(len(chunk) <= chunk_size for chunk in chunks))
+        self.assertEqual([row[0] for chunk in chunks for row in chunk], [product.pk for product in self.products])
+
+  def test_errors(self):
+    self.assertEqual(self.client.get('/store/exports/orders.csv?placed_at__gte=yesterday').status_code, 400)
+    self.assertEqual(self.client.get('/store/exports/customers.csv').status_code, 404)
+    self.assertEqual(self.client.get('/store/exports/orders.xml').status_code, 404)
+    client = APIClient()
+    client.force_authenticate(self.make_customer('other').user)
+    self.assertEqual(client.get('/store/exports/orders.csv').status_code, 403)
+
+
+class UpsertIncrementTest(StoreTestCase):
+  # a row whose unique key already exists gets the increments added, in the same statement as the new
+  # rows; the same key twice in one call is added up first
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(3)
+    self.cart = Cart.objects.create()
+
+  def quantities(self):
+    return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+  def rows(self, *quantities):
+    return [{'cart_id': self.cart.pk, 'product_id': product.pk, 'quantity': quantity} for product, quantity in quantities]
+
+  def test_conflicts_add_up(self):
+    first, second, third = self.products
+    items = upsert_increment(CartItem, self.rows((first, 2), (second, 1)), ['cart', 'product'], 'quantity', returning=True)
+    self.assertEqual(sorted((item.product_id, item.quantity) for item in items), [(first.pk, 2), (second.pk, 1)])
+    self.assertTrue(all(item.pk for item in items))
+
+    items = upsert_increment(CartItem, self.rows((first, 3), (third, 1), (first, 1)), ['cart', 'product'], 'quantity', returning=True)
+    self.assertEqual(sorted((item.product_id, item.quantity) for item in items), [(first.pk, 6), (third.pk, 1)])
+    self.assertEqual(self.quantities(), {first.pk: 6, second.pk: 1, third.pk: 1})
+    self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 3)
+
+    self.assertIsNone(upsert_increment(CartItem, self.rows((second, 4)), ['cart', 'product'], 'quantity'))
+    self.assertEqual(self.quantities()[second.pk], 5)
+    self.assertEqual(upsert_increment(CartItem, [], ['cart', 'product'], 'quantity', returning=True), [])
+
+  def test_several_increments(self):
+    day = timezone.localdate()
+    row = {'day': day, 'product_id': self.products[0].pk, 'orders_count': 1, 'units': 2, 'revenue': Decimal('20.00')}
+    counters = ['orders_count', 'units', 'revenue']
+    upsert_increment(DailyProductSales, [row], ['day', 'product'], counters)
+    upsert_increment(DailyProductSales, [row, {**row, 'orders_count': -1, 'units': -1, 'revenue': Decimal('-5.50')}], ['day', 'product'], counters)
+    self.assertEqual(
+      list(DailyProductSales.objects.values_list('orders_count', 'units', 'revenue')),
+      [(1, 3, Decimal('34.50'))])
+
+  def test_update_then_insert_fallback(self):
+    # the path of the databases without an upsert statement
+    first, second, third = self.products
+    CartItem.objects.create(cart=self.cart, product=first, quantity=1)
+    merged = {(self.cart.pk, first.pk): (2,), (self.cart.pk, second.pk): (3,)}
+    upsert_rows(CartItem, 'default', [CartItem._meta.get_field('cart'), CartItem._meta.get_field('product')], [CartItem._meta.get_field('quantity')], merged)
+    self.assertEqual(self.quantities(), {first.pk: 3, second.pk: 3})
+
+  def test_add_to_cart(self):
+    first, second, third = self.products
+    client = APIClient()
+    url = f'/store/carts/{self.cart.pk}/items/'
+    client.post(url, {'product_id': first.pk, 'quantity': 2})
+    response = client.post(url, {'product_id': first.pk, 'quantity': 3})
+    self.assertEqual(response.status_code, 201)
+    response = client.post(url + 'batch/', {'items': [
+      {'product_id': first.pk, 'quantity': 1}, {'product_id': second.pk, 'quantity': 2}, {'product_id': second.pk, 'quantity': 2},
+    ]}, format='json')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(sorted((item['product_id'], item['quantity']) for item in response.data), [(first.pk, 6), (second.pk, 4)])
+    self.assertEqual(self.quantities(), {first.pk: 6, second.pk: 4})
+
+
+class CacheCartWriteBehindTest(StoreTestCase):
+  # with write_behind the carts live in the cache and flush() writes the changed ones to the cart tables,
+  # which a cart missing from the cache is read back from
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(3)
+    self.store = CacheCartStore(alias='default', write_behind=3600)
+    self.store._timer.cancel() # flushed by the test
+    self.addCleanup(atexit.unregister, self.store.flush)
+
+  def stored(self, cart_id):
+    return dict(CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'quantity'))
+
+  def test_flush(self):
+    first, second, third = self.products
+    cart_id = str(self.store.create_cart().pk)
+    self.store.add_items(cart_id, [{'product_id': first.pk, 'quantity': 2}, {'product_id': second.pk, 'quantity': 1}])
+    self.assertFalse(Cart.objects.filter(pk=cart_id).exists()) # nothing written before the flush
+
+    self.assertEqual(self.store.flush(), 1)
+    cart = Cart.objects.get(pk=cart_id)
+    entry = caches['default'].get(self.store.make_key(cart_id))
+    self.assertEqual((cart.created_at, cart.last_update), (entry['created_at'], entry['last_update']))
+    self.assertEqual(self.stored(cart_id), {first.pk: 2, second.pk: 1})
+    self.assertEqual(self.store.flush(), 0) # nothing changed since
+
+    self.store.update_item(self.store.get_item(cart_id, first.pk), 5)
+    self.store.delete_item(self.store.get_item(cart_id, second.pk))
+    self.store.add_items(cart_id, [{'product_id': third.pk, 'quantity': 1}])
+    third.delete()
+    self.assertEqual(self.store.flush(), 1)
+    self.assertEqual(self.stored(cart_id), {first.pk: 5}) # the deleted product is left out
+
+  def test_read_through(self):
+    cart_id = str(self.store.create_cart().pk)
+    self.store.add_items(cart_id, [{'product_id': self.products[0].pk, 'quantity': 3}])
+    self.store.flush()
+    caches['default'].clear() # e.g. evicted
+    self.assertEqual([(item.product_id, item.quantity) for item in self.store.get_items(cart_id)], [(self.products[0].pk, 3)])
+
+  def test_deleted_cart(self):
+    cart_id = str(self.store.create_cart().pk)
+    self.store.flush()
+    with self.captureOnCommitCallbacks(execute=True):
+      self.store.delete_cart(cart_id)
+    self.assertIsNone(self.store.get_cart(cart_id)) # not read back from the tables meanwhile
+    self.assertEqual(self.store.flush(), 1)
+    self.assertFalse(Cart.objects.filter(pk=cart_id).exists())
+
+  def test_failed_flush_keeps_the_carts_dirty(self):
+    cart_id = str(self.store.create_cart().pk)
+    with mock.patch.object(self.store, 'persist', side_effect=RuntimeError('database is away')):
+      with self.assertRaises(RuntimeError):
+        self.store.flush()
+    self.assertEqual(self.store.flush(), 1)
+    self.assertTrue(Cart.objects.filter(pk=cart_id).exists())
+
+
+class CartSummaryTest(StoreTestCase):
+  # /summary/ adds up the cart in the database to what the cart response prices in python (sale_price),
+  # and a cart that doesn't exist or an id that isn't a uuid is a 404
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(4, unit_price=lambda index: Decimal('9.99') + 5 * index)
+    self.products[1].promotions.add(Promotion.objects.create(description='Sale', discount=0.1))
+    self.products[2].promotions.add(Promotion.objects.create(description='Third off', discount=0.333))
+    self.cart = Cart.objects.create()
+    CartItem.objects.bulk_create([
+      CartItem(cart=self.cart, product=product, quantity=index + 1) for index, product in enumerate(self.products)
+    ])
+
+  def test_summary_is_the_python_total(self):
+    cart = self.client.get(f'/store/carts/{self.cart.pk}/').data
+    with self.assertNumQueries(1):
+      response = self.client.get(f'/store/carts/{self.cart.pk}/summary/')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(
+      (response.data['items_count'], response.data['quantity'], response.data['total_price']),
+      (4, 10, cart['total_price']))
+    products = with_discounts(Product.objects.filter(pk__in=[product.pk for product in self.products]))
+    self.assertEqual(cart['total_price'], sum(
+      line_total(index + 1, product.unit_price, get_discount(product)) for index, product in enumerate(products.order_by('pk'))))
+
+  def test_line_totals_are_the_python_prices(self):
+    items = with_line_totals(CartItem.objects.filter(cart=self.cart).prefetch_related(
+      Prefetch('product', queryset=with_discounts(Product.objects.all()))))
+    for item in items:
+      price = sale_price(item.product.unit_price, get_discount(item.product))
+      self.assertEqual((item.sale_price, item.line_total), (price, item.quantity * price), item.product.unit_price)
+
+  def test_empty_cart(self):
+    cart = Cart.objects.create()
+    response = self.client.get(f'/store/carts/{cart.pk}/summary/')
+    self.assertEqual((response.data['items_count'], response.data['quantity'], response.data['total_price']), (0, 0, Decimal('0.00')))
+
+  def test_unknown_cart_is_a_404(self):
+    for cart_id in ('00000000-0000-0000-0000-000000000000', 'not-a-uuid'):
+      self.assertEqual(self.client.get(f'/store/carts/{cart_id}/summary/').status_code, 404, cart_id)
+
+
+class DatabasePricingTest(StoreTestCase):
+  # the database prices (pricing.sale_price_expression through with_line_totals) are sale_price() of
+  # to_discount(): no promotion, a discount of 0, above 1 or below 0 (clamped), fractions of a cent
+  cases = [
+    (Decimal('10.00'), None, Decimal('10.00')),
+    (Decimal('10.00'), 0, Decimal('10.00')),
+    (Decimal('10.00'), 1.5, Decimal('0.00')),
+    (Decimal('10.00'), -0.2, Decimal('10.00')),
+    (Decimal('9.99'), 0.1, Decimal('8.99')), # 8.991
+    (Decimal('19.99'), 0.333, Decimal('13.33')), # 13.33333
+    (Decimal('1.01'), 0.33, Decimal('0.68')), # 0.6767
+  ]
+  # exactly half a cent, or half of the 4th place of the discount: rounded up
+  half_cents = [
+    (Decimal('10.05'), 0.5, Decimal('5.03')), # 5.025
+    (Decimal('1.25'), 0.1, Decimal('1.13')), # 1.125
+    (Decimal('12.34'), 0.12345, Decimal('10.82')), # a discount of 0.1235, 10.81601
+  ]
+
+  def check(self, cases):
+    products = self.make_products(len(cases), unit_price=lambda index: cases[index][0])
+    for product, (_, discount, _) in zip(products, cases):
+      if discount is not None:
+        product.promotions.add(Promotion.objects.create(description='Promotion', discount=discount))
+    cart = Cart.objects.create()
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=3) for product in products])
+
+    items = {item.product_id: item for item in with_line_totals(CartItem.objects.filter(cart=cart))}
+    for product, (unit_price, discount, expected) in zip(products, cases):
+      with self.subTest(unit_price=unit_price, discount=discount):
+        self.assertEqual(sale_price(unit_price, to_discount(discount)), expected)
+        self.assertEqual((items[product.pk].sale_price, items[product.pk].line_total), (expected, 3 * expected))
+    self.assertEqual(self.client.get(f'/store/carts/{cart.pk}/summary/').data['total_price'], sum(3 * expected for _, _, expected in cases))
+
+  def test_discounts(self):
+    self.check(self.cases)
+
+  def test_half_cents_round_up(self):
+    # SQLite multiplies in floating point, its ROUND still gets these to the decimal result
+    self.check(self.half_cents)
+
+
+class IdempotencyKeyTest(StoreTestCase):
+  # a retry with the same Idempotency-Key and body gets the first response back without running the
+  # view again; the same key with another body is a 422
+  def setUp(self):
+    super().setUp()
+    self.product = self.make_product()
+    self.user = self.make_customer().user
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def make_cart(self):
+    cart = Cart.objects.create()
+    CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+    return cart
+
+  def place_order(self, cart_id, key, client=None):
+    return (client or self.client).post('/store/orders/', {'cart_id': str(cart_id)}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+  def test_replay(self):
+    cart = self.make_cart()
+    first = self.place_order(cart.pk, 'order-1')
+    self.assertEqual(first.status_code, 200)
+    self.assertNotIn('Idempotent-Replayed', first)
+
+    replay = self.place_order(cart.pk, 'order-1')
+    self.assertEqual((replay.status_code, replay['Idempotent-Replayed']), (200, 'true'))
+    self.assertEqual(replay.json(), first.json())
+    self.assertEqual(Order.objects.count(), 1)
+    self.assertEqual(Product.objects.get(pk=self.product.pk).inventory, 98) # the stock left once
+
+  def test_reused_key_with_another_body(self):
+    self.place_order(self.make_cart().pk, 'order-1')
+    response = self.place_order(self.make_cart().pk, 'order-1')
+    self.assertEqual(response.status_code, 422)
+    self.assertEqual(response.data['detail'].code, 'idempotency_key_reused')
+    self.assertEqual(Order.objects.count(), 1)
+
+  def test_keys_are_scoped_to_the_user(self):
+    cart = self.make_cart()
+    self.place_order(cart.pk, 'order-1')
+    other = APIClient()
+    other.force_authenticate(self.make_customer('other').user)
+    response = self.place_order(self.make_cart().pk, 'order-1', client=other)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotIn('Idempotent-Replayed', response)
+    self.assertEqual(Order.objects.count(), 2)
+
+  def test_errors_are_not_stored(self):
+    empty = Cart.objects.create() # an empty cart can't be ordered
+    self.assertEqual(self.place_order(empty.pk, 'order-1').status_code, 400)
+    self.assertFalse(IdempotencyKey.objects.exists())
+    CartItem.objects.create(cart=empty, product=self.product, quantity=1)
+    self.assertEqual(self.place_order(empty.pk, 'order-1').status_code, 200) # the retry runs the view
+
+  def test_expired_key_starts_over(self):
+    cart = self.make_cart()
+    url = f'/store/carts/{cart.pk}/items/'
+    for _ in range(2):
+      self.client.post(url, {'product_id': self.product.pk, 'quantity': 1}, format='json', HTTP_IDEMPOTENCY_KEY='add-1')
+    self.assertEqual(CartItem.objects.get(cart=cart).quantity, 3) # the retry was replayed
+
+    IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+    response = self.client.post(url, {'product_id': self.product.pk, 'quantity': 1}, format='json', HTTP_IDEMPOTENCY_KEY='add-1')
+    self.assertNotIn('Idempotent-Replayed', response)
+    self.assertEqual(CartItem.objects.get(cart=cart).quantity, 4)
+
+
+class SalesRollupsTest(StoreTestCase):
+  # the increments of the orders completing (and leaving completion) add up to what rebuild_days
+  # aggregates from the order items
+  def setUp(self):
+    super().setUp()
+    collections = [Collection.objects.create(title=f'Collection {index}') for index in range(2)]
+    self.products = self.make_products(4, lambda index: collections[index % 2], unit_price=lambda index: 10 + index)
+    self.customer = self.make_customer()
+    self.today = timezone.localdate()
+
+  def place_order(self, days_ago, *lines):
+    order = Order.objects.create(customer=self.customer)
+    OrderItem.objects.bulk_create([
+      OrderItem(order=order, product=self.products[index], quantity=quantity, unit_price=self.products[index].unit_price - Decimal('0.25'))
+      for index, quantity in lines
+    ])
+    Order.objects.filter(pk=order.pk).update(placed_at=day_start(self.today - timedelta(days=days_ago)) + timedelta(hours=13))
+    return Order.objects.get(pk=order.pk)
+
+  def set_status(self, order, payment_status):
+    order.payment_status = payment_status
+    order.save()
+
+  def rollups(self):
+    # rows the increments left at zero (an order that completed and then failed) aren't rebuilt
+    return [
+      sorted(
+        row for row in model.objects.values_list('day', key, 'orders_count', 'units', 'revenue')
+        if any(row[2:]))
+      for model, key in ((DailyProductSales, 'product_id'), (DailyCollectionSales, 'collection_id'))
+    ]
+
+  def test_increments_match_a_rebuild(self):
+    orders = [
+      self.place_order(0, (0, 2), (1, 1)),
+      self.place_order(0, (0, 1), (2, 3)),
+      self.place_order(1, (1, 1), (3, 2)),
+      self.place_order(2, (0, 5)),
+      self.place_order(2, (2, 1), (3, 1)),
+    ]
+    for order in orders[:4]:
+      self.set_status(order, Order.PAYMENT_STATUS_COMPLETE)
+    self.set_status(orders[3], Order.PAYMENT_STATUS_FAILED) # taken out again
+    self.set_status(orders[4], Order.PAYMENT_STATUS_FAILED) # never counted
+    self.set_status(orders[1], Order.PAYMENT_STATUS_COMPLETE) # no change
+
+    incremental = self.rollups()
+    self.assertEqual(
+      [(day, product_id, orders_count, units) for day, product_id, orders_count, units, revenue in incremental[0]],
+      sorted([
+        (self.today, self.products[0].pk, 2, 3), (self.today, self.products[1].pk, 1, 1), (self.today, self.products[2].pk, 1, 3),
+        (self.today - timedelta(days=1), self.products[1].pk, 1, 1), (self.today - timedelta(days=1), self.products[3].pk, 1, 2),
+      ]))
+
+    rebuild_days(self.today - timedelta(days=2), self.today)
+    self.assertEqual(self.rollups(), incremental)
+
+
+class CustomerIdCacheTest(StoreTestCase):
+  # the customer id of a user is cached for STORE_CUSTOMER_ID_TTL seconds and forgotten when a customer
+  # of the user is created or deleted
+  def setUp(self):
+    super().setUp()
+    customer = self.make_customer()
+    self.user, self.customer_id = customer.user, customer.pk
+
+  @override_settings(STORE_CUSTOMER_ID_TTL=120)
+  def test_cached_with_a_timeout(self):
+    cache = caches['store']
+    with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+      self.assertEqual(get_customer_id(self.user.id), self.customer_id)
+    self.assertEqual(cache_set.call_args.args[2], 120)
+    with self.assertNumQueries(0):
+      self.assertEqual(get_customer_id(self.user.id), self.customer_id)
+
+  def test_forgotten_with_the_customer(self):
+    get_customer_id(self.user.id)
+    Customer.objects.filter(pk=self.customer_id).delete()
+    with self.assertRaises(Customer.DoesNotExist):
+      get_customer_id(self.user.id)
+    customer = Customer.objects.create(user=self.user)
+    self.assertEqual(get_customer_id(self.user.id), customer.pk)
+
+
+class CustomerHistoryTest(StoreTestCase):
+  # /customers/<id>/history/ has the lifetime aggregates, kept up to date by the checkout, and the
+  # orders newest first a keyset page at a time; it needs the view_history permission, not is_staff
+  def setUp(self):
+    super().setUp()
+    self.products = self.make_products(3, unit_price=lambda index: Decimal('9.99') + index)
+    self.customer = self.make_customer()
+    for index in range(12):
+      cart = Cart.objects.create()
+      CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=index % 3 + 1) for product in self.products[:index % 3 + 1]])
+      serializer = CreateOrderSerializer(data={'cart_id': cart.pk}, context={'customer_id': self.customer.pk})
+      serializer.is_valid(raise_exception=True)
+      serializer.save()
+    self.client = self.client_with_permission('support')
+
+  def client_with_permission(self, username):
+    user = self.make_customer(username).user
+    user.user_permissions.add(Permission.objects.get(codename='view_history'))
+    client = APIClient()
+    client.force_authenticate(get_user_model().objects.get(pk=user.pk)) # the permissions are cached on the instance
+    return client
+
+  def history(self, url=None):
+    response = self.client.get(url or f'/store/customers/{self.customer.pk}/history/')
+    self.assertEqual(response.status_code, 200)
+    return response.data
+
+  def test_aggregates(self):
+    items = OrderItem.objects.filter(order__customer=self.customer)
+    placed_at = Order.objects.filter(customer=self.customer).values_list('placed_at', flat=True)
+    expected = CustomerStatsSerializer(CustomerStats(
+      orders_count=12,
+      items_count=sum(item.quantity for item in items),
+      lifetime_spend=sum(item.quantity * item.unit_price for item in items),
+      first_purchase_at=min(placed_at),
+      last_purchase_at=max(placed_at),
+    )).data
+    data = self.history()
+    self.assertEqual({name: data[name] for name in expected}, expected)
+
+    # the same aggregates from the orders: read without a CustomerStats row, and rebuilt
+    CustomerStats.objects.filter(pk=self.customer.pk).delete()
+    self.assertEqual(self.history(), data)
+    CustomerStats.objects.all().delete()
+    history.rebuild(chunk_size=1)
+    self.assertEqual(self.history(), data)
+
+  def test_keyset_pages(self):
+    orders = list(Order.objects.filter(customer=self.customer))
+    now = timezone.now()
+    for index, order in enumerate(orders): # ties on placed_at are broken by the id
+      Order.objects.filter(pk=order.pk).update(placed_at=now - timedelta(hours=index // 4))
+    expected = list(Order.objects.filter(customer=self.customer).order_by('-placed_at', '-pk').values_list('pk', flat=True))
+
+    pages = []
+    url = None
+    while True:
+      orders = self.history(url)['orders']
+      pages.append([order['id'] for order in orders['results']])
+      url = orders['next']
+      if url is None:
+        break
+    self.assertEqual([len(page) for page in pages], [10, 2])
+    self.assertEqual(sum(pages, []), expected)
+    previous = self.history(orders['previous'])['orders']
+    self.assertEqual([order['id'] for order in previous['results']], pages[0])
+
+  def test_permission(self):
+    url = f'/store/customers/{self.customer.pk}/history/'
+    self.assertEqual(APIClient().get(url).status_code, 401)
+    for username, fields, status in (
+      ('staff', {'is_staff': True}, 403), # is_staff alone isn't enough
+      ('buyer2', {}, 403),
+      ('admin', {'is_staff': True, 'is_superuser': True}, 200),
+    ):
+      client = APIClient()
+      client.force_authenticate(self.make_customer(username, **fields).user)
+      self.assertEqual(client.get(url).status_code, status, username)
+    self.assertEqual(self.client_with_permission('analyst').get(url).status_code, 200) # without is_staff
+
+  def test_unknown_customer_is_a_404(self):
+    for pk in (0, 'abc'):
+      self.assertEqual(self.client.get(f'/store/customers/{pk}/history/').status_code, 404, pk)
@@ -16,7 +16,12 @@ carts_router = routers.NestedDefaultRouter(router, 'carts', lookup='cart')
 carts_router.register('items', views.CartItemViewSet, basename='cart-items')
 
 # URLConf
-urlpatterns = router.urls + products_router.urls + carts_router.urls
+urlpatterns = router.urls + products_router.urls + carts_router.urls + [
+  path('cache-stats/', views.CacheStatsView.as_view()),
+  path('reports/top-sellers/', views.TopSellersView.as_view()),
+  path('reports/revenue/', views.RevenueSeriesView.as_view()),
+  path('exports/<slug:resource>.<slug:export_format>', views.ExportView.as_view()), # products, orders, order-items . ndjson, csv
+]
 
 # urlpatterns = [
 #     # path('products/', views.product_list),
@@ -1,6 +1,9 @@
-from django.db.models import Count
+import codecs
+
+from django.conf import settings
+from django.db.models import Max
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework.filters import SearchFilter
@@ -14,22 +17,36 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework import status
-
-from store.filters import ProductFilter
-from store.pagination import DefaultPagination
+from rest_framework.exceptions import NotFound, UnsupportedMediaType, ValidationError
+
+from store.caching import CachedResponseMixin, response_cache
+from store.carts import get_cart_store
+from store.compiled import CompiledListMixin
+from store.conditional import ConditionalGetMixin
+from store.customers import get_request_customer_id
+from store import exports, history, rollups, snapshots
+from store.fieldsets import SparseFieldsViewSetMixin
+from store.idempotency import idempotent
+from store.facets import get_facets
+from store.importing import FORMATS, ProductImporter, read_records
+from store.pricing import with_discounts, with_line_totals
+from store.filters import ProductFilter, ProductSearchFilter
+from store.pagination import DefaultPagination, KeysetPagination, KeysetSwitchMixin, OrderKeysetPagination
 from store.permissions import FullDjangoModelPermissions, IsAdminOrReadOnly, ViewCustomerHistoryPermission
-from .models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product, Review
-from .serializers import AddCartItemSerializer, CartItemSerializer, CartSerializer, CollectionSerializer, CreateOrderSerializer, CustomerSerializer, OrderSerializer, ProductSerializer, ReviewSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
+from .models import Cart, CartItem, Collection, Customer, Order, OrderItem, OrderSnapshot, Product, ProductRecommendation, Review
+from .serializers import AddCartItemSerializer, BatchAddCartItemsSerializer, CartItemSerializer, CartSerializer, CollectionSerializer, CreateOrderSerializer, CustomerSerializer, CustomerStatsSerializer, OrderSerializer, ProductSerializer, ReviewSerializer, SalesReportSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
 
 # Create your views here.
 
-class ProductViewSet(ModelViewSet): # this is alternate to using ListCreateAPIView and RetrieveUpdateDestroyAPIView classes
+class ProductViewSet(ConditionalGetMixin, CachedResponseMixin, SparseFieldsViewSetMixin, CompiledListMixin, KeysetSwitchMixin, ModelViewSet): # this is alternate to using ListCreateAPIView and RetrieveUpdateDestroyAPIView classes
   queryset = Product.objects.all() # since we removed this queryset from here we have to explicitly define basename in the urls.py
   serializer_class = ProductSerializer
-  filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+  cache_namespace = 'products'
+  filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
   # filterset_fields = ['collection_id', 'unit_price']
   filterset_class = ProductFilter
   pagination_class = DefaultPagination
+  keyset_pagination_class = KeysetPagination # used instead of pagination_class when the client asks for ?cursor=
   permission_classes = [IsAdminOrReadOnly]
   search_fields = ['title', 'description']
   ordering_fields = ['unit_price', 'last_update']
@@ -41,18 +58,69 @@ class ProductViewSet(ModelViewSet): # this is alternate to using ListCreateAPIVi
   #     queryset = queryset.filter(collection_id=collection_id)
   #   return queryset
 
-  def get_serializer_context(self):
-    return {'request': self.request}
+  def get_queryset(self):
+    return self.plan_queryset(with_discounts(Product.objects.all()))
+
+  @action(detail=True)
+  def recommendations(self, request, pk):
+    # the products most often bought together with this one, best first: one read of the
+    # (product, rank) index written by manage.py build_recommendations; the existence of the
+    # product is only checked when it has none
+    try:
+      rows = list(
+        ProductRecommendation.objects.filter(product_id=pk).order_by('rank')
+          .values('score', 'recommended_id', 'recommended__title', 'recommended__unit_price'))
+    except ValueError:
+      raise NotFound()
+    if not rows and not Product.objects.filter(pk=pk).exists():
+      raise NotFound()
+    return Response([
+      {'id': row['recommended_id'], 'title': row['recommended__title'], 'unit_price': row['recommended__unit_price'], 'score': row['score']}
+      for row in rows
+    ])
+
+  def get_validator_aggregates(self):
+    aggregates = super().get_validator_aggregates()
+    if 'collection' in self.get_requested_fields()[1]:
+      aggregates['modified_collection'] = Max('collection__last_update')
+    return aggregates
+
+  def is_conditional(self):
+    # reviews carry no modification time, an edited review could never invalidate the ETag
+    return 'reviews' not in self.get_requested_fields()[1]
+
+  @action(detail=False)
+  def facets(self, request):
+    # counts per collection, price bucket and stock level of the products matching the same filters and ?search= as the list
+    queryset = self.filter_queryset(Product.objects.all())
+    names = set(self.filterset_class.base_filters) | {ProductSearchFilter.search_param}
+    params = [(name, value) for name, values in request.query_params.lists() if name in names for value in values]
+    return Response(get_facets(queryset, params))
+
+  @action(detail=False, methods=['POST'], url_path='import')
+  def import_products(self, request):
+    # the body is a JSON Lines (application/x-ndjson) or CSV (text/csv) stream of products, upserted by slug
+    format = FORMATS.get(request.content_type.split(';')[0].strip())
+    if format is None:
+      raise UnsupportedMediaType(request.content_type)
+    lines = codecs.iterdecode(request.stream or [], 'utf-8-sig')
+    return Response(ProductImporter().run(read_records(lines, format)))
 
   def destroy(self, request, *args, **kwargs):
     if OrderItem.objects.filter(product_id=kwargs['pk']).count() > 0:
       return Response({'error': 'Product cannot be deleted because it is associated with an order item.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
     return super().destroy(request, *args, **kwargs)
 
-class CollectionViewSet(ModelViewSet):
-  queryset = Collection.objects.annotate(products_count=Count('products')).all()
+class CollectionViewSet(ConditionalGetMixin, CachedResponseMixin, SparseFieldsViewSetMixin, ModelViewSet):
+  queryset = Collection.objects.all() # products_count is a column, see adjust_products_count in models.py
   serializer_class = CollectionSerializer
   permission_classes = [IsAdminOrReadOnly]
+  cache_namespace = 'collections'
+  detail_depends_on_list = True # products_count changes whenever a product is added, moved or deleted
+  # adjusting products_count moves last_update as well, the validators don't need to join the products
+
+  def get_queryset(self):
+    return self.plan_queryset(super().get_queryset())
 
   def destroy(self, request, *args, **kwargs):
     if Product.objects.filter(collection_id=kwargs['pk']).count() > 0:
@@ -69,13 +137,46 @@ class ReviewViewSet(ModelViewSet):
   def get_serializer_context(self):
     return {'product_id': self.kwargs['product_pk']}
 
-class CartViewSet(CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, GenericViewSet): # not using ModelViewSet as we will not be using all the methods of the class, like list and update; check implementation of ModelViewSet, its just combo of different mixins, so we will create custom viewset using mixins we require
-  queryset = Cart.objects.prefetch_related('items__product').all()
+class CartViewSet(ConditionalGetMixin, SparseFieldsViewSetMixin, CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, GenericViewSet): # not using ModelViewSet as we will not be using all the methods of the class, like list and update; check implementation of ModelViewSet, its just combo of different mixins, so we will create custom viewset using mixins we require
+  queryset = Cart.objects.all()
   serializer_class = CartSerializer
+  last_modified_fields = ['last_update', 'items__product__last_update'] # line prices come from the products
 
-
-class CartItemViewSet(ModelViewSet):
+  def get_queryset(self):
+    return self.plan_queryset(super().get_queryset()) # prefetches items and their products unless ?fields= leaves them out
+
+  # carts are read with querysets when the cart store keeps them in the database, otherwise from the store
+  def is_conditional(self):
+    return get_cart_store().persistent
+
+  def get_object(self):
+    cart_store = get_cart_store()
+    if cart_store.persistent:
+      return super().get_object()
+    cart = cart_store.get_cart(self.kwargs['pk'])
+    if cart is None:
+      raise NotFound()
+    self.check_object_permissions(self.request, cart)
+    return cart
+
+  def perform_create(self, serializer):
+    serializer.instance = get_cart_store().create_cart()
+
+  def perform_destroy(self, instance):
+    get_cart_store().delete_cart(instance.pk)
+
+  @action(detail=True, methods=['GET'])
+  def summary(self, request, pk):
+    # number of items, units and total price of the cart, one aggregate query without the items
+    summary = get_cart_store().summary(pk)
+    if summary is None:
+      raise NotFound()
+    return Response(summary)
+
+
+class CartItemViewSet(ConditionalGetMixin, CompiledListMixin, ModelViewSet):
   http_method_names = ['get', 'post', 'patch', 'delete']
+  last_modified_fields = ['cart__last_update', 'product__last_update']
   
   def get_serializer_class(self):
     if self.request.method == 'POST':
@@ -88,18 +189,76 @@ class CartItemViewSet(ModelViewSet):
     return {'cart_id' : self.kwargs['cart_pk']}
 
   def get_queryset(self):
-    return CartItem.objects.filter(cart_id=self.kwargs['cart_pk']).select_related('product')
+    return with_line_totals(CartItem.objects.filter(cart_id=self.kwargs['cart_pk'])).select_related('product')
+
+  def is_conditional(self):
+    return get_cart_store().persistent
+
+  def list(self, request, *args, **kwargs):
+    cart_store = get_cart_store()
+    if cart_store.persistent:
+      return super().list(request, *args, **kwargs)
+    cart_items = cart_store.get_items(self.kwargs['cart_pk']) or []
+    return Response(self.get_serializer(cart_items, many=True).data)
+
+  def get_object(self):
+    cart_store = get_cart_store()
+    if cart_store.persistent:
+      return super().get_object()
+    cart_item = cart_store.get_item(self.kwargs['cart_pk'], self.kwargs['pk'])
+    if cart_item is None:
+      raise NotFound()
+    return cart_item
+
+  def perform_destroy(self, instance):
+    get_cart_store().delete_item(instance)
+
+  # retries of the changes with the same Idempotency-Key get the first response back
+  @idempotent
+  def create(self, request, *args, **kwargs):
+    return super().create(request, *args, **kwargs)
 
+  @idempotent
+  def partial_update(self, request, *args, **kwargs):
+    return super().partial_update(request, *args, **kwargs)
 
-class CustomerViewSet(ModelViewSet):
+  @idempotent
+  def destroy(self, request, *args, **kwargs):
+    return super().destroy(request, *args, **kwargs)
+
+  @action(detail=False, methods=['POST'])
+  @idempotent
+  def batch(self, request, cart_pk):
+    # adds many products to the cart in one request, with one upsert statement per batch of items
+    serializer = BatchAddCartItemsSerializer(data=request.data, context=self.get_serializer_context())
+    serializer.is_valid(raise_exception=True)
+    cart_items = serializer.save()
+    return Response(AddCartItemSerializer(cart_items, many=True).data)
+
+
+class CustomerViewSet(SparseFieldsViewSetMixin, ModelViewSet):
   queryset = Customer.objects.all()
   serializer_class = CustomerSerializer
   # permission_classes = [FullDjangoModelPermissions]
   permission_classes = [IsAdminUser]
 
+  def get_queryset(self):
+    return self.plan_queryset(super().get_queryset())
+
   @action(detail=True, permission_classes=[ViewCustomerHistoryPermission])
   def history(self, request, pk):
-    return Response('ok')
+    # the lifetime aggregates of the customer (store.history) and their orders, newest first, a keyset
+    # page at a time over the (customer, placed_at, id) index: ?cursor= from next/previous
+    try:
+      stats = history.get_stats(int(pk))
+    except ValueError:
+      stats = None
+    if stats is None:
+      raise NotFound()
+    paginator = OrderKeysetPagination()
+    page = paginator.paginate_queryset(OrderSerializer.plan_queryset(Order.objects.filter(customer_id=stats.customer_id)), request, view=self)
+    orders = paginator.get_paginated_response(OrderSerializer(page, many=True).data).data
+    return Response({**CustomerStatsSerializer(stats).data, 'orders': orders})
 
   @action(detail=False, methods=['GET', 'PUT'], permission_classes=[IsAuthenticated])
   def me(self, request):
@@ -114,16 +273,70 @@ class CustomerViewSet(ModelViewSet):
       return Response(serializer.data)
 
 
-class OrderViewSet(ModelViewSet):
+class TopSellersView(APIView):
+  # GET /store/reports/top-sellers/?start=2024-01-01&end=2024-01-31&collection=3&limit=10, from the rollups
+  permission_classes = [IsAdminUser]
+
+  def get(self, request):
+    params = SalesReportSerializer(data=request.query_params)
+    params.is_valid(raise_exception=True)
+    data = params.validated_data
+    return Response(rollups.top_sellers(data['start'], data['end'], data['limit'], data.get('collection')))
+
+
+class RevenueSeriesView(APIView):
+  # GET /store/reports/revenue/?start=...&end=...[&collection=3 | &product=1], a row per day from the rollups
+  permission_classes = [IsAdminUser]
+
+  def get(self, request):
+    params = SalesReportSerializer(data=request.query_params)
+    params.is_valid(raise_exception=True)
+    data = params.validated_data
+    return Response(rollups.revenue_series(data['start'], data['end'], data.get('collection'), data.get('product')))
+
+
+class CacheStatsView(APIView):
+  permission_classes = [IsAdminUser]
+
+  def get(self, request):
+    return Response(response_cache.stats())
+
+
+class ExportView(APIView):
+  # GET /store/exports/orders.csv?placed_at__gte=...&payment_status=C streams the whole table
+  # (no pagination) as NDJSON or CSV, rows are read and written a chunk at a time
+  permission_classes = [IsAdminUser]
+  content_negotiation_class = exports.ExportContentNegotiation
+  chunk_size = 2000
+
+  def get(self, request, resource, export_format):
+    export = exports.EXPORTS.get(resource)
+    if export is None or export_format not in exports.FORMATS:
+      raise NotFound()
+    queryset, errors = export.filter(request.query_params)
+    if errors:
+      raise ValidationError(errors)
+
+    content_type, write_lines = exports.FORMATS[export_format]
+    response = StreamingHttpResponse(write_lines(export.columns, export.rows(queryset, self.chunk_size)), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (resource, export_format)
+    return response
+
+
+class OrderViewSet(ConditionalGetMixin, SparseFieldsViewSetMixin, CompiledListMixin, KeysetSwitchMixin, ModelViewSet):
   http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']
+  pagination_class = DefaultPagination
+  keyset_pagination_class = OrderKeysetPagination # used instead of pagination_class when the client asks for ?cursor=
+  last_modified_fields = ['last_update', 'items__product__last_update'] # items show the current product title and price
   
   def get_permissions(self):
     if self.request.method in ['PATCH', 'DELETE']:
       return [IsAdminUser()]
     return [IsAuthenticated()]
 
+  @idempotent
   def create(self, request, *args, **kwargs):
-    serializer = CreateOrderSerializer(data=request.data, context={'user_id': request.user.id})
+    serializer = CreateOrderSerializer(data=request.data, context={'customer_id': get_request_customer_id(request)})
     serializer.is_valid(raise_exception=True)
     order = serializer.save()
     serializer = OrderSerializer(order)
@@ -137,12 +350,47 @@ class OrderViewSet(ModelViewSet):
     return OrderSerializer
 
   def get_queryset(self):
-    user = self.request.user
-    if user.is_staff:
-      return Order.objects.all()
-    
-    customer_id = Customer.objects.only('id').get(user_id=user.id)
-    return Order.objects.filter(customer_id=customer_id)
+    # newest first; the items and their products are prefetched (OrderSerializer.Meta.field_relations),
+    # a page costs the same number of queries whatever its size
+    queryset = Order.objects.order_by('-placed_at', '-id')
+    if not self.request.user.is_staff:
+      queryset = queryset.filter(customer_id=get_request_customer_id(self.request))
+    return self.plan_queryset(queryset)
+
+  def use_snapshots(self):
+    # STORE_ORDER_SNAPSHOTS: list and retrieve serve the documents of OrderSnapshot, one indexed read
+    # without joining the items and products (and without the validators, is_conditional)
+    return getattr(settings, 'STORE_ORDER_SNAPSHOTS', False) and self.action in ('list', 'retrieve')
+
+  def is_conditional(self):
+    return not self.use_snapshots()
+
+  def get_snapshot_queryset(self):
+    queryset = OrderSnapshot.objects.order_by('-placed_at', '-order_id')
+    if not self.request.user.is_staff:
+      queryset = queryset.filter(customer_id=get_request_customer_id(self.request))
+    return queryset
+
+  def list(self, request, *args, **kwargs):
+    if not self.use_snapshots():
+      return super().list(request, *args, **kwargs)
+    queryset = self.get_snapshot_queryset().values('placed_at', 'order_id', 'document')
+    fields = self.get_requested_fields()[0]
+    page = self.paginate_queryset(queryset)
+    if page is not None:
+      return self.get_paginated_response(snapshots.render(page, fields))
+    return Response(snapshots.render(queryset, fields))
+
+  def retrieve(self, request, *args, **kwargs):
+    if not self.use_snapshots():
+      return super().retrieve(request, *args, **kwargs)
+    try:
+      row = self.get_snapshot_queryset().filter(order_id=self.kwargs['pk']).values('document').first()
+    except (TypeError, ValueError):
+      raise NotFound()
+    if row is None: # no such order, or no snapshot of it yet (manage.py rebuild_order_snapshots)
+      return super().retrieve(request, *args, **kwargs)
+    return Response(snapshots.render([row], self.get_requested_fields()[0])[0])
 
 
 
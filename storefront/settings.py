@@ -101,6 +101,27 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'store': { # api response cache, see store/caching.py
+        # locmem (or django.core.cache.backends.filebased.FileBasedCache) is fine for development and tests,
+        # in production point this at a shared cache, e.g. django.core.cache.backends.redis.RedisCache
+        # with maxmemory-policy allkeys-lru
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'store',
+        'TIMEOUT': 300, # seconds
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000, # least recently used entries are evicted past this
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -148,7 +169,7 @@ REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False, # this is to avoid converting decimal fields to string, which is the default behavior
     # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination', # this line can be used to enable panination globally
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.CachedJWTAuthentication', # JWTAuthentication with the users and their permissions cached in memory
     ),
     # 'DEFAULT_PERMISSION_CLASSES': [
     #     'rest_framework.permissions.IsAuthenticated'
@@ -157,6 +178,37 @@ REST_FRAMEWORK = {
 
 AUTH_USER_MODEL = 'core.User'
 
+STORE_TAX_RATE = '0.1' # a string so store.pricing gets an exact Decimal
+
+STORE_RESPONSE_CACHE = 'store' # alias in CACHES used to cache product and collection responses
+
+STORE_SEARCH_BACKEND = 'store.search.InvertedIndexSearchBackend' # or 'store.search.LikeSearchBackend' for plain LIKE '%term%' lookups
+
+STORE_COMPILED_SERIALIZERS = False # True to render list pages of the viewsets using store.compiled.CompiledListMixin from values() rows
+
+STORE_CART_EXPIRY_DAYS = 30 # carts untouched for this long are deleted by store.reaper (manage.py reap_carts)
+
+STORE_CART_REAPER_INTERVAL = None # seconds; when set every process also runs the reaper in a background thread
+
+STORE_CART_STORE = 'store.carts.DatabaseCartStore' # or 'store.carts.CacheCartStore' to keep carts in the STORE_CART_CACHE cache
+
+STORE_CART_CACHE = 'default' # alias in CACHES for store.carts.CacheCartStore, a shared cache (e.g. Redis) with several processes
+
+STORE_CART_WRITE_BEHIND = None # seconds; when set CacheCartStore also writes changed carts to the database this often
+
+STORE_OUTBOX_WORKER = False # True delivers order_created and the other outbox events from a thread of every process (e.g. runserver)
+STORE_OUTBOX_INLINE = True # without the worker thread, deliver the events right after the commit that published them; False when manage.py run_outbox_worker runs
+
+STORE_IDEMPOTENCY_TTL = 24 * 60 * 60 # seconds a response to a request with an Idempotency-Key is replayed (manage.py purge_idempotency_keys)
+
+STORE_CUSTOMER_ID_TTL = 60 * 60 # seconds the customer id of a user is cached (store.customers)
+
+STORE_ORDER_SNAPSHOTS = False # True serves the order list and detail from store.models.OrderSnapshot; run manage.py rebuild_order_snapshots first
+
+STORE_RECOMMENDATIONS_TOP_K = 10 # products kept per product by manage.py build_recommendations (store.recommendations)
+
+CORE_USER_CACHE = {'MAXSIZE': 10000, 'TTL': 60} # users of JWT tokens kept per process (core.authentication), a change made elsewhere shows after TTL seconds
+
 DJOSER = {
     'SERIALIZERS': {
         'user_create': 'core.serializers.UserCreateSerializer', # under serializers then under default we can see all the serializers used by djoser then can change what we want to change https://djoser.readthedocs.io/en/latest/settings.html
@@ -166,5 +218,6 @@ DJOSER = {
 
 SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('JWT',),
-    "ACCESS_TOKEN_LIFETIME": timedelta(days=1)
+    "ACCESS_TOKEN_LIFETIME": timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'core.serializers.TokenObtainPairSerializer', # adds the customer_id claim
 }
\ No newline at end of file